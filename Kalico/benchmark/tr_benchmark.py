@@ -0,0 +1,355 @@
+#!/usr/bin/env python3
+# Offline toolchange benchmark for the trad_rack klippy module
+#
+# Copyright (C) 2022-2026 Ryan Ghosh <rghosh776@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import argparse, configparser, json, os, random, sys, tempfile
+import tr_sim
+
+# config options that only make sense on a real printer
+IGNORED_OPTIONS = ("selector_sensor_pin", "servo_pin", "extruder")
+
+
+def load_config_file(filename):
+    # read the [trad_rack] section of a klipper config file
+    parser = configparser.RawConfigParser(
+        inline_comment_prefixes=("#", ";"), strict=False
+    )
+    with open(filename) as f:
+        parser.read_file(f)
+    if not parser.has_section("trad_rack"):
+        raise ValueError("No [trad_rack] section in '%s'" % filename)
+    options = {}
+    for option, value in parser.items("trad_rack"):
+        if option in IGNORED_OPTIONS or option.endswith("_gcode"):
+            continue
+        options[option] = value.strip()
+    return options
+
+
+def parse_overrides(overrides):
+    options = {}
+    for override in overrides:
+        option, sep, value = override.partition("=")
+        if not sep:
+            raise ValueError("Expected OPTION=VALUE, got '%s'" % override)
+        options[option.strip()] = value.strip()
+    return options
+
+
+def build_sections(lane_count, bowden_length, toolhead_sensor, options):
+    sections = tr_sim.default_sections(
+        lane_count=lane_count,
+        bowden_length=bowden_length,
+        toolhead_sensor=toolhead_sensor,
+    )
+    tr = sections["trad_rack"]
+    for option, value in options.items():
+        if option == "toolhead_fil_sensor_pin":
+            # use the simulated toolhead sensor
+            continue
+        tr[option] = value
+    lane_spacing = float(tr["lane_spacing"])
+    sections["stepper_tr_selector"]["position_max"] = (
+        int(tr["lane_count"]) - 1
+    ) * lane_spacing
+    return sections
+
+
+def read_gcode_toolchanges(sim, filename):
+    # find toolchanges with the same parser used to prefetch toolchanges
+    prefetcher = sim.trad_rack_module.TradRackToolPrefetcher(
+        sim.printer, os.path.getsize(filename) + 1
+    )
+    sdcard = tr_sim.SimObject(
+        get_status=lambda eventtime: {
+            "file_path": filename,
+            "file_position": 0,
+        }
+    )
+    sim.printer.add_object("virtual_sdcard", sdcard)
+    try:
+        return list(prefetcher.find_toolchanges(0.0))
+    finally:
+        del sim.printer.objects["virtual_sdcard"]
+
+
+def make_sequence(args, lane_count):
+    # returns a list of (tool, lane) toolchanges
+    if args.sequence:
+        return [(int(t), None) for t in args.sequence.split(",") if t.strip()]
+    if args.gcode:
+        return None
+    rand = random.Random(args.seed)
+    sequence = [(rand.randrange(lane_count), None)]
+    while len(sequence) <= args.swaps:
+        tool = rand.randrange(lane_count)
+        if tool != sequence[-1][0]:
+            sequence.append((tool, None))
+    return sequence
+
+
+def toolchange_command(tool, lane):
+    if lane is not None:
+        return "TR_LOAD_TOOLHEAD LANE=%d" % lane
+    return "TR_LOAD_TOOLHEAD TOOL=%d" % tool
+
+
+def run_benchmark(args, sections, world_params):
+    fd, variables_file = tempfile.mkstemp(suffix=".cfg")
+    os.close(fd)
+    os.remove(variables_file)
+    try:
+        sim = tr_sim.Simulation(
+            sections=sections,
+            variables_file=variables_file,
+            world_params=world_params,
+            verbose=args.verbose,
+        )
+        lane_count = int(sections["trad_rack"]["lane_count"])
+        sequence = make_sequence(args, lane_count)
+        if sequence is None:
+            sequence = read_gcode_toolchanges(sim, args.gcode)
+        if len(sequence) < 2:
+            raise ValueError("At least 2 toolchanges are needed")
+        for tool, lane in sequence:
+            if not 0 <= (tool if lane is None else lane) < lane_count:
+                raise ValueError(
+                    "Toolchange to %s is out of range"
+                    % toolchange_command(tool, lane)
+                )
+        return simulate(sim, sequence, args.gap)
+    finally:
+        if os.path.exists(variables_file):
+            os.remove(variables_file)
+
+
+def simulate(sim, sequence, gap, time_first=False):
+    # time each toolchange in the sequence after the first, or every
+    # toolchange (starting with nothing loaded) if time_first is True
+    trad_rack = sim.trad_rack
+
+    # write the toolchanges to a print file so prefetching can look ahead
+    fd, print_file = tempfile.mkstemp(suffix=".gcode")
+    positions = []
+    with os.fdopen(fd, "w") as f:
+        for tool, lane in sequence:
+            positions.append(f.tell())
+            f.write(toolchange_command(tool, lane) + "\n")
+    file_position = [0]
+    sim.printer.add_object(
+        "virtual_sdcard",
+        tr_sim.SimObject(
+            get_status=lambda eventtime: {
+                "file_path": print_file,
+                "file_position": file_position[0],
+                "is_active": True,
+            }
+        ),
+    )
+
+    try:
+        # home and load the first lane (not timed)
+        sim.run_gcode("TR_HOME")
+        first = 0 if time_first else 1
+        if not time_first:
+            sim.run_gcode(toolchange_command(*sequence[0]))
+        start = sim.finish()
+        trad_rack.phase_timer.reset()
+        writes_start = sim.save_variables.write_count
+        queries_start = sim.stats["mcu_queries"]
+        sim.printing = True
+        sim.printer.send_event("idle_timeout:printing", start)
+
+        swap_times = []
+        skipped = 0
+        pipeline_saved = 0.0
+        for (tool, lane), position in zip(sequence[first:], positions[first:]):
+            # print until the next toolchange
+            sim.advance(gap)
+            start = sim.finish()
+
+            # time the toolchange
+            file_position[0] = position
+            prev_lane = trad_rack.active_lane
+            sim.run_gcode(toolchange_command(tool, lane))
+            swap_times.append(sim.finish() - start)
+
+            # count toolchanges skipped because the lane was already loaded
+            # (pipeline_time_saved is not updated for these)
+            if prev_lane is not None and trad_rack.active_lane == prev_lane:
+                skipped += 1
+            else:
+                pipeline_saved += trad_rack.pipeline_time_saved
+    finally:
+        os.remove(print_file)
+
+    swaps = len(swap_times)
+    sorted_times = sorted(swap_times)
+    phases = {
+        phase: stats["total"] / swaps
+        for phase, stats in trad_rack.phase_timer.get_phases().items()
+    }
+    return {
+        "swaps": swaps,
+        "skipped_swaps": skipped,
+        "swap_times": swap_times,
+        "total_time": sum(swap_times),
+        "mean_swap_time": sum(swap_times) / swaps,
+        "median_swap_time": sorted_times[swaps // 2],
+        "max_swap_time": sorted_times[-1],
+        "min_swap_time": sorted_times[0],
+        "pipeline_time_saved": pipeline_saved / swaps,
+        "variable_writes_per_swap": (
+            sim.save_variables.write_count - writes_start
+        )
+        / float(swaps),
+        "mcu_queries_per_swap": (sim.stats["mcu_queries"] - queries_start)
+        / float(swaps),
+        "phase_time_per_swap": phases,
+        "violations": list(sim.world.violations),
+    }
+
+
+def format_result(name, result):
+    lines = [
+        "%s: %d swaps" % (name, result["swaps"]),
+        "  mean swap time:       %8.3f s" % result["mean_swap_time"],
+        "  median swap time:     %8.3f s" % result["median_swap_time"],
+        "  min/max swap time:    %8.3f / %.3f s"
+        % (result["min_swap_time"], result["max_swap_time"]),
+        "  total swap time:      %8.1f s" % result["total_time"],
+        "  pipeline time saved:  %8.3f s" % result["pipeline_time_saved"],
+        "  variable writes/swap: %8.2f" % result["variable_writes_per_swap"],
+        "  MCU queries/swap:     %8.2f" % result["mcu_queries_per_swap"],
+        "  time per swap by phase:",
+    ]
+    phases = result["phase_time_per_swap"]
+    for phase in sorted(phases, key=lambda p: -phases[p]):
+        lines.append("    %-20s %8.3f s" % (phase, phases[phase]))
+    for violation in result["violations"]:
+        lines.append("  VIOLATION: %s" % violation)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Simulate Trad Rack toolchanges without a printer and report the"
+            " time per swap"
+        )
+    )
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument(
+        "--sequence", help="comma separated list of tools to load in order"
+    )
+    source.add_argument(
+        "--gcode", help="sliced gcode file to read the toolchanges from"
+    )
+    parser.add_argument(
+        "--swaps",
+        type=int,
+        default=20,
+        help="number of random toolchanges if no sequence or gcode is given",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--config", help="klipper config file with a [trad_rack] section"
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="OPTION=VALUE",
+        help="override a [trad_rack] config option",
+    )
+    parser.add_argument(
+        "--compare",
+        action="append",
+        default=[],
+        metavar="OPTION=VALUE",
+        help="also run with this option overridden and report the difference",
+    )
+    parser.add_argument("--lane-count", type=int, default=16)
+    parser.add_argument("--bowden-length", type=float, default=1000.0)
+    parser.add_argument(
+        "--gap",
+        type=float,
+        default=10.0,
+        help="seconds of printing between toolchanges (not timed)",
+    )
+    parser.add_argument(
+        "--slip-noise",
+        type=float,
+        default=0.0,
+        help="standard deviation of the simulated filament slip",
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument(
+        "--baseline", help="results file from a previous --json run"
+    )
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=5.0,
+        help="percent the mean swap time may exceed the baseline",
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    try:
+        options = {}
+        if args.config:
+            options.update(load_config_file(args.config))
+        options.update(parse_overrides(args.set))
+        world_params = {"slip_noise": args.slip_noise}
+        runs = [("base", options)]
+        if args.compare:
+            compare_options = dict(options)
+            compare_options.update(parse_overrides(args.compare))
+            runs.append(("compare", compare_options))
+        results = {}
+        for name, run_options in runs:
+            sections = build_sections(
+                int(run_options.get("lane_count", args.lane_count)),
+                float(run_options.get("bowden_length", args.bowden_length)),
+                not args.config or "toolhead_fil_sensor_pin" in run_options,
+                run_options,
+            )
+            results[name] = run_benchmark(args, sections, world_params)
+            print(format_result(name, results[name]))
+    except (ValueError, IOError, tr_sim.ConfigError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 2
+
+    failed = False
+    if "compare" in results:
+        base = results["base"]["mean_swap_time"]
+        diff = results["compare"]["mean_swap_time"] - base
+        print(
+            "compare - base: %+.3f s per swap (%+.1f%%)"
+            % (diff, 100.0 * diff / base)
+        )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)["base"]["mean_swap_time"]
+        limit = baseline * (1.0 + args.max_regression / 100.0)
+        mean = results["base"]["mean_swap_time"]
+        if mean > limit:
+            print(
+                "REGRESSION: mean swap time %.3f s exceeds baseline %.3f s by"
+                " more than %.1f%%" % (mean, baseline, args.max_regression)
+            )
+            failed = True
+    for result in results.values():
+        if result["violations"]:
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
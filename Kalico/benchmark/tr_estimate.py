@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# Toolchange time estimator for sliced gcode files
+#
+# Copyright (C) 2022-2026 Ryan Ghosh <rghosh776@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import argparse, json, os, re, shutil, sys, tempfile
+import tr_benchmark, tr_sim
+
+# bytes read from the start and end of the file to find the slicer's print
+# time estimate
+ESTIMATE_BYTES = 64 * 1024
+# print time estimates written by PrusaSlicer/SuperSlicer, OrcaSlicer and
+# Cura
+DURATION_REGEX = re.compile(
+    rb"^;\s*(?:estimated printing time \(normal mode\)|total estimated time)"
+    rb"\s*[:=]\s*((?:\d+[dhms]\s*)+)",
+    re.MULTILINE | re.IGNORECASE,
+)
+SECONDS_REGEX = re.compile(rb"^;TIME:(\d+)", re.MULTILINE)
+DURATION_PART_REGEX = re.compile(rb"(\d+)([dhms])")
+DURATION_UNITS = {b"d": 86400, b"h": 3600, b"m": 60, b"s": 1}
+
+
+def read_slicer_estimate(filename):
+    # returns the print time estimated by the slicer in seconds, or None if
+    # there is no estimate in the file
+    with open(filename, "rb") as f:
+        head = f.read(ESTIMATE_BYTES)
+        f.seek(0, os.SEEK_END)
+        f.seek(max(len(head), f.tell() - ESTIMATE_BYTES))
+        data = head + b"\n" + f.read()
+    match = DURATION_REGEX.search(data)
+    if match is not None:
+        return float(
+            sum(
+                int(value) * DURATION_UNITS[unit.lower()]
+                for value, unit in DURATION_PART_REGEX.findall(match.group(1))
+            )
+        )
+    match = SECONDS_REGEX.search(data)
+    if match is not None:
+        return float(match.group(1))
+    return None
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(round(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    if hours:
+        return "%dh %dm %ds" % (hours, minutes, seconds)
+    if minutes:
+        return "%dm %ds" % (minutes, seconds)
+    return "%ds" % seconds
+
+
+def match_calibration(sim):
+    # move the simulated toolhead sensor to where the saved bowden lengths
+    # put it, so that loads home the usual distance instead of the distance
+    # implied by bowden_length
+    trad_rack = sim.trad_rack
+    if not trad_rack.bowden_load_length_filter.get_entry_count():
+        return
+    sensor_pos = (
+        trad_rack.bowden_load_length + trad_rack.target_toolhead_homing_dist
+    )
+    offsets = {}
+    if trad_rack.per_lane_bowden_lengths:
+        for lane, length in enumerate(trad_rack.lane_bowden_load_lengths):
+            if length is not None:
+                offsets[lane] = length - trad_rack.bowden_load_length
+    sim.world.params["toolhead_sensor_pos"] = sensor_pos
+    sim.world.params["lane_path_offsets"] = offsets
+
+
+def extrapolate(result, sequence):
+    # estimate the time of toolchanges after the simulated ones from the mean
+    # time of the same toolchange (from the same tool or lane to the same
+    # tool or lane) in the simulated ones, or the mean time of all simulated
+    # toolchanges that were not to the current tool
+    simulated = len(result["swap_times"])
+    transitions = {}
+    other_times = []
+    for i, swap_time in enumerate(result["swap_times"]):
+        prev = sequence[i - 1] if i else None
+        transitions.setdefault((prev, sequence[i]), []).append(swap_time)
+        if prev != sequence[i]:
+            other_times.append(swap_time)
+    mean_times = {
+        key: sum(times) / len(times) for key, times in transitions.items()
+    }
+    mean_time = sum(other_times) / len(other_times)
+    total_time = result["total_time"]
+    skipped = result["skipped_swaps"]
+    for prev, toolchange in zip(
+        sequence[simulated - 1 :], sequence[simulated:]
+    ):
+        if prev == toolchange:
+            skipped += 1
+            total_time += mean_times.get((prev, toolchange), 0.0)
+        else:
+            total_time += mean_times.get((prev, toolchange), mean_time)
+    result["simulated_swaps"] = simulated
+    result["swaps"] = len(sequence)
+    result["skipped_swaps"] = skipped
+    result["total_time"] = total_time
+    result["mean_swap_time"] = total_time / len(sequence)
+
+
+def estimate_file(
+    filename, sections, variables_file, gap, max_swaps=None, verbose=False
+):
+    # the simulator saves variables as it runs, so it is given a copy of the
+    # save_variables file
+    fd, temp_file = tempfile.mkstemp(suffix=".cfg")
+    os.close(fd)
+    if variables_file:
+        shutil.copyfile(variables_file, temp_file)
+    else:
+        os.remove(temp_file)
+    try:
+        sim = tr_sim.Simulation(
+            sections=sections, variables_file=temp_file, verbose=verbose
+        )
+        match_calibration(sim)
+        lane_count = int(sections["trad_rack"]["lane_count"])
+        sequence = tr_benchmark.read_gcode_toolchanges(sim, filename)
+        if not sequence:
+            raise ValueError("No toolchanges found in '%s'" % filename)
+        for tool, lane in sequence:
+            if not 0 <= (tool if lane is None else lane) < lane_count:
+                raise ValueError(
+                    "Toolchange to %s is out of range"
+                    % tr_benchmark.toolchange_command(tool, lane)
+                )
+
+        # spread the slicer's print time evenly between toolchanges
+        slicer_time = read_slicer_estimate(filename)
+        if gap is None:
+            gap = 10.0
+            if slicer_time is not None:
+                gap = slicer_time / len(sequence)
+        result = tr_benchmark.simulate(
+            sim, sequence[:max_swaps], gap, time_first=True
+        )
+    finally:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+
+    result["simulated_swaps"] = result["swaps"]
+    if len(sequence) > result["swaps"]:
+        extrapolate(result, sequence)
+    result["file"] = filename
+    result["tools"] = sorted({tool for tool, lane in sequence if lane is None})
+    result["slicer_time"] = slicer_time
+    result["swap_share"] = None
+    if slicer_time:
+        result["swap_share"] = result["total_time"] / (
+            slicer_time + result["total_time"]
+        )
+    return result
+
+
+def format_result(result):
+    lines = [
+        "%s: %d toolchanges (%d skipped) between %d tools"
+        % (
+            result["file"],
+            result["swaps"],
+            result["skipped_swaps"],
+            len(result["tools"]),
+        ),
+        "  toolchange time:      %10s" % format_duration(result["total_time"]),
+        "  mean swap time:       %8.1f s" % result["mean_swap_time"],
+    ]
+    if result["simulated_swaps"] < result["swaps"]:
+        lines.append(
+            "  (estimated from the first %d toolchanges)"
+            % result["simulated_swaps"]
+        )
+    if result["slicer_time"] is not None:
+        lines += [
+            "  slicer print time:    %10s"
+            % format_duration(result["slicer_time"]),
+            "  total print time:     %10s"
+            % format_duration(result["slicer_time"] + result["total_time"]),
+            "  toolchange share:     %8.1f %%" % (100.0 * result["swap_share"]),
+        ]
+    for violation in result["violations"]:
+        lines.append("  VIOLATION: %s" % violation)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Estimate the time a print will spend on Trad Rack toolchanges"
+        )
+    )
+    parser.add_argument("gcode", nargs="+", help="sliced gcode files")
+    parser.add_argument(
+        "--config", help="klipper config file with a [trad_rack] section"
+    )
+    parser.add_argument(
+        "--variables",
+        help="save_variables file with the calibrated bowden lengths",
+    )
+    parser.add_argument(
+        "--set",
+        action="append",
+        default=[],
+        metavar="OPTION=VALUE",
+        help="override a [trad_rack] config option",
+    )
+    parser.add_argument("--lane-count", type=int, default=16)
+    parser.add_argument("--bowden-length", type=float, default=1000.0)
+    parser.add_argument(
+        "--gap",
+        type=float,
+        help=(
+            "seconds of printing between toolchanges (the default is the"
+            " slicer's print time divided evenly between toolchanges)"
+        ),
+    )
+    parser.add_argument(
+        "--max-swaps",
+        type=int,
+        default=100,
+        help=(
+            "simulate at most this many toolchanges per file and estimate the"
+            " rest from the simulated ones, or 0 to simulate every toolchange"
+            " (default 100)"
+        ),
+    )
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    if args.max_swaps < 0:
+        parser.error("--max-swaps must not be negative")
+
+    try:
+        options = {}
+        if args.config:
+            options.update(tr_benchmark.load_config_file(args.config))
+        options.update(tr_benchmark.parse_overrides(args.set))
+        sections = tr_benchmark.build_sections(
+            int(options.get("lane_count", args.lane_count)),
+            float(options.get("bowden_length", args.bowden_length)),
+            not args.config or "toolhead_fil_sensor_pin" in options,
+            options,
+        )
+        results = []
+        for filename in args.gcode:
+            results.append(
+                estimate_file(
+                    filename,
+                    sections,
+                    args.variables,
+                    args.gap,
+                    args.max_swaps or None,
+                    args.verbose,
+                )
+            )
+            print(format_result(results[-1]))
+    except (ValueError, IOError, tr_sim.ConfigError) as e:
+        sys.stderr.write("Error: %s\n" % e)
+        return 2
+
+    # list the jobs with the largest share of toolchange time first
+    if len(results) > 1:
+        print("Jobs by toolchange share:")
+        for result in sorted(results, key=lambda r: -(r["swap_share"] or 0.0)):
+            share = "     n/a"
+            if result["swap_share"] is not None:
+                share = "%6.1f %%" % (100.0 * result["swap_share"])
+            print(
+                "  %s  %10s  %s"
+                % (share, format_duration(result["total_time"]), result["file"])
+            )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    for result in results:
+        if result["violations"]:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1545 @@
+# Offline simulation environment for the trad_rack klippy module
+#
+# Copyright (C) 2022-2026 Ryan Ghosh <rghosh776@gmail.com>
+#
+# This file may be distributed under the terms of the GNU GPLv3 license.
+import ast, configparser, math, os, random, re, sys, types
+
+NEVER = 9999999999999999.0
+BUFFER_TIME_START = 0.250
+WAIT_MOVES_POLL_TIME = 0.100
+HOMING_STEP = 0.05
+DEFAULT_MODULE_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "klippy_module"
+)
+
+
+class CommandError(Exception):
+    pass
+
+
+class ConfigError(Exception):
+    pass
+
+
+# Reactor
+class SimTimer:
+    def __init__(self, callback, waketime):
+        self.callback = callback
+        self.waketime = waketime
+
+
+class SimCompletion:
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self.result = None
+        self.done = False
+
+    def test(self):
+        return self.done
+
+    def complete(self, result):
+        self.result = result
+        self.done = True
+
+    def wait(self, waketime=NEVER, waketime_result=None):
+        while not self.done:
+            next_time = self.reactor.next_timer_time()
+            if next_time >= waketime or next_time >= NEVER:
+                return waketime_result
+            self.reactor.pause(next_time)
+        return self.result
+
+
+class SimReactor:
+    NOW = 0.0
+    NEVER = NEVER
+
+    def __init__(self):
+        self.now = 0.0
+        self.timers = []
+        self.in_timer = False
+
+    def monotonic(self):
+        return self.now
+
+    def register_timer(self, callback, waketime=NEVER):
+        timer = SimTimer(callback, waketime)
+        self.timers.append(timer)
+        return timer
+
+    def update_timer(self, timer, waketime):
+        timer.waketime = waketime
+
+    def unregister_timer(self, timer):
+        if timer in self.timers:
+            self.timers.remove(timer)
+
+    def register_callback(self, callback, waketime=NOW):
+        def run_once(eventtime, timer_holder=[]):
+            self.unregister_timer(timer_holder[0])
+            callback(eventtime)
+            return NEVER
+
+        holder = []
+        timer = self.register_timer(
+            lambda e: run_once(e, holder), max(waketime, 0.0)
+        )
+        holder.append(timer)
+        return timer
+
+    def register_async_callback(self, callback, waketime=NOW):
+        return self.register_callback(callback, waketime)
+
+    def completion(self):
+        return SimCompletion(self)
+
+    def next_timer_time(self):
+        if not self.timers:
+            return NEVER
+        return min(t.waketime for t in self.timers)
+
+    def _run_due_timers(self, until):
+        while True:
+            due = [t for t in self.timers if t.waketime <= until]
+            if not due:
+                return
+            timer = min(due, key=lambda t: t.waketime)
+            self.now = max(self.now, timer.waketime)
+            timer.waketime = NEVER
+            waketime = timer.callback(self.now)
+            if timer in self.timers and waketime is not None:
+                timer.waketime = waketime
+
+    def pause(self, waketime):
+        if waketime >= NEVER:
+            raise Exception("Simulation would wait forever")
+        waketime = max(waketime, self.now)
+        self._run_due_timers(waketime)
+        self.now = waketime
+        return self.now
+
+    def run_until_idle(self, limit=600.0):
+        end = self.now + limit
+        while True:
+            next_time = self.next_timer_time()
+            if next_time > end:
+                return
+            self.pause(next_time)
+
+
+# Configuration
+class SimConfig:
+    error = ConfigError
+
+    def __init__(self, printer, sections, name="printer"):
+        self.printer = printer
+        self.sections = sections
+        self.name = name
+        self.values = sections.get(name, {})
+
+    def get_printer(self):
+        return self.printer
+
+    def get_name(self):
+        return self.name
+
+    def getsection(self, name):
+        return SimConfig(self.printer, self.sections, name)
+
+    def has_section(self, name):
+        return name in self.sections
+
+    def _get(
+        self,
+        option,
+        default,
+        parser,
+        minval=None,
+        maxval=None,
+        above=None,
+        below=None,
+    ):
+        if option in self.values:
+            value = parser(self.values[option])
+        elif default is not SimConfig._sentinel:
+            return default
+        else:
+            raise ConfigError(
+                "Option '%s' in section '%s' must be specified"
+                % (option, self.name)
+            )
+        if minval is not None and value < minval:
+            raise ConfigError("Option '%s' below minimum" % option)
+        if maxval is not None and value > maxval:
+            raise ConfigError("Option '%s' above maximum" % option)
+        if above is not None and value <= above:
+            raise ConfigError("Option '%s' must be above %s" % (option, above))
+        if below is not None and value >= below:
+            raise ConfigError("Option '%s' must be below %s" % (option, below))
+        return value
+
+    _sentinel = object()
+
+    def get(self, option, default=_sentinel, note_valid=True):
+        return self._get(option, default, str)
+
+    def getint(
+        self,
+        option,
+        default=_sentinel,
+        minval=None,
+        maxval=None,
+        note_valid=True,
+    ):
+        return self._get(option, default, int, minval, maxval)
+
+    def getfloat(
+        self,
+        option,
+        default=_sentinel,
+        minval=None,
+        maxval=None,
+        above=None,
+        below=None,
+        note_valid=True,
+    ):
+        return self._get(option, default, float, minval, maxval, above, below)
+
+    def getboolean(self, option, default=_sentinel, note_valid=True):
+        def parse(value):
+            if isinstance(value, str):
+                return value.strip().lower() in ("1", "true", "yes", "on")
+            return bool(value)
+
+        return self._get(option, default, parse)
+
+    def getchoice(self, option, choices, default=_sentinel, note_valid=True):
+        value = self._get(option, default, str)
+        if isinstance(choices, dict):
+            if value not in choices:
+                raise ConfigError("Choice '%s' is not valid" % value)
+            return choices[value]
+        if value not in choices:
+            raise ConfigError("Choice '%s' is not valid" % value)
+        return value
+
+    def getlist(
+        self,
+        option,
+        default=_sentinel,
+        sep=",",
+        count=None,
+        parser=str,
+        note_valid=True,
+    ):
+        if option not in self.values:
+            if default is SimConfig._sentinel:
+                raise ConfigError("Option '%s' must be specified" % option)
+            return default
+        return [
+            parser(v.strip())
+            for v in str(self.values[option]).split(sep)
+            if v.strip()
+        ]
+
+    def getfloatlist(
+        self, option, default=_sentinel, sep=",", count=None, note_valid=True
+    ):
+        return self.getlist(option, default, sep, count, float)
+
+
+# Motion
+class SimMove:
+    def __init__(self, toolhead, start_pos, end_pos, speed):
+        self.toolhead = toolhead
+        self.start_pos = tuple(start_pos)
+        self.end_pos = tuple(end_pos)
+        self.axes_d = [e - s for s, e in zip(start_pos, end_pos)]
+        self.move_d = math.sqrt(sum(d * d for d in self.axes_d[:3]))
+        velocity = min(speed, toolhead.max_velocity)
+        self.max_cruise_v2 = velocity**2
+        self.accel = toolhead.max_accel
+        self.min_move_t = self.move_d / velocity if velocity else 0.0
+        self.accel_t = self.cruise_t = self.decel_t = 0.0
+
+    def limit_speed(self, speed, accel):
+        speed2 = speed**2
+        if speed2 < self.max_cruise_v2:
+            self.max_cruise_v2 = speed2
+            self.min_move_t = self.move_d / speed
+        self.accel = min(self.accel, accel)
+
+    def move_error(self, msg="Move out of range"):
+        pos = self.end_pos
+        return CommandError(
+            "%s: %.3f %.3f [%.3f]" % (msg, pos[0], pos[1], pos[3])
+        )
+
+    def calc_time(self, distance=None):
+        if distance is None:
+            distance = self.move_d
+        return trapezoid_time(
+            distance, math.sqrt(self.max_cruise_v2), self.accel
+        )
+
+
+def trapezoid_time(distance, velocity, accel):
+    if distance <= 0.0 or velocity <= 0.0:
+        return 0.0
+    accel_d = velocity * velocity / accel
+    if distance < accel_d:
+        return 2.0 * math.sqrt(distance / accel)
+    return 2.0 * velocity / accel + (distance - accel_d) / velocity
+
+
+class SimLookAheadQueue:
+    def __init__(self):
+        self.queue = []
+        self.flush_time = 0.0
+
+    def set_flush_time(self, flush_time):
+        self.flush_time = flush_time
+
+    def add_move(self, move):
+        self.queue.append(move)
+
+    def get_last(self):
+        if self.queue:
+            return self.queue[-1]
+        return None
+
+    def flush(self, lazy=False):
+        del self.queue[:]
+
+
+class SimToolHeadBase(object):
+    """Stand-in for klippy's toolhead.ToolHead, used as the base class of
+    TradRackToolHead. Moves are timed with trapezoidal profiles and are
+    applied to the simulated world as soon as they are queued."""
+
+    def _calc_junction_deviation(self):
+        pass
+
+    def _handle_step_flush(self, *args):
+        pass
+
+    def _handle_shutdown(self):
+        pass
+
+    def _calc_print_time(self):
+        est = self.mcu.estimated_print_time(self.reactor.monotonic())
+        self.print_time = max(self.print_time, est + BUFFER_TIME_START)
+
+    def _flush_lookahead(self):
+        self.lookahead.flush()
+        self.special_queuing_state = "NeedPrime"
+
+    def get_last_move_time(self):
+        if self.special_queuing_state:
+            self._flush_lookahead()
+            self._calc_print_time()
+        else:
+            self._flush_lookahead()
+        return self.print_time
+
+    def _ensure_primed(self):
+        if self.special_queuing_state:
+            self._calc_print_time()
+            self.special_queuing_state = ""
+
+    def get_position(self):
+        return list(self.commanded_pos)
+
+    def set_position(self, newpos, homing_axes=()):
+        self._flush_lookahead()
+        self.commanded_pos[:] = newpos
+        self.kin.set_position(newpos, homing_axes)
+        self.printer.send_event("toolhead:set_position")
+
+    def move(self, newpos, speed):
+        self._ensure_primed()
+        move = SimMove(self, self.commanded_pos, newpos, speed)
+        if not move.move_d:
+            return
+        self.kin.check_move(move)
+        move_t = move.calc_time()
+        start = self.print_time
+        self.printer.sim.world.apply_move(self, move, start, start + move_t)
+        self.print_time += move_t
+        move.min_move_t = move_t
+        self.commanded_pos[:] = newpos
+        self.lookahead.add_move(move)
+        self.printer.sim.note_move(self, start, self.print_time)
+
+    def dwell(self, delay):
+        self._ensure_primed()
+        self.print_time += max(0.0, delay)
+
+    def wait_moves(self):
+        self._flush_lookahead()
+        eventtime = self.reactor.monotonic()
+        while (
+            not self.special_queuing_state
+            or self.print_time >= self.mcu.estimated_print_time(eventtime)
+        ):
+            if not self.can_pause:
+                break
+            eventtime = self.reactor.pause(eventtime + WAIT_MOVES_POLL_TIME)
+
+    def flush_step_generation(self):
+        self._flush_lookahead()
+
+    def get_trapq(self):
+        return self.trapq
+
+    def get_kinematics(self):
+        return self.kin
+
+    def check_busy(self, eventtime):
+        est_print_time = self.mcu.estimated_print_time(eventtime)
+        return self.print_time, est_print_time, not self.lookahead.queue
+
+    def note_mcu_movequeue_activity(self, mq_time, is_step_gen=True):
+        pass
+
+
+class SimMainToolHead(SimToolHeadBase):
+    def __init__(self, printer, extruder):
+        self.printer = printer
+        self.reactor = printer.get_reactor()
+        self.mcu = printer.lookup_object("mcu")
+        self.lookahead = SimLookAheadQueue()
+        self.commanded_pos = [0.0, 0.0, 0.0, 0.0]
+        self.print_time = 0.0
+        self.special_queuing_state = "NeedPrime"
+        self.can_pause = True
+        self.max_velocity = 300.0
+        self.max_accel = 3000.0
+        self.extruder = extruder
+        self.trapq = object()
+        self.kin = SimMainKinematics()
+
+    def get_extruder(self):
+        return self.extruder
+
+    def move(self, newpos, speed):
+        self._ensure_primed()
+        move = SimMove(self, self.commanded_pos, newpos, speed)
+        move_t = move.calc_time() if move.move_d else 0.0
+        if move.axes_d[3] and not move.move_d:
+            move_t = abs(move.axes_d[3]) / min(
+                speed, self.extruder.max_e_velocity
+            )
+        start = self.print_time
+        self.print_time += move_t
+        self.commanded_pos[:] = newpos
+        self.extruder.last_position = newpos[3]
+        self.printer.sim.note_move(self, start, self.print_time)
+
+
+class SimMainKinematics:
+    def set_position(self, newpos, homing_axes):
+        pass
+
+    def check_move(self, move):
+        pass
+
+
+# Steppers, rails and endstops
+class SimStepper:
+    def __init__(self, name, rotation_distance=22.0):
+        self.name = name
+        self.trapq = None
+        self.sk = object()
+        self.rotation_distance = rotation_distance
+        self.position = (0.0, 0.0, 0.0)
+
+    def get_name(self, short=False):
+        return self.name
+
+    def get_trapq(self):
+        return self.trapq
+
+    def set_trapq(self, trapq):
+        self.trapq = trapq
+
+    def set_stepper_kinematics(self, sk):
+        prev = self.sk
+        self.sk = sk
+        return prev
+
+    def get_rotation_distance(self):
+        return self.rotation_distance, 200
+
+    def set_rotation_distance(self, rotation_distance):
+        self.rotation_distance = rotation_distance
+
+    def set_position(self, coord):
+        self.position = tuple(coord)
+
+    def get_commanded_position(self):
+        return 0.0
+
+    def setup_itersolve(self, alloc_func, *params):
+        pass
+
+
+class SimEndstop:
+    def __init__(self, printer, query):
+        self.printer = printer
+        self.query = query
+        self.steppers = []
+
+    def add_stepper(self, stepper):
+        self.steppers.append(stepper)
+
+    def get_steppers(self):
+        return list(self.steppers)
+
+    def query_endstop(self, print_time):
+        self.printer.sim.stats["mcu_queries"] += 1
+        return 1 if self.query() else 0
+
+
+class SimHomingInfo:
+    def __init__(
+        self,
+        speed,
+        position_endstop,
+        retract_speed,
+        retract_dist,
+        positive_dir,
+        second_homing_speed,
+    ):
+        self.speed = speed
+        self.position_endstop = position_endstop
+        self.retract_speed = retract_speed
+        self.retract_dist = retract_dist
+        self.positive_dir = positive_dir
+        self.second_homing_speed = second_homing_speed
+
+
+class SimRail:
+    def __init__(self, config, axis):
+        printer = config.get_printer()
+        self.name = config.get_name()
+        self.axis = axis
+        self.position_min = config.getfloat("position_min", 0.0)
+        self.position_max = config.getfloat("position_max")
+        self.position_endstop = config.getfloat("position_endstop", 0.0)
+        speed = config.getfloat("homing_speed", 50.0)
+        self.homing_info = SimHomingInfo(
+            speed,
+            self.position_endstop,
+            speed,
+            config.getfloat("homing_retract_dist", 5.0),
+            config.getboolean("homing_positive_dir", False),
+            speed / 2.0,
+        )
+        self.steppers = [SimStepper(self.name)]
+        world = printer.sim.world
+        if axis == 0:
+            query = world.query_selector_endstop
+        else:
+            query = world.query_selector_sensor
+        self.endstops = [(SimEndstop(printer, query), self.name)]
+
+    def get_name(self, short=False):
+        return self.name
+
+    def get_steppers(self):
+        return list(self.steppers)
+
+    def get_endstops(self):
+        return list(self.endstops)
+
+    def get_range(self):
+        return self.position_min, self.position_max
+
+    def get_homing_info(self):
+        self.homing_info.position_endstop = self.position_endstop
+        return self.homing_info
+
+    def setup_itersolve(self, alloc_func, *params):
+        pass
+
+    def set_trapq(self, trapq):
+        pass
+
+    def set_position(self, coord):
+        pass
+
+
+def LookupMultiRail(config):
+    name = config.get_name()
+    axis = 0 if name.endswith("selector") else 1
+    return SimRail(config, axis)
+
+
+# Homing
+class SimStepperPosition:
+    def __init__(self, stepper_name, trig_pos):
+        self.stepper_name = stepper_name
+        self.trig_pos = trig_pos
+
+
+class SimHomingMove:
+    def __init__(self, printer, endstops, toolhead=None):
+        self.printer = printer
+        self.endstops = endstops
+        if toolhead is None:
+            toolhead = printer.lookup_object("toolhead")
+        self.toolhead = toolhead
+        self.stepper_positions = []
+        self.moved = True
+
+    def homing_move(
+        self,
+        movepos,
+        speed,
+        probe_pos=False,
+        triggered=True,
+        check_triggered=True,
+    ):
+        sim = self.printer.sim
+        sim.stats["homing_moves"] += 1
+        toolhead = self.toolhead
+        toolhead.get_last_move_time()
+        toolhead._ensure_primed()
+        startpos = toolhead.get_position()
+        movepos = list(movepos) + startpos[len(movepos) :]
+        axes_d = [e - s for s, e in zip(startpos, movepos)]
+        dist = math.sqrt(sum(d * d for d in axes_d[:3]))
+        queries = [es.query for es, name in self.endstops]
+
+        def is_triggered():
+            state = any(q() for q in queries)
+            return state if triggered else not state
+
+        if not dist:
+            raise CommandError("Homing move of zero length")
+        move = SimMove(toolhead, startpos, movepos, speed)
+        toolhead.kin.check_move(move)
+        steps = int(math.ceil(dist / HOMING_STEP))
+        start_time = toolhead.print_time
+        world = sim.world
+        traveled = 0.0
+        trig = None
+        prev = list(startpos)
+        self.moved = False
+        if not is_triggered():
+            for i in range(1, steps + 1):
+                frac = min(1.0, i * HOMING_STEP / dist)
+                pos = [s + d * frac for s, d in zip(startpos, axes_d)]
+                world.apply_displacement(
+                    toolhead,
+                    prev,
+                    pos,
+                    start_time + move.calc_time(frac * dist),
+                )
+                self.moved = True
+                prev = pos
+                traveled = frac * dist
+                if is_triggered():
+                    trig = pos
+                    break
+        else:
+            trig = list(startpos)
+        move_t = move.calc_time(traveled)
+        if trig is not None:
+            # decelerate to a stop
+            move_t += math.sqrt(move.max_cruise_v2) / move.accel
+        toolhead.print_time = start_time + move_t
+        sim.note_move(toolhead, start_time, toolhead.print_time)
+        final = trig if trig is not None else movepos
+        toolhead.commanded_pos[:] = final
+        toolhead.kin.set_position(final, ())
+        toolhead.reactor.pause(toolhead.print_time)
+        toolhead._flush_lookahead()
+        self.stepper_positions = [
+            SimStepperPosition(s.get_name(), 0.0)
+            for es, name in self.endstops
+            for s in getattr(es, "steppers", [])
+        ]
+        if trig is None:
+            if check_triggered:
+                raise CommandError(
+                    "No trigger on %s after full movement"
+                    % (self.endstops[0][1],)
+                )
+            return list(movepos)
+        return list(trig)
+
+    def check_no_movement(self):
+        if self.moved:
+            return None
+        return self.endstops[0][1]
+
+
+class SimHoming:
+    def __init__(self, printer):
+        self.printer = printer
+        self.toolhead = printer.lookup_object("toolhead")
+        self.changed_axes = []
+        self.trigger_mcu_pos = {}
+        self.adjust_pos = {}
+
+    def set_axes(self, axes):
+        self.changed_axes = axes
+
+    def get_axes(self):
+        return self.changed_axes
+
+    def _fill_coord(self, coord):
+        thcoord = list(self.toolhead.get_position())
+        for i in range(len(coord)):
+            if coord[i] is not None:
+                thcoord[i] = coord[i]
+        return thcoord
+
+
+# Simulated hardware
+class SimLane:
+    def __init__(self, index, spool_length):
+        self.index = index
+        # tip position relative to the selector sensor (positive = past it)
+        self.tip = None
+        self.remaining = spool_length
+
+
+class SimWorld:
+    """Physical model of the selector, servo, filament lanes and sensors."""
+
+    def __init__(self, sim, params):
+        self.sim = sim
+        self.params = params
+        self.selector_pos = 0.0
+        self.servo_events = [(-NEVER, params["servo_up_angle"])]
+        self.lanes = []
+        for i in range(params["lane_count"]):
+            lane = SimLane(i, params.get("spool_length", 1.0e9))
+            lane.tip = -params["selector_unload_length"]
+            self.lanes.append(lane)
+        self.violations = []
+        self.last_sensor_states = {}
+        self.random = random.Random(params.get("seed", 0))
+
+    # servo
+    def servo_event(self, print_time, angle):
+        self.servo_events.append((print_time, angle))
+        self.servo_events.sort(key=lambda e: e[0])
+
+    def _servo_transitions(self):
+        # only commands that change the angle move the servo
+        transitions = []
+        angle = None
+        for t, a in self.servo_events:
+            if a != angle:
+                transitions.append((t, a))
+                angle = a
+        return transitions
+
+    def servo_state(self, print_time):
+        angle = None
+        event_time = -NEVER
+        for t, a in self._servo_transitions():
+            if t <= print_time + 1e-9:
+                angle, event_time = a, t
+        down = angle == self.params["servo_down_angle"]
+        settled = print_time + 1e-9 >= event_time + self.params["servo_time"]
+        return down, settled
+
+    def servo_moving_between(self, start, end):
+        for t, a in self._servo_transitions():
+            if t + self.params["servo_time"] > start + 1e-6 and t < end - 1e-6:
+                return True
+        return False
+
+    # lanes
+    def aligned_lane(self):
+        for lane in self.lanes:
+            pos = self.params["lane_positions"][lane.index]
+            if abs(self.selector_pos - pos) < 0.01:
+                return lane
+        return None
+
+    def query_selector_sensor(self):
+        lane = self.aligned_lane()
+        if lane is None:
+            return any(l.tip > 0.0 for l in self.lanes)
+        return lane.tip > 0.0
+
+    def query_toolhead_sensor(self):
+        sensor_pos = self.params["toolhead_sensor_pos"]
+        offsets = self.params.get("lane_path_offsets") or {}
+        return any(
+            lane.tip >= sensor_pos + offsets.get(lane.index, 0.0)
+            for lane in self.lanes
+        )
+
+    def query_selector_endstop(self):
+        return self.selector_pos <= self.params["selector_endstop"] + 1e-6
+
+    # motion
+    def apply_move(self, toolhead, move, start, end):
+        self._check_move(toolhead, move.start_pos, move.end_pos, start, end)
+        self._apply(toolhead, move.start_pos, move.end_pos, end)
+
+    def apply_displacement(self, toolhead, start_pos, end_pos, print_time):
+        self._apply(toolhead, start_pos, end_pos, print_time)
+
+    def _check_move(self, toolhead, start_pos, end_pos, start, end):
+        if toolhead is not self.sim.tr_toolhead:
+            return
+        if end_pos[0] != start_pos[0]:
+            down, settled = self.servo_state(start)
+            if down or self.servo_moving_between(start, end):
+                self.violations.append(
+                    "%.3f: selector moved while servo was not raised" % start
+                )
+            lane = self.aligned_lane()
+            if lane is not None and lane.tip > 0.0:
+                self.violations.append(
+                    "%.3f: selector moved with filament in selector" % start
+                )
+        if end_pos[1] != start_pos[1]:
+            down, settled = self.servo_state(start)
+            if down and not settled:
+                self.violations.append(
+                    "%.3f: filament moved before servo settled" % start
+                )
+
+    def _apply(self, toolhead, start_pos, end_pos, print_time):
+        if toolhead is not self.sim.tr_toolhead:
+            return
+        self.selector_pos = end_pos[0]
+        delta = end_pos[1] - start_pos[1]
+        if delta:
+            down, settled = self.servo_state(print_time)
+            lane = self.aligned_lane()
+            if down and lane is not None:
+                slip = self.params.get("slip", 0.0)
+                noise = self.params.get("slip_noise", 0.0)
+                if noise:
+                    slip += self.random.gauss(0.0, noise)
+                lane.tip += delta * (1.0 - slip)
+        self.sim.check_sensor_events(print_time)
+
+
+class SimServo:
+    def __init__(self, printer, config):
+        self.printer = printer
+        self.max_angle = config.getfloat("maximum_servo_angle", 180.0)
+        self.gcrq = self
+
+    def _get_pwm_from_angle(self, angle):
+        return angle
+
+    def _get_pwm_from_pulse_width(self, width):
+        return width
+
+    def send_async_request(self, value, print_time=None):
+        if print_time is None:
+            print_time = self.printer.sim.reactor.monotonic()
+        self.printer.sim.world.servo_event(print_time, value)
+
+
+class SimMCU:
+    def __init__(self, reactor):
+        self.reactor = reactor
+
+    def estimated_print_time(self, eventtime):
+        return eventtime
+
+    def is_fileoutput(self):
+        return False
+
+
+class SimHeater:
+    def __init__(self, reactor, temp=240.0):
+        self.reactor = reactor
+        self.min_extrude_temp = 170.0
+        self.smoothed_temp = temp
+        self.target_temp = temp
+        self.heat_rate = 3.0
+        self.last_time = 0.0
+
+    def _update(self, eventtime):
+        dt = max(0.0, eventtime - self.last_time)
+        self.last_time = eventtime
+        diff = self.target_temp - self.smoothed_temp
+        step = self.heat_rate * dt
+        if abs(diff) <= step:
+            self.smoothed_temp = self.target_temp
+        else:
+            self.smoothed_temp += math.copysign(step, diff)
+
+    def get_temp(self, eventtime):
+        self._update(eventtime)
+        return self.smoothed_temp, self.target_temp
+
+    def set_temp(self, degrees):
+        self._update(self.reactor.monotonic())
+        self.target_temp = degrees
+
+    def check_busy(self, eventtime):
+        self._update(eventtime)
+        return abs(self.target_temp - self.smoothed_temp) > 1.0
+
+
+class SimHeaters:
+    def __init__(self, printer):
+        self.printer = printer
+
+    def set_temperature(self, heater, temp, wait=False):
+        heater.set_temp(temp)
+        if wait and temp:
+            reactor = self.printer.get_reactor()
+            eventtime = reactor.monotonic()
+            while heater.check_busy(eventtime):
+                eventtime = reactor.pause(eventtime + 1.0)
+
+
+class SimExtruder:
+    def __init__(self, reactor):
+        self.heater = SimHeater(reactor)
+        self.extruder_stepper = types.SimpleNamespace(
+            stepper=SimStepper("extruder")
+        )
+        self.trapq = object()
+        self.last_position = 0.0
+        self.max_e_velocity = 120.0
+        self.max_e_accel = 5000.0
+
+    def get_heater(self):
+        return self.heater
+
+    def get_trapq(self):
+        return self.trapq
+
+    def get_name(self):
+        return "extruder"
+
+
+# Gcode
+class SimGCodeCommand:
+    error = CommandError
+
+    def __init__(self, gcode, command, commandline, params):
+        self.gcode = gcode
+        self.command = command
+        self.commandline = commandline
+        self.params = params
+
+    def get_command(self):
+        return self.command
+
+    def get_commandline(self):
+        return self.commandline
+
+    def get_command_parameters(self):
+        return self.params
+
+    def respond_info(self, msg, log=True):
+        self.gcode.respond_info(msg, log)
+
+    def respond_raw(self, msg):
+        self.gcode.respond_raw(msg)
+
+    _sentinel = object()
+
+    def get(
+        self,
+        name,
+        default=_sentinel,
+        parser=str,
+        minval=None,
+        maxval=None,
+        above=None,
+        below=None,
+    ):
+        value = self.params.get(name)
+        if value is None:
+            if default is self._sentinel:
+                raise CommandError(
+                    "Error on '%s': missing %s" % (self.commandline, name)
+                )
+            return default
+        try:
+            value = parser(value)
+        except Exception:
+            raise CommandError(
+                "Error on '%s': unable to parse %s" % (self.commandline, value)
+            )
+        if minval is not None and value < minval:
+            raise CommandError(
+                "Error on '%s': %s must have minimum of %s"
+                % (self.commandline, name, minval)
+            )
+        if maxval is not None and value > maxval:
+            raise CommandError(
+                "Error on '%s': %s must have maximum of %s"
+                % (self.commandline, name, maxval)
+            )
+        if above is not None and value <= above:
+            raise CommandError(
+                "Error on '%s': %s must be above %s"
+                % (self.commandline, name, above)
+            )
+        if below is not None and value >= below:
+            raise CommandError(
+                "Error on '%s': %s must be below %s"
+                % (self.commandline, name, below)
+            )
+        return value
+
+    def get_int(self, name, default=_sentinel, minval=None, maxval=None):
+        return self.get(name, default, parser=int, minval=minval, maxval=maxval)
+
+    def get_float(
+        self,
+        name,
+        default=_sentinel,
+        minval=None,
+        maxval=None,
+        above=None,
+        below=None,
+    ):
+        return self.get(
+            name,
+            default,
+            parser=float,
+            minval=minval,
+            maxval=maxval,
+            above=above,
+            below=below,
+        )
+
+
+class SimMutex:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+class SimGCode:
+    error = CommandError
+
+    def __init__(self, printer):
+        self.printer = printer
+        self.commands = {}
+        self.messages = []
+        self.Coord = list
+        self.mutex = None
+
+    def get_mutex(self):
+        return SimMutex()
+
+    def register_command(self, cmd, func, when_not_ready=False, desc=None):
+        if func is None:
+            return self.commands.pop(cmd, None)
+        self.commands[cmd] = func
+
+    def respond_info(self, msg, log=True):
+        self.messages.append(msg)
+        if self.printer.sim.verbose:
+            print("// " + msg.replace("\n", "\n// "))
+
+    def respond_raw(self, msg):
+        self.respond_info(msg)
+
+    def create_gcode_command(self, command, commandline, params):
+        return SimGCodeCommand(self, command, commandline, params)
+
+    def _get_extended_params(self, gcmd):
+        return gcmd
+
+    _param_re = re.compile(r'(\S+?)=("[^"]*"|\S*)')
+
+    def _parse(self, line):
+        line = line.split(";", 1)[0].strip()
+        if "#" in line:
+            line = line.split("#", 1)[0].strip()
+        if not line:
+            return None, None
+        parts = line.split(None, 1)
+        cmd = parts[0].upper()
+        params = {}
+        rest = parts[1] if len(parts) > 1 else ""
+        if cmd in (
+            "G1",
+            "G0",
+            "G4",
+            "M104",
+            "M109",
+            "M83",
+            "M82",
+            "G90",
+            "G91",
+            "G92",
+        ):
+            for word in rest.split():
+                params[word[0].upper()] = word[1:]
+        else:
+            for key, value in self._param_re.findall(rest):
+                if value.startswith('"') and value.endswith('"'):
+                    value = value[1:-1]
+                params[key.upper()] = value
+        return cmd, params
+
+    def run_script_from_command(self, script):
+        for line in script.split("\n"):
+            cmd, params = self._parse(line)
+            if cmd is None:
+                continue
+            self.run_command(cmd, line.strip(), params)
+
+    def run_script(self, script):
+        self.run_script_from_command(script)
+
+    def run_command(self, cmd, line, params):
+        gcmd = self.create_gcode_command(cmd, line, params)
+        handler = self.commands.get(cmd)
+        if handler is None:
+            handler = self.printer.sim.builtin_commands.get(cmd)
+        if handler is None:
+            raise CommandError('Unknown command:"%s"' % cmd)
+        handler(gcmd)
+
+
+class SimTemplate:
+    def __init__(self, gcode, script):
+        self.gcode = gcode
+        self.script = script
+
+    def render(self, context=None):
+        return self.script
+
+    def run_gcode_from_command(self, context=None):
+        if self.script:
+            self.gcode.run_script_from_command(self.script)
+
+
+class SimGCodeMacro:
+    def __init__(self, printer):
+        self.printer = printer
+
+    def load_template(self, config, option, default=None):
+        script = config.values.get(option, default)
+        return SimTemplate(self.printer.lookup_object("gcode"), script or "")
+
+
+class SimSaveVariables:
+    def __init__(self, printer, filename):
+        self.printer = printer
+        self.filename = filename
+        self.allVariables = {}
+        self.write_count = 0
+        if filename and os.path.exists(filename):
+            self.loadVariables()
+
+    def loadVariables(self):
+        allvars = {}
+        varfile = configparser.ConfigParser()
+        varfile.read(self.filename)
+        if varfile.has_section("Variables"):
+            for name, val in varfile.items("Variables"):
+                allvars[name] = ast.literal_eval(val)
+        self.allVariables = allvars
+
+    def cmd_SAVE_VARIABLE(self, gcmd):
+        varname = gcmd.get("VARIABLE")
+        value = ast.literal_eval(gcmd.get("VALUE"))
+        newvars = dict(self.allVariables)
+        newvars[varname] = value
+        self.write_count += 1
+        if not self.filename:
+            self.allVariables = newvars
+            return
+        varfile = configparser.ConfigParser()
+        varfile.add_section("Variables")
+        for name, val in sorted(newvars.items()):
+            varfile.set("Variables", name, repr(val))
+        with open(self.filename, "w") as f:
+            varfile.write(f)
+        self.loadVariables()
+
+    def get_status(self, eventtime):
+        return {"variables": self.allVariables}
+
+
+class SimObject(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class SimPrinter:
+    command_error = CommandError
+    config_error = ConfigError
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.objects = {}
+        self.event_handlers = {}
+        self.shutdown = False
+
+    def get_reactor(self):
+        return self.sim.reactor
+
+    def lookup_object(self, name, default=ConfigError):
+        if name in self.objects:
+            return self.objects[name]
+        if default is ConfigError:
+            raise ConfigError("Unknown config object '%s'" % (name,))
+        return default
+
+    def load_object(self, config, section, default=ConfigError):
+        if section in self.objects:
+            return self.objects[section]
+        obj = self.sim.create_object(config, section)
+        if obj is None:
+            if default is ConfigError:
+                raise ConfigError("Unable to load module '%s'" % (section,))
+            return default
+        self.objects[section] = obj
+        return obj
+
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+
+    def send_event(self, event, *params):
+        self.sim.events.append((self.sim.reactor.monotonic(), event))
+        return [cb(*params) for cb in self.event_handlers.get(event, [])]
+
+    def is_shutdown(self):
+        return self.shutdown
+
+    def invoke_shutdown(self, msg):
+        self.shutdown = True
+        self.send_event("klippy:shutdown")
+
+
+def install_klippy_modules():
+    """Register stand-ins for the klippy modules imported by trad_rack."""
+    if getattr(sys.modules.get("toolhead"), "_tr_sim", False):
+        return
+    extras = types.ModuleType("extras")
+    extras.__path__ = []
+    homing = types.ModuleType("extras.homing")
+    homing.Homing = SimHoming
+    homing.HomingMove = SimHomingMove
+    extras.homing = homing
+    gcode = types.ModuleType("gcode")
+    gcode.CommandError = CommandError
+    stepper = types.ModuleType("stepper")
+    stepper.LookupMultiRail = LookupMultiRail
+    chelper = types.ModuleType("chelper")
+    ffi_main = SimObject(gc=lambda obj, free: obj)
+    ffi_lib = SimObject(
+        cartesian_stepper_alloc=lambda axis: object(),
+        extruder_stepper_alloc=lambda: object(),
+        free=lambda obj: None,
+    )
+    chelper.get_ffi = lambda: (ffi_main, ffi_lib)
+    toolhead = types.ModuleType("toolhead")
+    toolhead._tr_sim = True
+    toolhead.ToolHead = SimToolHeadBase
+    toolhead.LookAheadQueue = SimLookAheadQueue
+    toolhead.BUFFER_TIME_HIGH = 1.0
+    toolhead.BUFFER_TIME_START = BUFFER_TIME_START
+    kinematics = types.ModuleType("kinematics")
+    kinematics.__path__ = []
+    extruder = types.ModuleType("kinematics.extruder")
+    extruder.DummyExtruder = lambda printer: SimObject(
+        calc_junction=lambda prev_move, move: move.max_cruise_v2
+    )
+    kinematics.extruder = extruder
+    sys.modules.update(
+        {
+            "extras": extras,
+            "extras.homing": homing,
+            "gcode": gcode,
+            "stepper": stepper,
+            "chelper": chelper,
+            "toolhead": toolhead,
+            "kinematics": kinematics,
+            "kinematics.extruder": extruder,
+        }
+    )
+
+
+def load_trad_rack_module(module_dir=DEFAULT_MODULE_DIR):
+    install_klippy_modules()
+    module_dir = os.path.abspath(module_dir)
+    if module_dir not in sys.path:
+        sys.path.insert(0, module_dir)
+    import trad_rack
+
+    return trad_rack
+
+
+def default_sections(lane_count=16, bowden_length=1000.0, toolhead_sensor=True):
+    lane_spacing = 17.0
+    tr = {
+        "selector_max_velocity": 450.0,
+        "selector_max_accel": 3000.0,
+        "filament_max_velocity": 250.0,
+        "filament_max_accel": 1500.0,
+        "lane_count": lane_count,
+        "lane_spacing": lane_spacing,
+        "servo_down_angle": 0.0,
+        "servo_up_angle": 180.0,
+        "servo_wait_ms": 500.0,
+        "selector_unload_length": 13.0,
+        "eject_length": 30.0,
+        "bowden_length": bowden_length,
+        "extruder_load_length": 25.5,
+        "hotend_load_length": 18.0,
+        "toolhead_unload_length": 15.5,
+        "spool_pull_speed": 100.0,
+        "buffer_pull_speed": 250.0,
+        "register_toolchange_commands": True,
+    }
+    if toolhead_sensor:
+        tr["toolhead_fil_sensor_pin"] = "sim:toolhead_sensor"
+    return {
+        "trad_rack": tr,
+        "stepper_tr_selector": {
+            "position_min": 0.0,
+            "position_endstop": 0.0,
+            "position_max": (lane_count - 1) * lane_spacing,
+            "homing_speed": 100.0,
+        },
+        "stepper_tr_fil_driver": {
+            "endstop_pin": "^sim:selector_sensor",
+            "position_min": -5000.0,
+            "position_endstop": 0.0,
+            "position_max": 5000.0,
+        },
+        "servo tr_servo": {"maximum_servo_angle": 180.0},
+    }
+
+
+class Simulation:
+    """Builds a TradRack object on top of stand-in klippy objects."""
+
+    def __init__(
+        self,
+        sections=None,
+        module_dir=DEFAULT_MODULE_DIR,
+        variables_file=None,
+        world_params=None,
+        verbose=False,
+    ):
+        self.verbose = verbose
+        self.trad_rack_module = load_trad_rack_module(module_dir)
+        if sections is None:
+            sections = default_sections()
+        self.sections = sections
+        self.reactor = SimReactor()
+        self.printer = SimPrinter(self)
+        self.events = []
+        self.stats = {"mcu_queries": 0, "homing_moves": 0}
+        self.builtin_commands = {}
+        self.button_callbacks = []
+        self.tr_toolhead = None
+        self.move_log = []
+        tr = sections["trad_rack"]
+        lane_count = int(tr["lane_count"])
+        spacing = float(tr["lane_spacing"])
+        params = {
+            "lane_count": lane_count,
+            "lane_positions": [i * spacing for i in range(lane_count)],
+            "servo_down_angle": float(tr["servo_down_angle"]),
+            "servo_up_angle": float(tr["servo_up_angle"]),
+            "servo_time": float(tr.get("servo_wait_ms", 500.0)) / 1000.0,
+            "selector_unload_length": float(tr["selector_unload_length"]),
+            "toolhead_sensor_pos": float(tr["bowden_length"]) * 1.05,
+            "selector_endstop": float(
+                sections["stepper_tr_selector"]["position_endstop"]
+            ),
+        }
+        params.update(world_params or {})
+        self.world = SimWorld(self, params)
+
+        # base printer objects
+        reactor = self.reactor
+        printer = self.printer
+        mcu = SimMCU(reactor)
+        printer.add_object("mcu", mcu)
+        self.extruder = SimExtruder(reactor)
+        self.toolhead = SimMainToolHead(printer, self.extruder)
+        printer.add_object("toolhead", self.toolhead)
+        printer.add_object("extruder", self.extruder)
+        printer.add_object("heaters", SimHeaters(printer))
+        self.gcode = SimGCode(printer)
+        printer.add_object("gcode", self.gcode)
+        printer.add_object("gcode_macro", SimGCodeMacro(printer))
+        self.save_variables = SimSaveVariables(printer, variables_file)
+        printer.add_object("save_variables", self.save_variables)
+        self.paused = False
+        self.printing = False
+        printer.add_object(
+            "pause_resume",
+            SimObject(
+                get_status=lambda eventtime: {"is_paused": self.paused},
+                send_pause_command=self._pause,
+            ),
+        )
+        printer.add_object(
+            "idle_timeout",
+            SimObject(
+                get_status=lambda eventtime: {
+                    "state": "Printing" if self.printing else "Ready"
+                }
+            ),
+        )
+        printer.add_object("gcode_move", SimObject(saved_states={}))
+        printer.add_object(
+            "stepper_enable",
+            SimObject(
+                lookup_enable=lambda name: SimObject(
+                    motor_enable=lambda print_time: None,
+                    motor_disable=lambda print_time: None,
+                )
+            ),
+        )
+        printer.add_object(
+            "motion_queuing",
+            SimObject(
+                register_flush_callback=lambda cb, can_add_trapq=False: None,
+                allocate_trapq=lambda: object(),
+                lookup_trapq_append=lambda: (lambda *args: None),
+            ),
+        )
+        printer.add_object("danger_options", SimObject())
+        for section in ("pins", "buttons", "query_endstops"):
+            printer.add_object(section, self.create_object(None, section))
+        self._register_builtin_commands()
+
+        # create trad_rack
+        config = SimConfig(printer, sections, "trad_rack")
+        self.trad_rack = self.trad_rack_module.load_config(config)
+        printer.add_object("trad_rack", self.trad_rack)
+        self.tr_toolhead = self.trad_rack.tr_toolhead
+        printer.send_event("klippy:connect")
+        printer.send_event("klippy:ready")
+        self.check_sensor_events(0.0)
+
+    # object creation for load_object()
+    def create_object(self, config, section):
+        printer = self.printer
+        if section == "pins":
+            return SimObject(
+                setup_pin=self._setup_pin,
+                allow_multi_use_pin=lambda pin: None,
+                error=ConfigError,
+            )
+        if section == "query_endstops":
+            return SimObject(register_endstop=lambda es, name: None)
+        if section == "buttons":
+            return SimObject(register_buttons=self._register_buttons)
+        if section.startswith("servo "):
+            return SimServo(printer, config.getsection(section))
+        if section in self.sections:
+            return SimObject()
+        return None
+
+    def _setup_pin(self, pin_type, pin):
+        return SimEndstop(self.printer, self.world.query_toolhead_sensor)
+
+    def _register_buttons(self, pins, callback):
+        for pin in pins:
+            name = pin.lstrip("^~!").strip()
+            if name.endswith("selector_sensor"):
+                query = self.world.query_selector_sensor
+            else:
+                query = self.world.query_toolhead_sensor
+            self.button_callbacks.append([query, callback, None])
+
+    def check_sensor_events(self, print_time):
+        for entry in self.button_callbacks:
+            query, callback, last = entry
+            state = bool(query())
+            if state != last:
+                entry[2] = state
+                self.reactor.register_callback(
+                    lambda e, c=callback, s=state: c(e, s),
+                    max(print_time, self.reactor.monotonic()),
+                )
+
+    def note_move(self, toolhead, start, end):
+        self.move_log.append((toolhead is self.tr_toolhead, start, end))
+
+    # builtin gcode commands
+    def _register_builtin_commands(self):
+        builtin = self.builtin_commands
+        builtin["SAVE_VARIABLE"] = self.save_variables.cmd_SAVE_VARIABLE
+        builtin["SAVE_GCODE_STATE"] = self._cmd_save_state
+        builtin["RESTORE_GCODE_STATE"] = lambda gcmd: None
+        builtin["PAUSE"] = lambda gcmd: self._pause()
+        builtin["RESUME"] = lambda gcmd: self._resume()
+        builtin["G4"] = lambda gcmd: self.toolhead.dwell(
+            gcmd.get_float("P", 0.0) / 1000.0
+        )
+        builtin["M400"] = lambda gcmd: self.toolhead.wait_moves()
+        builtin["M104"] = lambda gcmd: self.extruder.heater.set_temp(
+            gcmd.get_float("S", 0.0)
+        )
+        builtin["M109"] = self._cmd_M109
+        builtin["G1"] = self._cmd_G1
+        builtin["G0"] = self._cmd_G1
+        for cmd in ("G90", "G91", "M82", "M83", "G92", "TIMELAPSE_TAKE_FRAME"):
+            builtin[cmd] = lambda gcmd: None
+
+    def _cmd_save_state(self, gcmd):
+        name = gcmd.get("NAME", "default")
+        self.printer.lookup_object("gcode_move").saved_states[name] = {}
+
+    def _cmd_M109(self, gcmd):
+        heaters = self.printer.lookup_object("heaters")
+        heaters.set_temperature(self.extruder.heater, gcmd.get_float("S"), True)
+
+    def _cmd_G1(self, gcmd):
+        pos = self.toolhead.get_position()
+        for i, axis in enumerate("XYZ"):
+            if axis in gcmd.params:
+                pos[i] = float(gcmd.params[axis])
+        if "E" in gcmd.params:
+            pos[3] += float(gcmd.params["E"])
+        speed = float(gcmd.params.get("F", 6000.0)) / 60.0
+        self.toolhead.move(pos, speed)
+
+    def _pause(self):
+        if not self.paused:
+            states = self.printer.lookup_object("gcode_move").saved_states
+            states["PAUSE_STATE"] = {}
+        self.paused = True
+
+    def _resume(self):
+        self.paused = False
+
+    # helpers
+    def run_gcode(self, script):
+        self.gcode.run_script(script)
+
+    def advance(self, delay):
+        self.reactor.pause(self.reactor.monotonic() + delay)
+
+    def finish(self):
+        """Wait for both toolheads and return the time everything is done."""
+        self.toolhead.wait_moves()
+        self.tr_toolhead.wait_moves()
+        end = max(
+            self.toolhead.print_time,
+            self.tr_toolhead.print_time,
+            self.reactor.monotonic(),
+        )
+        self.reactor.pause(end)
+        return end
@@ -4,7 +4,7 @@
 # based on code by Kevin O'Connor <kevin@koconnor.net>
 #
 # This file may be distributed under the terms of the GNU GPLv3 license.
-import logging, math, os, time
+import json, logging, math, os, re, threading, time
 from collections import deque
 from extras.homing import Homing, HomingMove
 from gcode import CommandError
@@ -15,19 +15,67 @@ SERVO_NAME = "servo tr_servo"
 SELECTOR_STEPPER_NAME = "stepper_tr_selector"
 FIL_DRIVER_STEPPER_NAME = "stepper_tr_fil_driver"
 
+# extra time (in seconds) to wait after queued moves are expected to be done
+WAIT_MOVES_MARGIN = 0.001
+
+
+def wait_for_moves(th):
+    # wait for the queued moves of a toolhead to finish by sleeping until they
+    # are expected to be done, rather than checking every 100ms like
+    # ToolHead.wait_moves does (only if the toolhead has the attributes this
+    # relies on, otherwise ToolHead.wait_moves is used on its own)
+    if not all(
+        hasattr(th, attr)
+        for attr in (
+            "_flush_lookahead",
+            "can_pause",
+            "print_time",
+            "mcu",
+            "reactor",
+        )
+    ):
+        toolhead.ToolHead.wait_moves(th)
+        return
+    th._flush_lookahead()
+    if th.can_pause:
+        reactor = th.reactor
+        eventtime = reactor.monotonic()
+        while True:
+            est_print_time = th.mcu.estimated_print_time(eventtime)
+            if th.print_time < est_print_time:
+                break
+            eventtime = reactor.pause(
+                eventtime + th.print_time - est_print_time + WAIT_MOVES_MARGIN
+            )
+
+    # let the toolhead check that the moves are done
+    toolhead.ToolHead.wait_moves(th)
+
 
 class TradRack:
     # variables saved with save_variables
     VARS_CALIB_BOWDEN_LOAD_LENGTH = "tr_calib_bowden_load_length"
     VARS_CALIB_BOWDEN_UNLOAD_LENGTH = "tr_calib_bowden_unload_length"
+    VARS_CALIB_LANE_BOWDEN_LOAD_LENGTHS = "tr_calib_lane_bowden_load_lengths"
+    VARS_CALIB_LANE_BOWDEN_UNLOAD_LENGTHS = (
+        "tr_calib_lane_bowden_unload_lengths"
+    )
     VARS_CONFIG_BOWDEN_LENGTH = "tr_config_bowden_length"
     VARS_TOOL_STATUS = "tr_state_tool_status"
     VARS_HEATER_TARGET = "tr_last_heater_target"
     VARS_ACTIVE_LANE = "tr_active_lane"
+    VARS_LANE_STATES = "tr_state_lanes"
 
     # gcode states
     GCODE_STATE_TOOLCHANGE = "TR_TOOLCHANGE_STATE"
 
+    # max time (in seconds) for a sensor change to be reported after a move
+    SENSOR_REPORT_TIME = 0.100
+
+    # time (in seconds) between updates of the filament used from the active
+    # lane while printing
+    CONSUMPTION_UPDATE_TIME = 10.0
+
     def __init__(self, config):
         self.printer = config.get_printer()
         self.reactor = self.printer.get_reactor()
@@ -35,6 +83,12 @@ class TradRack:
             "klippy:connect", self.handle_connect
         )
         self.printer.register_event_handler("klippy:ready", self.handle_ready)
+        self.printer.register_event_handler(
+            "klippy:shutdown", self.handle_shutdown
+        )
+        self.printer.register_event_handler(
+            "klippy:disconnect", self.handle_shutdown
+        )
 
         # read spool and buffer pull speeds
         self.spool_pull_speed = config.getfloat(
@@ -53,8 +107,13 @@ class TradRack:
         self.sel_max_velocity, _ = self.tr_toolhead.get_sel_max_velocity()
 
         # get servo
+        self.servo_wait = (
+            config.getfloat("servo_wait_ms", default=500.0, above=0.0) / 1000.0
+        )
         self.servo = TradRackServo(
-            self.printer.load_object(config, SERVO_NAME), self.tr_toolhead
+            self.printer.load_object(config, SERVO_NAME),
+            self.tr_toolhead,
+            self.servo_wait,
         )
 
         # get kinematics and filament driver endstops
@@ -66,6 +125,7 @@ class TradRack:
         # set up toolhead filament sensor
         toolhead_fil_sensor_pin = config.get("toolhead_fil_sensor_pin", None)
         self.toolhead_fil_endstops = []
+        self.toolhead_sensor = None
         if toolhead_fil_sensor_pin is not None:
             # register endstop
             ppins = self.printer.lookup_object("pins")
@@ -81,10 +141,19 @@ class TradRack:
             ) in self.tr_kinematics.get_fil_driver_rail().get_steppers():
                 mcu_endstop.add_stepper(stepper)
 
+            # keep track of sensor state
+            self.toolhead_sensor = TradRackFilamentSensor(
+                config, toolhead_fil_sensor_pin
+            )
+
         # set up selector sensor as a runout sensor
         pin = config.getsection(FIL_DRIVER_STEPPER_NAME).get("endstop_pin")
         self.selector_sensor = TradRackRunoutSensor(
-            config, self.handle_runout, pin
+            config,
+            self.handle_runout,
+            pin,
+            glitch_callback=self.handle_runout_glitch,
+            toolhead_sensor=self.toolhead_sensor,
         )
 
         # read lane count and get lane positions
@@ -98,8 +167,61 @@ class TradRack:
         bowden_samples = config.getint(
             "bowden_length_samples", default=10, minval=1
         )
-        self.bowden_load_length_filter = MovingAverageFilter(bowden_samples)
-        self.bowden_unload_length_filter = MovingAverageFilter(bowden_samples)
+        self.robust_bowden_length_filter = config.getchoice(
+            "bowden_length_filter",
+            {"average": False, "robust": True},
+            default="average",
+        )
+        self.bowden_length_outlier_sigma = config.getfloat(
+            "bowden_length_outlier_sigma", default=3.0, above=0.0
+        )
+        if self.robust_bowden_length_filter:
+
+            def create_bowden_length_filter():
+                return RobustLengthFilter(
+                    bowden_samples, self.bowden_length_outlier_sigma
+                )
+
+        else:
+
+            def create_bowden_length_filter():
+                return MovingAverageFilter(bowden_samples)
+
+        self.bowden_load_length_filter = create_bowden_length_filter()
+        self.bowden_unload_length_filter = create_bowden_length_filter()
+        self.per_lane_bowden_lengths = config.getboolean(
+            "per_lane_bowden_lengths", False
+        )
+
+        # create bowden speed profiles
+        self.adaptive_bowden_speeds = config.getboolean(
+            "adaptive_bowden_speeds", False
+        )
+        fil_max_velocity, _ = self.tr_toolhead.get_fil_max_velocity()
+        self.bowden_speed_profiles = {
+            "load": [
+                BowdenSpeedProfile(
+                    {
+                        "spool": self.spool_pull_speed,
+                        "buffer": self.buffer_pull_speed,
+                    },
+                    fil_max_velocity,
+                )
+                for _ in range(self.lane_count)
+            ],
+            "unload": [
+                BowdenSpeedProfile(
+                    {"buffer": self.buffer_pull_speed}, fil_max_velocity
+                )
+                for _ in range(self.lane_count)
+            ],
+        }
+        self.lane_bowden_load_length_filters = [
+            create_bowden_length_filter() for _ in range(self.lane_count)
+        ]
+        self.lane_bowden_unload_length_filters = [
+            create_bowden_length_filter() for _ in range(self.lane_count)
+        ]
 
         # create extruder sync manager
         self.extruder_sync_manager = TradRackExtruderSyncManager(
@@ -111,9 +233,6 @@ class TradRack:
         # read other values
         self.servo_down_angle = config.getfloat("servo_down_angle")
         self.servo_up_angle = config.getfloat("servo_up_angle")
-        self.servo_wait = (
-            config.getfloat("servo_wait_ms", default=500.0, above=0.0) / 1000.0
-        )
         self.selector_unload_length = config.getfloat(
             "selector_unload_length", above=0.0
         )
@@ -180,6 +299,18 @@ class TradRack:
         self.target_selector_homing_dist = config.getfloat(
             "target_selector_homing_dist", 10.0, above=0.0
         )
+        self.min_toolhead_homing_dist = config.getfloat(
+            "min_toolhead_homing_dist",
+            min(5.0, self.target_toolhead_homing_dist),
+            above=0.0,
+            maxval=self.target_toolhead_homing_dist,
+        )
+        self.min_selector_homing_dist = config.getfloat(
+            "min_selector_homing_dist",
+            min(5.0, self.target_selector_homing_dist),
+            above=0.0,
+            maxval=self.target_selector_homing_dist,
+        )
         self.fil_homing_lengths = {
             "user load lane": (
                 config.getint(
@@ -220,10 +351,38 @@ class TradRack:
             "register_toolchange_commands", default=True
         )
         self.save_active_lane = config.getboolean("save_active_lane", True)
+        self.save_tool_map = config.getboolean("save_tool_map", False)
         self.keep_servo_down_after_lane_load = config.getboolean(
             "keep_servo_down_after_lane_load", False
         )
         self.log_bowden_lengths = config.getboolean("log_bowden_lengths", False)
+        bowden_length_log_max_size = config.getint(
+            "bowden_length_log_max_size", default=1048576, minval=0
+        )
+        self.pipelined_toolchange = config.getboolean(
+            "pipelined_toolchange", False
+        )
+        self.prefetch_next_tool = config.getboolean("prefetch_next_tool", False)
+        prefetch_scan_bytes = config.getint(
+            "prefetch_scan_bytes", default=262144, minval=1
+        )
+        self.runout_reserve_length = config.getfloat(
+            "runout_reserve_length", default=0.0, minval=0.0
+        )
+        self.selector_sensor.set_debounce(
+            config.getfloat(
+                "runout_debounce_length",
+                default=0.0,
+                minval=0.0,
+                below=self.config_bowden_length,
+            ),
+            config.getfloat("runout_debounce_time", default=0.0, minval=0.0),
+        )
+        self.save_variables_delay = config.getfloat(
+            "save_variables_delay", default=0.0, minval=0.0
+        )
+        toolchange_journal = config.getboolean("toolchange_journal", False)
+        toolchange_stats = config.getboolean("toolchange_stats", True)
 
         # other variables
         self.toolhead = None
@@ -232,21 +391,75 @@ class TradRack:
         self.retry_lane = None  # lane to reload before resuming
         self.next_lane = None  # next lane to load to toolhead
         self.next_tool = None  # next tool to load to toolhead
-        self.servo_raised = None
-        self.lanes_buffered = [False] * self.lane_count
+        self.lanes = TradRackLaneRegistry(self.lane_count)
+        self.saved_lane_states = None
+        self.saved_tool_status = None
         self.bowden_load_calibrated = False
         self.bowden_unload_calibrated = False
+        self.lane_bowden_load_lengths = [None] * self.lane_count
+        self.lane_bowden_unload_lengths = [None] * self.lane_count
+        self.lanes_bowden_load_calibrated = [False] * self.lane_count
+        self.lanes_bowden_unload_calibrated = [False] * self.lane_count
         self.bowden_load_lengths_filename = os.path.expanduser(
             "~/bowden_load_lengths.csv"
         )
         self.bowden_unload_lengths_filename = os.path.expanduser(
             "~/bowden_unload_lengths.csv"
         )
+        self.ignore_next_load_length = False
         self.ignore_next_unload_length = False
+        self.log_writer = None
+        if self.log_bowden_lengths:
+            self.log_writer = TradRackLogWriter(
+                self.printer, bowden_length_log_max_size
+            )
         self.last_heater_target = 0.0
         self.tr_next_generator = None
         self.selector_pos_uncertain = False
         self.variables = None
+        self.pipeline_state = None  # (retract end time, selector travel time)
+        self.pipeline_time_saved = 0.0
+        self.prefetch_tool = None  # tool of the next toolchange in the file
+        self.prefetch_lane = None  # lane of the next toolchange in the file
+        self.phase_timer = TradRackPhaseTimer(
+            self.reactor, self.tr_toolhead, toolchange_stats
+        )
+        self.toolchange_journal = TradRackToolchangeJournal(
+            os.path.expanduser("~/trad_rack_journal.log")
+            if toolchange_journal
+            else None
+        )
+        self.interrupted_toolchange = None  # last journal entry at startup
+        self.dirty_variables = {}  # variables waiting to be saved
+        self.save_variables_timer = self.reactor.register_timer(
+            self._handle_save_variables_timer
+        )
+
+        # set up tracking of filament used from each lane
+        self.consumption_start_pos = None  # extruder position of last update
+        self.low_lanes_reported = set()
+        self.consumption_timer = self.reactor.register_timer(
+            self._handle_consumption_timer
+        )
+        self.printer.register_event_handler(
+            "idle_timeout:printing", self.handle_printing
+        )
+        self.printer.register_event_handler(
+            "idle_timeout:ready", self.handle_not_printing
+        )
+        self.printer.register_event_handler(
+            "idle_timeout:idle", self.handle_not_printing
+        )
+
+        # set up look-ahead for the next toolchange in the print file
+        self.tool_prefetcher = None
+        if self.prefetch_next_tool:
+            self.tool_prefetcher = TradRackToolPrefetcher(
+                self.printer, prefetch_scan_bytes
+            )
+            self.printer.register_event_handler(
+                "trad_rack:load_complete", self.handle_load_complete
+            )
 
         # resume variables
         self.resume_callbacks = {
@@ -256,12 +469,6 @@ class TradRack:
         }
         self.resume_stack = deque()
 
-        # tool mapping
-        self.lanes_dead = [False] * self.lane_count
-        self.tool_map = []
-        self.default_lanes = []
-        self._reset_tool_map()
-
         # runout variables
         self.runout_lane = None
         self.runout_steps_done = 0
@@ -275,6 +482,12 @@ class TradRack:
         self.post_unload_macro = gcode_macro.load_template(
             config, "post_unload_gcode", ""
         )
+        self.concurrent_unload_macro = gcode_macro.load_template(
+            config, "concurrent_unload_gcode", ""
+        )
+        self.concurrent_load_macro = gcode_macro.load_template(
+            config, "concurrent_load_gcode", ""
+        )
         self.pre_load_macro = gcode_macro.load_template(
             config, "pre_load_gcode", ""
         )
@@ -303,6 +516,16 @@ class TradRack:
             self.cmd_TR_LOAD_LANE,
             desc=self.cmd_TR_LOAD_LANE_help,
         )
+        self.gcode.register_command(
+            "TR_LOAD_LANES",
+            self.cmd_TR_LOAD_LANES,
+            desc=self.cmd_TR_LOAD_LANES_help,
+        )
+        self.gcode.register_command(
+            "TR_PREFLIGHT",
+            self.cmd_TR_PREFLIGHT,
+            desc=self.cmd_TR_PREFLIGHT_help,
+        )
         self.gcode.register_command(
             "TR_LOAD_TOOLHEAD",
             self.cmd_TR_LOAD_TOOLHEAD,
@@ -397,6 +620,29 @@ class TradRack:
             self.cmd_TR_PRINT_TOOL_GROUPS,
             desc=self.cmd_TR_PRINT_TOOL_GROUPS_help,
         )
+        self.gcode.register_command(
+            "TR_SET_LANE_TEMP",
+            self.cmd_TR_SET_LANE_TEMP,
+            desc=self.cmd_TR_SET_LANE_TEMP_help,
+        )
+        self.gcode.register_command(
+            "TR_SET_LANE_MATERIAL",
+            self.cmd_TR_SET_LANE_MATERIAL,
+            desc=self.cmd_TR_SET_LANE_MATERIAL_help,
+        )
+        self.gcode.register_command(
+            "TR_SET_LANE_SPOOL",
+            self.cmd_TR_SET_LANE_SPOOL,
+            desc=self.cmd_TR_SET_LANE_SPOOL_help,
+        )
+        self.gcode.register_command(
+            "TR_PRINT_LANE_STATES",
+            self.cmd_TR_PRINT_LANE_STATES,
+            desc=self.cmd_TR_PRINT_LANE_STATES_help,
+        )
+        self.gcode.register_command(
+            "TR_STATS", self.cmd_TR_STATS, desc=self.cmd_TR_STATS_help
+        )
         if register_toolchange_commands:
             for i in range(self.lane_count):
                 self.gcode.register_command(
@@ -423,6 +669,27 @@ class TradRack:
     def handle_ready(self):
         self._load_saved_state()
 
+        # check for a toolchange that was interrupted by a restart
+        self.interrupted_toolchange = self.toolchange_journal.replay()
+        if (
+            self.interrupted_toolchange is not None
+            and self.interrupted_toolchange["phase"]
+            not in TradRackToolchangeJournal.END_PHASES
+        ):
+            msg = (
+                "Trad Rack was restarted while loading or unloading the"
+                " toolhead (last completed phase: {}). Use TR_LOCATE_SELECTOR"
+                " to resume.".format(self.interrupted_toolchange["phase"])
+            )
+            logging.info("trad_rack: " + msg)
+            self.gcode.respond_info(msg)
+
+    def handle_shutdown(self):
+        try:
+            self._flush_saved_variables()
+        except self.printer.command_error:
+            logging.exception("trad_rack: Failed to save variables")
+
     def _load_saved_state(self):
         # load bowden lengths if the user has not changed the config value
         prev_config_bowden_length = self.variables.get(
@@ -438,10 +705,7 @@ class TradRack:
             )
             if load_length_stats:
                 self.bowden_load_length = load_length_stats["new_set_length"]
-                for _ in range(load_length_stats["sample_count"]):
-                    self.bowden_load_length_filter.update(
-                        self.bowden_load_length
-                    )
+                self.bowden_load_length_filter.restore(load_length_stats)
 
             # update unload length
             unload_length_stats = self.variables.get(
@@ -451,15 +715,28 @@ class TradRack:
                 self.bowden_unload_length = unload_length_stats[
                     "new_set_length"
                 ]
-                for _ in range(unload_length_stats["sample_count"]):
-                    self.bowden_unload_length_filter.update(
-                        self.bowden_unload_length
-                    )
+                self.bowden_unload_length_filter.restore(unload_length_stats)
+
+            # update per-lane lengths
+            if self.per_lane_bowden_lengths:
+                self._load_lane_bowden_lengths(
+                    self.variables.get(
+                        self.VARS_CALIB_LANE_BOWDEN_LOAD_LENGTHS, []
+                    ),
+                    self.lane_bowden_load_lengths,
+                    self.lane_bowden_load_length_filters,
+                )
+                self._load_lane_bowden_lengths(
+                    self.variables.get(
+                        self.VARS_CALIB_LANE_BOWDEN_UNLOAD_LENGTHS, []
+                    ),
+                    self.lane_bowden_unload_lengths,
+                    self.lane_bowden_unload_length_filters,
+                )
         else:
             # save bowden_length config value
-            self.gcode.run_script_from_command(
-                'SAVE_VARIABLE VARIABLE=%s VALUE="%s"'
-                % (self.VARS_CONFIG_BOWDEN_LENGTH, self.config_bowden_length)
+            self._save_variable(
+                self.VARS_CONFIG_BOWDEN_LENGTH, self.config_bowden_length
             )
 
         # load last heater target
@@ -467,6 +744,56 @@ class TradRack:
             self.VARS_HEATER_TARGET, 0.0
         )
 
+        # load lane states
+        self.lanes.restore_lane_states(
+            self.variables.get(self.VARS_LANE_STATES, [])
+        )
+        self.saved_lane_states = self.lanes.get_lane_states()
+        if self.save_tool_map:
+            self.lanes.restore_tool_status(
+                self.variables.get(self.VARS_TOOL_STATUS, {})
+            )
+            self.saved_tool_status = self.lanes.get_tool_status()
+
+    def _set_selector_position(self, lane):
+        # set the selector position to the position of a lane without moving
+        # the selector
+        print_time = self.tr_toolhead.get_last_move_time()
+        pos = self.tr_toolhead.get_position()
+        lane_pos = self.lane_positions[lane]
+
+        # mark selector position as uncertain if not homed or current position
+        # doesn't match lane position
+        if not (self._is_selector_homed() and pos[0] == lane_pos):
+            self.selector_pos_uncertain = True
+
+        # set selector position and enable motor
+        pos[0] = lane_pos
+        self.tr_toolhead.set_position(pos, homing_axes=(0,))
+        stepper_enable = self.printer.lookup_object("stepper_enable")
+        enable = stepper_enable.lookup_enable(SELECTOR_STEPPER_NAME)
+        enable.motor_enable(print_time)
+
+    def _load_lane_bowden_lengths(self, lane_length_stats, lengths, filters):
+        for lane, length_stats in enumerate(lane_length_stats):
+            if lane >= self.lane_count or not length_stats:
+                continue
+            lengths[lane] = length_stats["new_set_length"]
+            filters[lane].restore(length_stats)
+
+    def handle_printing(self, print_time):
+        self.reactor.update_timer(self.consumption_timer, self.reactor.NOW)
+        if self.tool_prefetcher is not None:
+            self.reactor.register_callback(self._prefetch_next_toolchange)
+
+    def handle_not_printing(self, print_time):
+        self.reactor.update_timer(self.consumption_timer, self.reactor.NEVER)
+        self._update_consumption()
+        self._save_lane_states()
+
+    def handle_load_complete(self):
+        self.reactor.register_callback(self._prefetch_next_toolchange)
+
     def handle_runout(self, eventtime):
         # send pause command
         pause_resume = self.printer.lookup_object("pause_resume")
@@ -479,11 +806,13 @@ class TradRack:
         # note runout
         self.runout_lane = self.active_lane
         self._set_active_lane(None)
-        self.lanes_buffered[self.runout_lane] = False
-        self.lanes_dead[self.runout_lane] = True
+        self.lanes[self.runout_lane].buffered = False
+        self.lanes[self.runout_lane].dead = True
+        self.lanes[self.runout_lane].loaded = False
+        self._save_lane_states()
         self.gcode.respond_info(
             "Runout detected at selector on lane {} (tool {})".format(
-                self.runout_lane, self.tool_map[self.runout_lane]
+                self.runout_lane, self.lanes[self.runout_lane].tool
             )
         )
 
@@ -493,6 +822,16 @@ class TradRack:
             self.gcode.create_gcode_command("TR_RESUME", "TR_RESUME", {})
         )
 
+    def handle_runout_glitch(self, eventtime, duration, length):
+        msg = (
+            "Ignored selector sensor glitch on lane {} (no filament detected"
+            " for {:.2f}s and {:.1f}mm of extrusion)".format(
+                self.active_lane, duration, length
+            )
+        )
+        logging.info("trad_rack: " + msg)
+        self.gcode.respond_info(msg)
+
     # gcode commands
     cmd_TR_HOME_help = "Home Trad Rack's selector"
 
@@ -540,7 +879,219 @@ class TradRack:
     def cmd_TR_LOAD_LANE(self, gcmd):
         lane = gcmd.get_int("LANE", None)
         self._load_lane(lane, gcmd.get_int("RESET_SPEED", 1), True)
-        self.lanes_dead[lane] = False
+        self.lanes[lane].dead = False
+        self.lanes[lane].failed_loads = 0
+        self._save_lane_states()
+
+    cmd_TR_LOAD_LANES_help = (
+        "Load filament into several lanes in one pass of the selector"
+    )
+
+    def cmd_TR_LOAD_LANES(self, gcmd):
+        # get lanes
+        lanes_str = gcmd.get("LANES", None)
+        if lanes_str is None:
+            lanes = list(range(self.lane_count))
+        else:
+            try:
+                lanes = [int(lane) for lane in lanes_str.split(",") if lane]
+            except ValueError:
+                raise gcmd.error("Invalid LANES")
+            for lane in lanes:
+                self._check_lane_valid(lane)
+        reset_speed = gcmd.get_int("RESET_SPEED", 1)
+
+        # skip lanes that are already known to be loaded
+        skipped_lanes = [
+            lane
+            for lane in sorted(set(lanes))
+            if self.lanes[lane].loaded and not self.lanes[lane].dead
+        ]
+        lanes = [lane for lane in set(lanes) if lane not in skipped_lanes]
+
+        # load lanes
+        loaded_lanes, failed_lanes = self._load_lanes(lanes, reset_speed)
+        self._save_lane_states()
+
+        # report results
+        msg = "Loaded lanes: {}\n".format(
+            ", ".join(str(lane) for lane in sorted(loaded_lanes)) or "none"
+        )
+        if skipped_lanes:
+            msg += "Skipped lanes that are already loaded: {}\n".format(
+                ", ".join(str(lane) for lane in skipped_lanes)
+            )
+        if failed_lanes:
+            msg += "Failed to load lanes: {}".format(
+                ", ".join(str(lane) for lane in sorted(failed_lanes))
+            )
+        gcmd.respond_info(msg.rstrip("\n"))
+
+    cmd_TR_PREFLIGHT_help = (
+        "Check that the lanes needed by a print file are loaded before"
+        " printing"
+    )
+
+    def cmd_TR_PREFLIGHT(self, gcmd):
+        file_path = self._get_print_file(gcmd.get("FILE", None))
+        verify = gcmd.get_int("VERIFY", 1)
+
+        # get the tools and lanes used by the print file
+        problems = []
+        needed_lanes = []
+        lane_tools = {}  # tool of each needed lane (None if given directly)
+        for tool, lane in self._read_print_file_toolchanges(file_path):
+            if lane is not None:
+                try:
+                    self._check_lane_valid(lane)
+                except self.printer.command_error:
+                    problems.append("Lane %d does not exist" % lane)
+                    continue
+            else:
+                try:
+                    self._check_tool_valid(tool)
+                except self.printer.command_error:
+                    problems.append("Tool %d does not exist" % tool)
+                    continue
+                lane = self._get_preflight_lane(tool)
+                if lane is None:
+                    problems.append("Tool %d has no lanes assigned" % tool)
+                    continue
+            if lane not in lane_tools:
+                needed_lanes.append(lane)
+            if lane_tools.get(lane) is None:
+                lane_tools[lane] = tool
+
+        # load every needed lane (except the one already in the toolhead) in
+        # one sweep, then try other lanes for tools whose lane failed
+        if verify:
+            tried_lanes = set()
+            lanes = [lane for lane in needed_lanes if lane != self.active_lane]
+            if lanes and self._query_selector_sensor():
+                raise self.printer.command_error(
+                    "Cannot check lanes with filament in selector. Unload the"
+                    " toolhead first or use VERIFY=0"
+                )
+            while lanes:
+                tried_lanes.update(lanes)
+                failed_lanes = self._load_lanes(lanes)[1]
+                lanes = []
+                for lane in failed_lanes:
+                    tool = lane_tools.pop(lane)
+                    needed_lanes.remove(lane)
+                    if tool is None:
+                        problems.append("Lane %d failed to load" % lane)
+                        continue
+                    replacement = self._get_preflight_lane(tool, tried_lanes)
+                    if replacement is None:
+                        problems.append(
+                            "None of the lanes assigned to tool %d loaded"
+                            % tool
+                        )
+                        continue
+                    if replacement not in lane_tools:
+                        needed_lanes.append(replacement)
+                        if replacement != self.active_lane:
+                            lanes.append(replacement)
+                    lane_tools[replacement] = tool
+
+            # move to the first lane so the first toolchange can start loading
+            # right away
+            if needed_lanes and self.active_lane is None:
+                self._go_to_lane(needed_lanes[0])
+
+        # make the checked lanes the defaults for their tools
+        for lane in needed_lanes:
+            if lane_tools[lane] is not None:
+                self.lanes.default_lanes[lane_tools[lane]] = lane
+        self._save_lane_states()
+
+        # report results
+        msg = ""
+        for lane in needed_lanes:
+            if lane_tools[lane] is None:
+                msg += "Lane {}".format(lane)
+            else:
+                msg += "Tool {}: lane {}".format(lane_tools[lane], lane)
+            if lane == self.active_lane:
+                msg += " (loaded in toolhead)"
+            elif verify:
+                msg += " (loaded)"
+            if self._is_lane_low(lane):
+                msg += ", expected to run out ({:.0f}mm left)".format(
+                    self.lanes[lane].get_remaining_length()
+                )
+            msg += "\n"
+        if problems:
+            raise self.printer.command_error(
+                msg + "Preflight failed:\n" + "\n".join(problems)
+            )
+        gcmd.respond_info(msg + "Preflight passed")
+
+    def _get_print_file(self, filename):
+        # get the path of the given file, or of the file being printed if no
+        # file is given
+        sdcard = self.printer.lookup_object("virtual_sdcard", None)
+        if filename is None:
+            if sdcard is not None:
+                filename = sdcard.get_status(self.reactor.monotonic()).get(
+                    "file_path"
+                )
+            if not filename:
+                raise self.printer.command_error(
+                    "No file is being printed. Use FILE=<file> to specify one"
+                )
+        elif sdcard is not None and not os.path.isabs(filename):
+            filename = os.path.join(sdcard.sdcard_dirname, filename)
+        return filename
+
+    def _read_print_file_toolchanges(self, file_path):
+        # returns the (tool, lane) of each different toolchange in a print
+        # file in the order they first appear, using the list of tools added
+        # to the end of the file by the post-processing script if there is
+        # one (otherwise the whole file is read, yielding to the reactor
+        # between chunks)
+        scanner = TradRackToolPrefetcher(self.printer, None)
+        try:
+            toolchanges = scanner.read_tool_list(file_path)
+            if toolchanges is None:
+                toolchanges = scanner.read_toolchanges(
+                    file_path, reactor=self.reactor
+                )
+                toolchanges = [
+                    (None, lane) if lane is not None else (tool, None)
+                    for tool, lane in toolchanges
+                ]
+        except (IOError, OSError):
+            raise self.printer.command_error(
+                "Unable to read print file '%s'" % file_path
+            )
+        unique_toolchanges = []
+        for toolchange in toolchanges:
+            if toolchange not in unique_toolchanges:
+                unique_toolchanges.append(toolchange)
+        return unique_toolchanges
+
+    def _get_preflight_lane(self, tool, exclude_lanes=()):
+        # get the lane to use for a tool, which is the default lane unless it
+        # is unlikely to load and another assigned lane is more likely to
+        lanes = [
+            lane
+            for lane in self._get_assigned_lanes(tool)
+            if lane not in exclude_lanes
+        ]
+        if not lanes:
+            return None
+        default_lane = self.lanes.default_lanes[tool]
+        if default_lane in lanes and self._get_lane_health(default_lane) >= 0:
+            return default_lane
+        return max(
+            lanes,
+            key=lambda lane: (
+                self._get_lane_health(lane),
+                lane == default_lane,
+            ),
+        )
 
     cmd_TR_LOAD_TOOLHEAD_help = "Load filament from Trad Rack into the toolhead"
 
@@ -558,7 +1109,7 @@ class TradRack:
             self._check_tool_valid(tool)
 
             # get default lane for the selected tool
-            lane = self.default_lanes[tool]
+            lane = self.lanes.default_lanes[tool]
             if lane is None:
                 gcmd.respond_info(
                     "Tool {tool} has no lanes assigned to it. Use"
@@ -571,7 +1122,7 @@ class TradRack:
                 # (and wait for user to resume)
                 resume_kwargs = {
                     "condition": (
-                        lambda t=tool: self.default_lanes[t] is not None
+                        lambda t=tool: self.lanes.default_lanes[t] is not None
                     ),
                     "action": lambda g=gcmd,
                     t=tool_override: self.cmd_TR_LOAD_TOOLHEAD(
@@ -585,6 +1136,21 @@ class TradRack:
                 self._set_up_resume_and_pause("check condition", resume_kwargs)
                 return
 
+            # switch to another lane if the default lane is expected to run
+            # out before the next toolchange
+            reserve_lane = self._find_reserve_lane(lane)
+            if reserve_lane is not None:
+                gcmd.respond_info(
+                    "Lane {} is expected to run out ({:.0f}mm left). Switching"
+                    " tool {} to lane {}".format(
+                        lane,
+                        self.lanes[lane].get_remaining_length(),
+                        tool,
+                        reserve_lane,
+                    )
+                )
+                lane = self.lanes.default_lanes[tool] = reserve_lane
+
         # load toolhead
         try:
             self._load_toolhead(
@@ -592,9 +1158,13 @@ class TradRack:
                 tool,
                 gcmd.get_float("MIN_TEMP", 0.0, minval=0.0),
                 gcmd.get_float("EXACT_TEMP", 0.0, minval=0.0),
-                gcmd.get_float("BOWDEN_LENGTH", None, minval=0.0),
-                gcmd.get_float("EXTRUDER_LOAD_LENGTH", None, minval=0.0),
-                gcmd.get_float("HOTEND_LOAD_LENGTH", None, minval=0.0),
+                bowden_length=gcmd.get_float("BOWDEN_LENGTH", None, minval=0.0),
+                extruder_load_length=gcmd.get_float(
+                    "EXTRUDER_LOAD_LENGTH", None, minval=0.0
+                ),
+                hotend_load_length=gcmd.get_float(
+                    "HOTEND_LOAD_LENGTH", None, minval=0.0
+                ),
             )
         except TradRackLoadError:
             logging.warning(
@@ -631,14 +1201,23 @@ class TradRack:
     def cmd_TR_UNLOAD_TOOLHEAD(self, gcmd):
         try:
             # unload toolhead
+            self.phase_timer.start()
             self._unload_toolhead(
                 gcmd.get_float("MIN_TEMP", 0.0, minval=0.0),
                 gcmd.get_float("EXACT_TEMP", 0.0, minval=0.0),
             )
+            self.phase_timer.finish("unload")
         finally:
+            # stop timing (if the unload failed)
+            self.phase_timer.cancel()
+
             # reset lane speed (in case the user is removing/swapping the spool)
             if gcmd.get_int("RESET_SPEED", 1) and self.curr_lane is not None:
-                self.lanes_buffered[self.curr_lane] = False
+                self.lanes[self.curr_lane].buffered = False
+
+            # save variables changed during the unload
+            self._save_lane_states()
+            self._flush_saved_variables()
 
     cmd_TR_SERVO_DOWN_help = "Lower the servo"
 
@@ -723,26 +1302,13 @@ class TradRack:
                 "Cannot set active lane without filament in selector"
             )
 
-        # get current selector position and lane position
-        print_time = self.tr_toolhead.get_last_move_time()
-        pos = self.tr_toolhead.get_position()
-        lane_pos = self.lane_positions[lane]
-
-        # mark selector position as uncertain if not homed or current position
-        # doesn't match lane position
-        if not (self._is_selector_homed() and pos[0] == lane_pos):
-            self.selector_pos_uncertain = True
-
         # set selector position
-        pos[0] = lane_pos
-        self.tr_toolhead.set_position(pos, homing_axes=(0,))
-        stepper_enable = self.printer.lookup_object("stepper_enable")
-        enable = stepper_enable.lookup_enable(SELECTOR_STEPPER_NAME)
-        enable.motor_enable(print_time)
+        self._set_selector_position(lane)
 
         # set current lane and active lane
         self.curr_lane = lane
         self._set_active_lane(lane)
+        self.toolchange_journal.clear()
 
         # reset next lane and tool if there is no longer a pending toolchange
         if self._is_next_toolchange_done():
@@ -767,6 +1333,7 @@ class TradRack:
 
     def cmd_TR_RESET_ACTIVE_LANE(self, gcmd):
         self._set_active_lane(None)
+        self.toolchange_journal.clear()
         self._raise_servo()
         self.extruder_sync_manager.unsync()
         self.selector_sensor.set_active(False)
@@ -819,6 +1386,12 @@ class TradRack:
 
     def cmd_TR_LOCATE_SELECTOR(self, gcmd):
         if self._query_selector_sensor():
+            if (
+                self.active_lane is None
+                and self._resume_interrupted_toolchange(gcmd)
+            ):
+                return
+
             if self.active_lane is None and self.save_active_lane:
                 # set active lane if a valid lane was saved
                 saved_active_lane = self.variables.get(self.VARS_ACTIVE_LANE)
@@ -886,6 +1459,7 @@ class TradRack:
         else:
             self._set_active_lane(None)
             self.selector_sensor.set_active(False)
+            self.interrupted_toolchange = None
             if not self._is_selector_homed():
                 self.cmd_TR_HOME(
                     self.gcode.create_gcode_command("TR_HOME", "TR_HOME", {})
@@ -941,31 +1515,47 @@ class TradRack:
         mode = gcmd.get("MODE", "ALL").upper()
         if mode not in ["ALL", "LOAD", "UNLOAD"]:
             raise gcmd.error("Invalid MODE: %s" % mode)
+        lane = gcmd.get_int("LANE", None)
+        if lane is not None:
+            self._check_lane_valid(lane)
+            lanes = [lane]
+        else:
+            lanes = range(self.lane_count)
+
+        # discard per-lane lengths
+        if self.per_lane_bowden_lengths:
+            for i in lanes:
+                if mode in ["ALL", "LOAD"]:
+                    self.lane_bowden_load_lengths[i] = None
+                    self.lane_bowden_load_length_filters[i].reset()
+                if mode in ["ALL", "UNLOAD"]:
+                    self.lane_bowden_unload_lengths[i] = None
+                    self.lane_bowden_unload_length_filters[i].reset()
+            if mode in ["ALL", "LOAD"]:
+                self._save_lane_bowden_lengths("load")
+            if mode in ["ALL", "UNLOAD"]:
+                self._save_lane_bowden_lengths("unload")
+        if lane is not None:
+            return
 
         # discard load length
         if mode in ["ALL", "LOAD"]:
             self.bowden_load_length = self.config_bowden_length
             self.bowden_load_length_filter.reset()
-            self.gcode.run_script_from_command(
-                'SAVE_VARIABLE VARIABLE=%s VALUE="%s"'
-                % (self.VARS_CALIB_BOWDEN_LOAD_LENGTH, {})
-            )
+            self._save_variable(self.VARS_CALIB_BOWDEN_LOAD_LENGTH, {})
 
         # discard unload length
         if mode in ["ALL", "UNLOAD"]:
             self.bowden_unload_length = self.config_bowden_length
             self.bowden_unload_length_filter.reset()
-            self.gcode.run_script_from_command(
-                'SAVE_VARIABLE VARIABLE=%s VALUE="%s"'
-                % (self.VARS_CALIB_BOWDEN_UNLOAD_LENGTH, {})
-            )
+            self._save_variable(self.VARS_CALIB_BOWDEN_UNLOAD_LENGTH, {})
 
     cmd_TR_SYNC_TO_EXTRUDER_help = (
         "Sync Trad Rack's filament driver to the extruder"
     )
 
     def cmd_TR_SYNC_TO_EXTRUDER(self, gcmd):
-        self.toolhead.wait_moves()
+        wait_for_moves(self.toolhead)
         self.sync_to_extruder = True
         self._restore_extruder_sync()
 
@@ -974,7 +1564,7 @@ class TradRack:
     )
 
     def cmd_TR_UNSYNC_FROM_EXTRUDER(self, gcmd):
-        self.toolhead.wait_moves()
+        wait_for_moves(self.toolhead)
         self.sync_to_extruder = False
         self._restore_extruder_sync()
 
@@ -992,11 +1582,14 @@ class TradRack:
         self._assign_lane(lane, tool)
 
         # mark lane as not dead
-        self.lanes_dead[lane] = False
+        self.lanes[lane].dead = False
 
         # make lane the new default for the tool
         if gcmd.get_int("SET_DEFAULT", 0):
-            self.default_lanes[tool] = lane
+            self.lanes.default_lanes[tool] = lane
+
+        # save tool map
+        self._save_lane_states()
 
     cmd_TR_SET_DEFAULT_LANE_help = "Set the default lane for a tool"
 
@@ -1017,10 +1610,14 @@ class TradRack:
             # set lane as default for the tool
             self._set_default_lane(tool, lane)
 
+        # save tool map
+        self._save_lane_states()
+
     cmd_TR_RESET_TOOL_MAP_help = "Reset tools assigned to each lane"
 
     def cmd_TR_RESET_TOOL_MAP(self, gcmd):
-        self._reset_tool_map()
+        self.lanes.reset_tool_map()
+        self._save_lane_states()
 
     cmd_TR_PRINT_TOOL_MAP_help = "Print tool assignment for each lane"
 
@@ -1031,7 +1628,7 @@ class TradRack:
         for lane in range(self.lane_count):
             lane_str = str(lane)
             lane_msg += " " * (num_chars - len(lane_str)) + lane_str + "|"
-            tool_str = str(self.tool_map[lane])
+            tool_str = str(self.lanes[lane].tool)
             tool_msg += " " * (num_chars - len(tool_str)) + tool_str + "|"
         gcmd.respond_info(lane_msg + "\n" + tool_msg)
 
@@ -1042,41 +1639,162 @@ class TradRack:
         for _ in range(self.lane_count):
             tool_groups.append([])
         for lane in range(self.lane_count):
-            tool_groups[self.tool_map[lane]].append(lane)
+            tool_groups[self.lanes[lane].tool].append(lane)
         msg = ""
         for tool in range(len(tool_groups)):
             msg += "Tool {}: {}".format(tool, tool_groups[tool])
             if len(tool_groups[tool]) > 1:
-                msg += " (default: {})".format(self.default_lanes[tool])
+                msg += " (default: {})".format(self.lanes.default_lanes[tool])
             msg += "\n"
         gcmd.respond_info(msg)
 
+    cmd_TR_SET_LANE_TEMP_help = (
+        "Set the hotend temperature to use when loading a lane"
+    )
+
+    def cmd_TR_SET_LANE_TEMP(self, gcmd):
+        lanes = self._get_lanes_from_params(gcmd)
+        temp = gcmd.get_float("TEMP", None, minval=0.0)
+
+        # print temperatures if no temperature was specified
+        if temp is None:
+            gcmd.respond_info(
+                "\n".join(
+                    "Lane {}: {}".format(
+                        lane, self.lanes[lane].temp or "not set"
+                    )
+                    for lane in lanes
+                )
+            )
+            return
+
+        # check temperature
+        min_extrude_temp = (
+            self.toolhead.get_extruder().get_heater().min_extrude_temp
+        )
+        if temp and temp < min_extrude_temp:
+            raise self.printer.command_error(
+                "TEMP must be 0 or at least min_extrude_temp (%.1f)"
+                % min_extrude_temp
+            )
+
+        # set and save temperatures
+        for lane in lanes:
+            self.lanes[lane].temp = temp
+        self._save_lane_states()
+
+    cmd_TR_SET_LANE_MATERIAL_help = "Set the material loaded in a lane"
+
+    def cmd_TR_SET_LANE_MATERIAL(self, gcmd):
+        lanes = self._get_lanes_from_params(gcmd)
+        material = gcmd.get("MATERIAL", "").strip()
+
+        # check material name (it is saved with save_variables)
+        if not re.match(r"^[\w.+-]*$", material):
+            raise self.printer.command_error(
+                "MATERIAL may only contain letters, digits and the characters"
+                " _.+-"
+            )
+
+        # set and save materials
+        for lane in lanes:
+            self.lanes[lane].material = material
+        self._save_lane_states()
+
+    cmd_TR_SET_LANE_SPOOL_help = (
+        "Set the length of filament on the spool loaded in a lane"
+    )
+
+    def cmd_TR_SET_LANE_SPOOL(self, gcmd):
+        lanes = self._get_lanes_from_params(gcmd)
+        length = gcmd.get_float("LENGTH", 0.0, minval=0.0)
+
+        # set spool length and reset the length used from the spool
+        self._update_consumption()
+        for lane in lanes:
+            self.lanes[lane].set_spool_length(length or None)
+            self.low_lanes_reported.discard(lane)
+        self._save_lane_states()
+
+    cmd_TR_PRINT_LANE_STATES_help = "Print the saved state of each lane"
+
+    def cmd_TR_PRINT_LANE_STATES(self, gcmd):
+        msg = ""
+        for lane in self.lanes:
+            remaining = lane.get_remaining_length()
+            msg += (
+                "Lane {}: tool {}, {}{}, temp {}, material {}, loads {},"
+                " unloads {}, used {:.0f}mm{}\n".format(
+                    lane.index,
+                    lane.tool,
+                    "buffered" if lane.buffered else "not buffered",
+                    (", loaded" if lane.loaded else "")
+                    + (", dead" if lane.dead else ""),
+                    lane.temp or "not set",
+                    lane.material or "not set",
+                    lane.load_count,
+                    lane.unload_count,
+                    lane.consumed_length,
+                    (
+                        ""
+                        if remaining is None
+                        else " ({:.0f}mm left)".format(remaining)
+                    ),
+                )
+            )
+        gcmd.respond_info(msg)
+
+    cmd_TR_STATS_help = "Print time spent in each toolchange phase"
+
+    def cmd_TR_STATS(self, gcmd):
+        if gcmd.get_int("RESET", 0):
+            self.phase_timer.reset()
+            gcmd.respond_info("Toolchange timing statistics reset")
+            return
+        phases = self.phase_timer.get_phases()
+        if not phases:
+            gcmd.respond_info("No toolchange timing statistics recorded")
+            return
+        last_phases = self.phase_timer.get_last_phases()
+        msg = "Phase: count, mean, min, max, total, last (seconds)\n"
+        for phase, stats in sorted(
+            phases.items(), key=lambda item: -item[1]["total"]
+        ):
+            last = last_phases.get(phase)
+            msg += "{}: {}, {:.3f}, {:.3f}, {:.3f}, {:.1f}, {}\n".format(
+                phase,
+                stats["count"],
+                stats["total"] / stats["count"],
+                stats["min"],
+                stats["max"],
+                stats["total"],
+                "-" if last is None else "{:.3f}".format(last),
+            )
+        gcmd.respond_info(msg)
+
     # helper functions
     def _lower_servo(self, toolhead_dwell=False):
-        self.tr_toolhead.wait_moves()
+        # schedule the servo move to start after the queued filament driver
+        # and selector moves
         self.servo.set_servo(angle=self.servo_down_angle)
-        if self.servo_raised or self.servo_raised is None:
-            self.tr_toolhead.dwell(self.servo_wait)
-            if toolhead_dwell:
-                self.toolhead.dwell(self.servo_wait)
-        self.servo_raised = False
+
+        # delay any following moves until the servo has settled
+        self.servo.wait_settled(self.tr_toolhead)
+        if toolhead_dwell:
+            self.servo.wait_settled(self.toolhead)
 
     def _raise_servo(
-        self,
-        toolhead_dwell=False,
-        tr_toolhead_dwell=True,
-        wait_moves=True,
-        print_time=None,
+        self, toolhead_dwell=False, tr_toolhead_dwell=True, print_time=None
     ):
-        if wait_moves:
-            self.tr_toolhead.wait_moves()
+        # schedule the servo move to start after the queued filament driver
+        # and selector moves (or at the given print time)
         self.servo.set_servo(angle=self.servo_up_angle, print_time=print_time)
-        if not self.servo_raised:
-            if tr_toolhead_dwell:
-                self.tr_toolhead.dwell(self.servo_wait)
-            if toolhead_dwell:
-                self.toolhead.dwell(self.servo_wait)
-        self.servo_raised = True
+
+        # delay any following moves until the servo has settled
+        if tr_toolhead_dwell:
+            self.servo.wait_settled(self.tr_toolhead)
+        if toolhead_dwell:
+            self.servo.wait_settled(self.toolhead)
 
     def _is_selector_homed(self):
         return (
@@ -1087,14 +1805,51 @@ class TradRack:
         )
 
     def _query_selector_sensor(self):
-        move_time = self.tr_toolhead.get_last_move_time()
-        return not not self.fil_driver_endstops[0][0].query_endstop(move_time)
+        return self._query_sensor(
+            self.selector_sensor, self.fil_driver_endstops[0][0]
+        )
 
     def _query_toolhead_sensor(self):
         if not self.toolhead_fil_endstops:
             return None
+        return self._query_sensor(
+            self.toolhead_sensor, self.toolhead_fil_endstops[0][0]
+        )
+
+    def _query_sensor(self, sensor, mcu_endstop):
+        # use the last state reported by the sensor if no filament movement
+        # could have changed it since then
+        state = sensor.get_state()
+        if state is not None and self._is_filament_idle():
+            return state
+
+        # query the sensor after any queued moves
         move_time = self.tr_toolhead.get_last_move_time()
-        return not not self.toolhead_fil_endstops[0][0].query_endstop(move_time)
+        state = not not mcu_endstop.query_endstop(move_time)
+        sensor.set_state(state)
+        return state
+
+    def _is_filament_idle(self):
+        # check that the filament driver (and the extruder if it is synced to
+        # the filament driver) has had no moves queued or in progress for long
+        # enough for sensor changes to have been reported
+        toolheads = [self.tr_toolhead]
+        if (
+            self.extruder_sync_manager.is_extruder_synced()
+            or self.extruder_sync_manager.is_fil_driver_synced()
+        ):
+            toolheads.append(self.toolhead)
+        eventtime = self.reactor.monotonic()
+        for th in toolheads:
+            print_time, est_print_time, lookahead_empty = th.check_busy(
+                eventtime
+            )
+            if (
+                not lookahead_empty
+                or print_time + self.SENSOR_REPORT_TIME > est_print_time
+            ):
+                return False
+        return True
 
     def _check_lane_valid(self, lane):
         if lane is None or lane > self.lane_count - 1 or lane < 0:
@@ -1131,7 +1886,7 @@ class TradRack:
         # check if active lane is assigned to next tool
         if (
             self.next_tool is not None
-            and self.tool_map[self.active_lane] == self.next_tool
+            and self.lanes[self.active_lane].tool == self.next_tool
         ):
             return True
 
@@ -1168,6 +1923,9 @@ class TradRack:
         self._raise_servo()
 
         # move to lane
+        self._move_selector(lane)
+
+    def _move_selector(self, lane):
         self.tr_toolhead.get_last_move_time()
         pos = self.tr_toolhead.get_position()
         pos[0] = self.lane_positions[lane]
@@ -1176,20 +1934,99 @@ class TradRack:
         # set current lane
         self.curr_lane = lane
 
-    def _load_lane(self, lane, reset_speed=False, user_load=False):
-        # check lane
-        self._check_lane_valid(lane)
+    def _load_lanes(self, lanes, reset_speed=False):
+        # load several lanes, returns the lists of lanes that were loaded and
+        # lanes that failed to load
+
+        # check that the selector can move between lanes
+        self._check_selector_homed()
+        if self._query_selector_sensor():
+            raise self.printer.command_error(
+                "Cannot load lanes with filament in selector"
+            )
+
+        # visit the lanes in one sweep, starting from the end closest to the
+        # selector
+        lanes = sorted(set(lanes), key=lambda lane: self.lane_positions[lane])
+        selector_pos = self.tr_toolhead.get_position()[0]
+        if lanes and abs(self.lane_positions[lanes[-1]] - selector_pos) < abs(
+            self.lane_positions[lanes[0]] - selector_pos
+        ):
+            lanes.reverse()
+
+        # load each lane, moving on to the next lane as soon as the filament
+        # has been retracted
+        loaded_lanes = []
+        failed_lanes = []
+        for i, lane in enumerate(lanes):
+            next_lane = lanes[i + 1] if i + 1 < len(lanes) else None
+            try:
+                self._load_lane(lane, reset_speed, next_lane=next_lane)
+            except self.printer.command_error:
+                logging.warning(
+                    "trad_rack: Failed to load lane %d" % lane, exc_info=True
+                )
+                failed_lanes.append(lane)
+                self.lanes[lane].dead = True
+
+                # stop if the filament could not be retracted out of the
+                # selector, since the selector cannot move to another lane
+                if self._query_selector_sensor():
+                    msg = "Filament from lane %d is still in the selector" % (
+                        lane
+                    )
+                    if next_lane is not None:
+                        msg += ". Lanes %s were not loaded" % lanes[i + 1 :]
+                    raise self.printer.command_error(msg)
+                continue
+            loaded_lanes.append(lane)
+            self.lanes[lane].dead = False
+        return loaded_lanes, failed_lanes
+
+    def _load_lane(
+        self, lane, reset_speed=False, user_load=False, next_lane=None
+    ):
+        # check lane
+        self._check_lane_valid(lane)
 
         # reset lane speed
         if reset_speed:
-            self.lanes_buffered[lane] = False
+            self.lanes[lane].buffered = False
 
         # load filament into the selector
         self._load_selector(lane, user_load=user_load)
 
-        # retract filament into the module
+        # if the selector will move to another lane next, turn the drive gear
+        # until filament is no longer detected, so the selector is never
+        # moved with filament still in it
         self._reset_fil_driver()
         self.tr_toolhead.get_last_move_time()
+        if next_lane is not None:
+            pos = self.tr_toolhead.get_position()
+            pos[1] -= self.fil_homing_lengths["load selector"]
+            hmove = HomingMove(
+                self.printer, self.fil_driver_endstops, self.tr_toolhead
+            )
+            try:
+                hmove.homing_move(
+                    pos,
+                    self.selector_sense_speed,
+                    probe_pos=True,
+                    triggered=False,
+                )
+            except self.printer.command_error:
+                self._raise_servo()
+                logging.warning(
+                    "trad_rack: Selector homing move failed", exc_info=True
+                )
+                raise self.printer.command_error(
+                    "Failed to retract filament from selector after loading"
+                    " lane %d. Selector sensor still triggered after full"
+                    " movement" % lane
+                )
+            self._reset_fil_driver()
+
+        # retract filament into the module
         pos = self.tr_toolhead.get_position()
         pos[1] -= (
             self.selector_unload_length + self.selector_unload_length_extra
@@ -1203,22 +2040,31 @@ class TradRack:
         # reset filament driver position
         self._reset_fil_driver()
 
-        if not self.keep_servo_down_after_lane_load:
+        if next_lane is not None:
+            # raise servo as soon as the retract ends and start moving to the
+            # next lane without waiting for the retract to finish
+            self._raise_servo()
+            self._move_selector(next_lane)
+        elif not self.keep_servo_down_after_lane_load:
             # raise servo
             self._raise_servo()
 
         if user_load:
             self.gcode.respond_info("Load complete")
 
-    def _wait_for_heater_temp(self, min_temp=0.0, exact_temp=0.0):
+    def _wait_for_heater_temp(self, min_temp=0.0, exact_temp=0.0, lane=None):
         # get current and target temps
         heater = self.toolhead.get_extruder().get_heater()
         smoothed_temp, target_temp = heater.get_temp(self.reactor.monotonic())
         min_extrude_temp = heater.min_extrude_temp
 
+        # use the lane temperature (if set) instead of the last heater target
+        # if the heater needs to be turned on
+        fallback_temp = self._get_lane_temp(lane) or self.last_heater_target
+
         # raise an error if no valid temp has been set
         if (
-            max(min_temp, exact_temp, target_temp, self.last_heater_target)
+            max(min_temp, exact_temp, target_temp, fallback_temp)
             < min_extrude_temp
         ):
             raise self.printer.command_error(
@@ -1233,7 +2079,7 @@ class TradRack:
             elif target_temp > min_usable_temp:
                 temp = save_temp = target_temp
             else:
-                temp = max(min_temp, self.last_heater_target)
+                temp = max(min_temp, fallback_temp)
                 if min_temp >= min_extrude_temp:
                     save_temp = min_temp
                 else:
@@ -1243,14 +2089,30 @@ class TradRack:
             return save_temp
         return target_temp
 
+    def _get_lane_temp(self, lane):
+        if lane is None:
+            return 0.0
+        return self.lanes[lane].temp
+
+    def _get_load_temp(self, lane, min_temp=0.0, exact_temp=0.0):
+        # returns the temperature to heat to before the filament reaches the
+        # hotend, or 0 if no lane temperature applies
+        if exact_temp or not self._get_lane_temp(lane):
+            return 0.0
+        return max(min_temp, self._get_lane_temp(lane))
+
+    def _set_heater_temp(self, temp, wait=False):
+        heater = self.toolhead.get_extruder().get_heater()
+        _, target_temp = heater.get_temp(self.reactor.monotonic())
+        if temp != target_temp or wait:
+            pheaters = self.printer.lookup_object("heaters")
+            pheaters.set_temperature(heater, temp, wait)
+
     def _save_heater_target(self, target_temp=None):
         if target_temp is None:
             heater = self.toolhead.get_extruder().get_heater()
             _, target_temp = heater.get_temp(self.reactor.monotonic())
-        self.gcode.run_script_from_command(
-            'SAVE_VARIABLE VARIABLE=%s VALUE="%s"'
-            % (self.VARS_HEATER_TARGET, target_temp)
-        )
+        self._save_variable(self.VARS_HEATER_TARGET, target_temp)
         self.last_heater_target = target_temp
 
     def _note_heater_temps_for_redundant_toolchange(
@@ -1307,24 +2169,52 @@ class TradRack:
         # check if homed
         self._check_selector_homed()
 
+        # start timing toolchange phases
+        self.phase_timer.start()
+
+        # reset pipelined toolchange state
+        self.pipeline_state = None
+        self.pipeline_time_saved = 0.0
+
         # check and set lengths
-        if bowden_length is None:
-            bowden_length = self.bowden_load_length
         if extruder_load_length is None:
             extruder_load_length = self.extruder_load_length
         if hotend_load_length is None:
             hotend_load_length = self.hotend_load_length
 
-        # wait for heater temp if needed
-        save_temp = self._wait_for_heater_temp(min_temp, exact_temp)
+        # wait for heater temp if needed (if the lane has its own temperature,
+        # the heater is only waited on before loading the hotend)
+        load_temp = self._get_load_temp(lane, min_temp, exact_temp)
+        heater_wait_skipped = bool(load_temp)
+        if load_temp:
+            save_temp = None
+        else:
+            save_temp = self._wait_for_heater_temp(min_temp, exact_temp)
+            self.phase_timer.mark("heater_wait")
+
+        # start a new journal for the toolchange
+        self.toolchange_journal.start(
+            lane=lane, tool=tool, from_lane=self.curr_lane
+        )
 
         # disable runout detection
         self.selector_sensor.set_active(False)
 
         if not (selector_already_loaded and self.curr_lane == lane):
+            # determine whether the selector can move to the new lane while
+            # the old lane is being unloaded
+            if self.pipelined_toolchange and not self.selector_pos_uncertain:
+                pipeline_lane = lane
+            else:
+                pipeline_lane = None
+
             # unload current lane (if filament is detected)
             try:
-                self._unload_toolhead()
+                self._unload_toolhead(
+                    min_temp=min_temp,
+                    next_lane=pipeline_lane,
+                    next_temp=load_temp,
+                )
             except self.printer.command_error:
                 self._raise_servo()
                 if self.curr_lane is None:
@@ -1342,7 +2232,7 @@ class TradRack:
                             lane=str(self.curr_lane)
                         )
                     )
-                    self.lanes_buffered[self.curr_lane] = False
+                    self.lanes[self.curr_lane].buffered = False
                 self.retry_lane = self.curr_lane
                 logging.warning(
                     "trad_rack: Failed to unload toolhead", exc_info=True
@@ -1365,14 +2255,29 @@ class TradRack:
                         "trad_rack: Failed to home selector", exc_info=True
                     )
                     raise SelectorNotHomedError("Failed to home selector")
+                self.phase_timer.mark("home_selector")
+
+        # start heating (or cooling) for the new lane if the unload did not
+        if load_temp:
+            self._set_heater_temp(load_temp)
 
         # notify toolhead load started
         self.printer.send_event("trad_rack:load_started")
 
         # run pre-load custom gcode
         self.pre_load_macro.run_gcode_from_command()
-        self.toolhead.wait_moves()
-        self.tr_toolhead.wait_moves()
+        wait_for_moves(self.toolhead)
+        if self.pipeline_state is None:
+            self.tr_toolhead.wait_moves()
+        else:
+            self._note_pipeline_time_saved()
+        self.phase_timer.mark("pre_load_macro")
+
+        # run concurrent-load custom gcode and start its moves without
+        # waiting for them, so they overlap loading the selector and bowden
+        # tube
+        self.concurrent_load_macro.run_gcode_from_command()
+        self.toolhead.get_last_move_time()
 
         # load filament into the selector
         try:
@@ -1404,6 +2309,15 @@ class TradRack:
         # update lane and next_lane in case the selector was loaded from a lane
         # other than what was initially specified
         lane = self.next_lane = selected_lane
+        self.toolchange_journal.record("selector_loaded", lane=lane)
+
+        # get bowden length for the selected lane
+        if bowden_length is None:
+            bowden_length = (
+                self._get_bowden_load_length(lane)
+                + self.target_toolhead_homing_dist
+                - self._get_bowden_homing_dist("load", lane)
+            )
 
         # move filament through the bowden tube
         self._reset_fil_driver()
@@ -1411,10 +2325,11 @@ class TradRack:
         pos = self.tr_toolhead.get_position()
         move_start = pos[1]
         pos[1] += bowden_length
-        if self.lanes_buffered[self.curr_lane]:
-            speed = self.buffer_pull_speed
+        if self.lanes[self.curr_lane].buffered:
+            speed_state = "buffer"
         else:
-            speed = self.spool_pull_speed
+            speed_state = "spool"
+        speed = self._get_bowden_speed("load", lane, speed_state)
         reached_sensor_early = True
         if self.load_with_toolhead_sensor and self.toolhead_fil_endstops:
             hmove = HomingMove(
@@ -1431,9 +2346,19 @@ class TradRack:
         self.tr_toolhead.move(pos, speed)
         base_length = pos[1] - move_start
 
-        # sync extruder to filament driver
+        # wait for concurrent-load moves before the extruder is synced to the
+        # filament driver
         self.tr_toolhead.wait_moves()
+        self.phase_timer.mark("bowden_load")
+        self.toolchange_journal.record(
+            "bowden_loaded", lane=lane, length=base_length
+        )
+        wait_for_moves(self.toolhead)
+        self.phase_timer.mark("concurrent_load_macro")
+
+        # sync extruder to filament driver
         self.extruder_sync_manager.sync_extruder_to_fil_driver()
+        self.phase_timer.mark("extruder_sync")
 
         # move filament until toolhead sensor is triggered
         if self.load_with_toolhead_sensor and self.toolhead_fil_endstops:
@@ -1466,35 +2391,58 @@ class TradRack:
                     "Failed to load toolhead. No trigger on toolhead sensor"
                     " after full movement"
                 )
+            self.phase_timer.mark("toolhead_sense")
 
-            # update bowden_load_length
-            length = (
-                trigpos[1]
-                - move_start
-                + base_length
-                - self.target_toolhead_homing_dist
-            )
-            old_set_length = self.bowden_load_length
-            self.bowden_load_length = self.bowden_load_length_filter.update(
-                length
-            )
-            samples = self.bowden_load_length_filter.get_entry_count()
-            if self.log_bowden_lengths:
-                self._write_bowden_length_data(
-                    self.bowden_load_lengths_filename,
-                    length,
-                    old_set_length,
-                    self.bowden_load_length,
-                    samples,
+            # skip updating the bowden speed and length if the filament did
+            # not start at the selector (when resuming an interrupted load)
+            if self.ignore_next_load_length:
+                self.ignore_next_load_length = False
+            else:
+                # update bowden speed
+                self._update_bowden_speed(
+                    "load",
+                    lane,
+                    speed_state,
+                    trigpos[1] - move_start + base_length,
                 )
-            self._save_bowden_length("load", self.bowden_load_length, samples)
-            if not (self.bowden_load_calibrated or reached_sensor_early):
-                self.bowden_load_calibrated = True
-                self.gcode.respond_info(
-                    "Calibrated bowden_load_length: {}".format(
-                        self.bowden_load_length
+
+                # update bowden_load_length
+                length = (
+                    trigpos[1]
+                    - move_start
+                    + base_length
+                    - self.target_toolhead_homing_dist
+                )
+                self.lanes[lane].last_load_length = length
+                old_set_length = self.bowden_load_length
+                self.bowden_load_length = self.bowden_load_length_filter.update(
+                    length
+                )
+                samples = self.bowden_load_length_filter.get_entry_count()
+                if self.log_bowden_lengths:
+                    self._write_bowden_length_data(
+                        self.bowden_load_lengths_filename,
+                        length,
+                        old_set_length,
+                        self.bowden_load_length,
+                        samples,
                     )
+                self._save_bowden_length(
+                    "load",
+                    self.bowden_load_length,
+                    self.bowden_load_length_filter,
                 )
+                if self.per_lane_bowden_lengths:
+                    self._update_lane_bowden_length(
+                        "load", lane, length, not reached_sensor_early
+                    )
+                elif not (self.bowden_load_calibrated or reached_sensor_early):
+                    self.bowden_load_calibrated = True
+                    self.gcode.respond_info(
+                        "Calibrated bowden_load_length: {}".format(
+                            self.bowden_load_length
+                        )
+                    )
 
         # finish loading filament into extruder
         self._reset_fil_driver()
@@ -1502,6 +2450,19 @@ class TradRack:
         pos[1] += extruder_load_length
         self.tr_toolhead.move(pos, self.extruder_load_speed)
 
+        # wait for the lane's temperature before the filament enters the
+        # hotend (in case the selector loaded a different lane than requested)
+        load_temp = self._get_load_temp(lane, min_temp, exact_temp)
+        if load_temp:
+            self._set_heater_temp(load_temp, wait=True)
+            save_temp = load_temp
+            self.phase_timer.mark("heater_wait")
+        elif heater_wait_skipped:
+            # the lane loaded has no temperature of its own, so do the wait
+            # that was skipped for the requested lane
+            save_temp = self._wait_for_heater_temp(min_temp, exact_temp)
+            self.phase_timer.mark("heater_wait")
+
         # load filament into hotend
         pos[1] += hotend_load_length
         self.tr_toolhead.move(pos, self.hotend_load_speed)
@@ -1527,20 +2488,18 @@ class TradRack:
             + servo_delay
         )
         if not self.sync_to_extruder:
-            self._raise_servo(
-                tr_toolhead_dwell=False, wait_moves=False, print_time=print_time
-            )
-
-            # wait for servo move if necessary
-            if servo_delay:
-                self.tr_toolhead.dwell(servo_delay)
+            self._raise_servo(print_time=print_time)
 
         # set active lane
         self._set_active_lane(lane)
+        self.lanes[lane].load_count += 1
 
         # unsync extruder from filament driver
         self.tr_toolhead.wait_moves()
+        self.phase_timer.mark("hotend_load")
+        self.toolchange_journal.finish("loaded", lane=lane)
         self._restore_extruder_sync()
+        self.phase_timer.mark("extruder_unsync")
 
         # make lane the new default for its assigned tool
         self._make_lane_default(lane)
@@ -1554,8 +2513,9 @@ class TradRack:
 
         # run post-load custom gcode
         self.post_load_macro.run_gcode_from_command()
-        self.toolhead.wait_moves()
+        wait_for_moves(self.toolhead)
         self.tr_toolhead.wait_moves()
+        self.phase_timer.mark("post_load_macro")
 
         # restore gcode state
         self.gcode.run_script_from_command(
@@ -1568,13 +2528,24 @@ class TradRack:
         self.next_lane = None
         self.next_tool = None
 
+        # finish timing toolchange phases
+        self.phase_timer.finish("toolchange")
+
+        # save variables changed during the toolchange
+        self._save_lane_states()
+        self._flush_saved_variables()
+
         # notify toolhead load complete
         self.printer.send_event("trad_rack:load_complete")
 
     def _load_selector(self, lane, tool=None, user_load=False):
         try:
             self._do_load_selector(lane, user_load=user_load)
+            self.lanes[lane].failed_loads = 0
+            self.lanes[lane].loaded = True
         except self.printer.command_error:
+            self.lanes[lane].failed_loads += 1
+            self.lanes[lane].loaded = False
             if tool is None:
                 raise
             else:
@@ -1591,13 +2562,16 @@ class TradRack:
     def _do_load_selector(self, lane, user_load=False):
         # move selector
         self._go_to_lane(lane)
+        self.phase_timer.mark("selector_move")
 
         # lower servo
         self._lower_servo()
-        self.tr_toolhead.wait_moves()
+        self.pipeline_state = None
+        self.phase_timer.mark("servo_lower")
 
         # prompt user to insert filament
         if user_load:
+            self.tr_toolhead.wait_moves()
             self.gcode.respond_info(
                 "Please insert filament in lane %d" % (lane)
             )
@@ -1625,9 +2599,14 @@ class TradRack:
                 "Failed to load filament into selector. No trigger on selector"
                 " sensor after full movement"
             )
+        self.phase_timer.mark("selector_sense")
 
     def _unload_selector(
-        self, base_length=None, mark_calibrated=False, eject=False
+        self,
+        base_length=None,
+        mark_calibrated=False,
+        eject=False,
+        next_lane=None,
     ):
         # check for filament in selector
         if not self._query_selector_sensor():
@@ -1666,15 +2645,24 @@ class TradRack:
                     "Failed to unload filament from selector. Selector sensor"
                     " still triggered after full movement"
                 )
+            self.phase_timer.mark("selector_sense")
 
             # update bowden_unload_length
             if base_length is not None and not self.ignore_next_unload_length:
+                self._update_bowden_speed(
+                    "unload",
+                    self.curr_lane,
+                    "buffer",
+                    move_start - trigpos[1] + base_length,
+                )
                 length = (
                     move_start
                     - trigpos[1]
                     + base_length
                     - self.target_selector_homing_dist
                 )
+                if self.curr_lane is not None:
+                    self.lanes[self.curr_lane].last_unload_length = length
                 old_set_length = self.bowden_unload_length
                 self.bowden_unload_length = (
                     self.bowden_unload_length_filter.update(length)
@@ -1689,9 +2677,15 @@ class TradRack:
                         samples,
                     )
                 self._save_bowden_length(
-                    "unload", self.bowden_unload_length, samples
+                    "unload",
+                    self.bowden_unload_length,
+                    self.bowden_unload_length_filter,
                 )
-                if mark_calibrated:
+                if self.per_lane_bowden_lengths and self.curr_lane is not None:
+                    self._update_lane_bowden_length(
+                        "unload", self.curr_lane, length, mark_calibrated
+                    )
+                elif mark_calibrated:
                     self.bowden_unload_calibrated = True
                     self.gcode.respond_info(
                         "Calibrated bowden_unload_length: {}".format(
@@ -1720,8 +2714,19 @@ class TradRack:
         # reset filament driver position
         self._reset_fil_driver()
 
-        # raise servo
-        self._raise_servo()
+        if next_lane is None:
+            # raise servo
+            self._raise_servo()
+        else:
+            # raise servo as soon as the retract ends and start moving to the
+            # next lane without waiting for the retract to finish
+            retract_end = self.tr_toolhead.get_last_move_time()
+            self._raise_servo()
+            travel_start = self.tr_toolhead.get_last_move_time()
+            self._move_selector(next_lane)
+            travel_time = self.tr_toolhead.get_last_move_time() - travel_start
+            self.pipeline_state = (retract_end, travel_time)
+        self.phase_timer.mark("selector_unload")
 
     def _unload_toolhead(
         self,
@@ -1730,12 +2735,14 @@ class TradRack:
         force_unload=False,
         sync=False,
         eject=False,
+        next_lane=None,
+        next_temp=0.0,
     ):
         selector_sensor_state = self._query_selector_sensor()
         toolhead_sensor_state = self._query_toolhead_sensor()
 
         # check for filament
-        self.toolhead.wait_moves()
+        wait_for_moves(self.toolhead)
         if not (force_unload or selector_sensor_state or toolhead_sensor_state):
             # reset ignore_next_unload_length
             self.ignore_next_unload_length = False
@@ -1761,12 +2768,14 @@ class TradRack:
 
         # disable runout detection
         self.selector_sensor.set_active(False)
+        self.toolchange_journal.record("unload", lane=self.curr_lane)
 
         # notify toolhead unload started
         self.printer.send_event("trad_rack:unload_started")
 
         # wait for heater temp if needed
-        self._wait_for_heater_temp(min_temp, exact_temp)
+        self._wait_for_heater_temp(min_temp, exact_temp, self.curr_lane)
+        self.phase_timer.mark("heater_wait")
 
         # sync filament driver to extruder for pre-unload custom gcode
         if sync:
@@ -1776,21 +2785,26 @@ class TradRack:
         # run pre-unload custom gcode
         try:
             self.pre_unload_macro.run_gcode_from_command()
-            self.toolhead.wait_moves()
+            wait_for_moves(self.toolhead)
             self.tr_toolhead.wait_moves()
-        finally:
+        except Exception:
             # unsync filament driver from extruder
             self.extruder_sync_manager.unsync()
-
+            raise
+        finally:
             # reset active lane
             self._set_active_lane(None)
+        self.phase_timer.mark("pre_unload_macro")
 
         # lower servo
         self._lower_servo(True)
 
-        # sync extruder to filament driver
+        # sync extruder to filament driver (switching directly from the
+        # filament driver being synced to the extruder, if it is)
         self.tr_toolhead.wait_moves()
+        self.phase_timer.mark("servo_lower")
         self.extruder_sync_manager.sync_extruder_to_fil_driver()
+        self.phase_timer.mark("extruder_sync")
 
         # move filament until toolhead sensor is untriggered
         if self.unload_with_toolhead_sensor and self.toolhead_fil_endstops:
@@ -1814,6 +2828,7 @@ class TradRack:
                     "Failed to unload toolhead. Toolhead sensor still triggered"
                     " after full movement"
                 )
+            self.phase_timer.mark("toolhead_sense")
 
         # get filament out of the extruder
         self._reset_fil_driver()
@@ -1823,51 +2838,164 @@ class TradRack:
 
         # unsync extruder from filament driver
         self.tr_toolhead.wait_moves()
+        self.phase_timer.mark("toolhead_unload")
         self.extruder_sync_manager.unsync()
+        self.phase_timer.mark("extruder_unsync")
+
+        # start heating (or cooling) for the next lane now that the filament
+        # is out of the hotend
+        if next_temp:
+            self._set_heater_temp(next_temp)
+
+        # run concurrent-unload custom gcode and start its moves without
+        # waiting for them, so they overlap the rest of the unload
+        self.concurrent_unload_macro.run_gcode_from_command()
+        self.toolhead.get_last_move_time()
 
         # move filament through the bowden tube
         self.tr_toolhead.get_last_move_time()
         pos = self.tr_toolhead.get_position()
         move_start = pos[1]
-        pos[1] -= self.bowden_unload_length
+        pos[1] -= (
+            self._get_bowden_unload_length(self.curr_lane)
+            + self.target_selector_homing_dist
+            - self._get_bowden_homing_dist("unload", self.curr_lane)
+        )
         hmove = HomingMove(
             self.printer, self.fil_driver_endstops, self.tr_toolhead
         )
+        speed = self._get_bowden_speed("unload", self.curr_lane, "buffer")
         reached_sensor_early = True
         try:
             # move and check for early sensor trigger
             trigpos = hmove.homing_move(
-                pos, self.buffer_pull_speed, probe_pos=True, triggered=False
+                pos, speed, probe_pos=True, triggered=False
             )
 
             # if sensor triggered early, retract before next homing move
             pos[1] = trigpos[1] + self.fil_homing_retract_dist
         except self.printer.command_error:
             reached_sensor_early = False
-        self.tr_toolhead.move(pos, self.buffer_pull_speed)
+        self.tr_toolhead.move(pos, speed)
+        self.phase_timer.mark("bowden_unload")
 
         # unload selector
-        mark_calibrated = not (
-            self.bowden_unload_calibrated or reached_sensor_early
+        unloaded_lane = self.curr_lane
+        if self.per_lane_bowden_lengths and self.curr_lane is not None:
+            unload_calibrated = self.lanes_bowden_unload_calibrated[
+                self.curr_lane
+            ]
+        else:
+            unload_calibrated = self.bowden_unload_calibrated
+        mark_calibrated = not (unload_calibrated or reached_sensor_early)
+        self._unload_selector(
+            move_start - pos[1], mark_calibrated, eject, next_lane
         )
-        self._unload_selector(move_start - pos[1], mark_calibrated, eject)
 
-        # note that the current lane's buffer has been filled
-        if self.curr_lane is not None:
-            self.lanes_buffered[self.curr_lane] = True
+        # note that the unloaded lane's buffer has been filled
+        if unloaded_lane is not None:
+            self.lanes[unloaded_lane].buffered = True
+            self.lanes[unloaded_lane].loaded = not eject
+            self.lanes[unloaded_lane].unload_count += 1
+        self.toolchange_journal.record("unloaded", lane=unloaded_lane)
 
         # reset ignore_next_unload_length
         self.ignore_next_unload_length = False
 
         # run post-unload custom gcode
         self.post_unload_macro.run_gcode_from_command()
-        self.toolhead.wait_moves()
-        self.tr_toolhead.wait_moves()
+        wait_for_moves(self.toolhead)
+        if self.pipeline_state is None:
+            self.tr_toolhead.wait_moves()
+        self.phase_timer.mark("post_unload_macro")
 
         # notify toolhead unload complete
         self.printer.send_event("trad_rack:unload_complete")
 
+    def _note_pipeline_time_saved(self):
+        retract_end, travel_time = self.pipeline_state
+        prime_time = toolhead.BUFFER_TIME_START
+
+        # estimate when the selector would have been ready to load the next
+        # lane if the unload had waited for the retract and servo to finish
+        # (the toolhead then has to be primed again before the selector move)
+        print_time = self.tr_toolhead.mcu.estimated_print_time(
+            self.reactor.monotonic()
+        )
+        serial_ready_time = (
+            max(print_time, retract_end + self.servo_wait)
+            + prime_time
+            + travel_time
+            + self.servo_wait
+        )
+
+        # get when the selector will be ready with the moves already queued
+        ready_time = self.tr_toolhead.get_last_move_time() + self.servo_wait
+
+        self.pipeline_time_saved = max(0.0, serial_ready_time - ready_time)
+        logging.info(
+            "trad_rack: Pipelined toolchange saved %.3f seconds"
+            % self.pipeline_time_saved
+        )
+
+    def _is_printing_file(self, eventtime):
+        # returns True if a file is being printed and the print is not paused
+        sdcard = self.printer.lookup_object("virtual_sdcard", None)
+        if sdcard is None or not sdcard.get_status(eventtime).get("is_active"):
+            return False
+        pause_resume = self.printer.lookup_object("pause_resume")
+        return not pause_resume.get_status(eventtime)["is_paused"]
+
+    def _prefetch_next_toolchange(self, eventtime):
+        # skip if no file is being printed or the print is paused
+        if not self._is_printing_file(eventtime):
+            return
+
+        # find the next toolchange in the print file that would change the
+        # loaded lane
+        skip_lanes = [self.active_lane, self.next_lane]
+        self.prefetch_tool, self.prefetch_lane = None, None
+        for tool, lane in self.tool_prefetcher.find_toolchanges(eventtime):
+            if lane is None:
+                if tool >= self.lane_count:
+                    continue
+                lane = self.lanes.default_lanes[tool]
+                if lane is not None:
+                    reserve_lane = self._find_reserve_lane(lane)
+                    if reserve_lane is not None:
+                        lane = reserve_lane
+            if lane is None or lane >= self.lane_count or lane in skip_lanes:
+                continue
+            self.prefetch_tool, self.prefetch_lane = tool, lane
+            break
+        else:
+            return
+
+        # move the selector to the lane ahead of time (only if no filament is
+        # loaded, since the selector cannot move with filament in it)
+        with self.gcode.get_mutex():
+            if not (
+                self._is_printing_file(self.reactor.monotonic())
+                and self.active_lane is None
+                and self.next_lane is None
+                and self.curr_lane != self.prefetch_lane
+                and self._is_selector_homed()
+                and not self.selector_pos_uncertain
+            ):
+                return
+            if self._query_selector_sensor():
+                return
+            self._go_to_lane(self.prefetch_lane)
+            logging.info(
+                "trad_rack: Moved selector to lane %d for the next toolchange"
+                % self.prefetch_lane
+            )
+
     def _send_pause(self):
+        # save variables before pausing
+        self._save_lane_states()
+        self._flush_saved_variables()
+
         pause_resume = self.printer.lookup_object("pause_resume")
         if pause_resume.get_status(self.reactor.monotonic())["is_paused"]:
             return
@@ -1892,20 +3020,81 @@ class TradRack:
         self.resume_macro.run_gcode_from_command()
 
     def _set_active_lane(self, lane):
+        self._update_consumption()
         self.active_lane = lane
         if self.save_active_lane:
+            self._save_variable(self.VARS_ACTIVE_LANE, lane)
+
+    def _save_lane_states(self):
+        # save lane states (and the tool map if enabled) if they have changed
+        lane_states = self.lanes.get_lane_states()
+        if lane_states != self.saved_lane_states:
+            self._save_variable(self.VARS_LANE_STATES, lane_states)
+            self.saved_lane_states = lane_states
+        if self.save_tool_map:
+            tool_status = self.lanes.get_tool_status()
+            if tool_status != self.saved_tool_status:
+                self._save_variable(self.VARS_TOOL_STATUS, tool_status)
+                self.saved_tool_status = tool_status
+
+    def _save_variable(self, name, value):
+        if not self.save_variables_delay:
             self.gcode.run_script_from_command(
-                'SAVE_VARIABLE VARIABLE=%s VALUE="%s"'
-                % (self.VARS_ACTIVE_LANE, lane)
+                'SAVE_VARIABLE VARIABLE=%s VALUE="%s"' % (name, value)
             )
+            return
 
-    def _reset_tool_map(self):
-        self.tool_map = list(range(self.lane_count))
-        self.default_lanes = list(range(self.lane_count))
+        # mark variable to be saved with other changed variables after a
+        # delay (or when the current toolchange is done)
+        if not self.dirty_variables:
+            self.reactor.update_timer(
+                self.save_variables_timer,
+                self.reactor.monotonic() + self.save_variables_delay,
+            )
+        self.dirty_variables[name] = value
+
+    def _flush_saved_variables(self):
+        self.reactor.update_timer(self.save_variables_timer, self.reactor.NEVER)
+        if not self.dirty_variables:
+            return
+        variables, self.dirty_variables = self.dirty_variables, {}
+
+        # save all changed variables with a single write of the variables
+        # file (save_variables writes all variables it holds each time)
+        save_variables = self.printer.lookup_object("save_variables")
+        saved_variables = dict(save_variables.allVariables)
+        name, value = variables.popitem()
+        save_variables.allVariables.update(variables)
+        try:
+            save_variables.cmd_SAVE_VARIABLE(
+                self.gcode.create_gcode_command(
+                    "SAVE_VARIABLE",
+                    "SAVE_VARIABLE",
+                    {"VARIABLE": name, "VALUE": repr(value)},
+                )
+            )
+        except self.printer.command_error:
+            # keep the variables in memory matching the file and save the
+            # changed variables again next time (unless changed since)
+            save_variables.allVariables = saved_variables
+            variables[name] = value
+            variables.update(self.dirty_variables)
+            self.dirty_variables = variables
+            raise
+
+    def _handle_save_variables_timer(self, eventtime):
+        # wait until the end of the toolchange if one is in progress
+        if self.phase_timer.is_active():
+            return eventtime + self.save_variables_delay
+
+        try:
+            self._flush_saved_variables()
+        except self.printer.command_error:
+            logging.exception("trad_rack: Failed to save variables")
+        return self.reactor.NEVER
 
     def _find_replacement_lane(self, runout_lane, check_runout_lane=True):
-        tool = self.tool_map[runout_lane]
-        pre_dead_lanes = []
+        tool = self.lanes[runout_lane].tool
 
         # home if selector position is uncertain
         if self.selector_pos_uncertain:
@@ -1913,71 +3102,153 @@ class TradRack:
                 self.gcode.create_gcode_command("TR_HOME", "TR_HOME", {})
             )
 
-        # 1st pass - check lanes not marked as dead
-        lane = (runout_lane + 1) % self.lane_count
-        while True:
+        # get lanes to check (in round-robin order starting after the runout
+        # lane to break ties)
+        candidates = []
+        for i in range(1, self.lane_count + 1):
+            lane = (runout_lane + i) % self.lane_count
             if lane == runout_lane and not check_runout_lane:
-                break
-            if self.tool_map[lane] == tool:
-                if self.lanes_dead[lane]:
-                    pre_dead_lanes.append(lane)
-                else:
-                    try:
-                        self._load_selector(lane)
-                        self.default_lanes[tool] = lane
-                        return lane
-                    except self.printer.command_error:
-                        self.lanes_dead[lane] = True
-            if lane == runout_lane:
-                break
-            lane = (lane + 1) % self.lane_count
-
-        # 2nd pass - check lanes previously marked as dead
-        for lane in pre_dead_lanes:
+                continue
+            if self.lanes[lane].tool == tool:
+                candidates.append(lane)
+
+        # try the lanes that are most likely to load first, and the lanes
+        # closest to the selector first among lanes that are equally likely
+        while candidates:
+            selector_pos = self.tr_toolhead.get_position()[0]
+            lane = min(
+                candidates,
+                key=lambda candidate: (
+                    -self._get_lane_health(candidate),
+                    abs(self.lane_positions[candidate] - selector_pos),
+                ),
+            )
+            candidates.remove(lane)
             try:
                 self._load_selector(lane)
-                self.lanes_dead[lane] = False
-                self.default_lanes[tool] = lane
-                return lane
             except self.printer.command_error:
-                pass
+                self.lanes[lane].dead = True
+                continue
+            self.lanes[lane].dead = False
+            self.lanes.default_lanes[tool] = lane
+            return lane
         return None
 
+    def _get_lane_health(self, lane):
+        # estimate how likely the lane is to load (higher is better)
+        health = self.lanes[lane].get_health()
+        if self._is_lane_low(lane):
+            health -= 1
+        return health
+
     def _set_default_lane(self, tool, lane=None):
         # set lane that was passed in
         if lane is not None:
             self._assign_lane(lane, tool)
-            self.default_lanes[tool] = lane
+            self.lanes.default_lanes[tool] = lane
             return
 
         # find a lane that is already assigned to the tool
         for lane in range(self.lane_count):
-            if self.tool_map[lane] == tool:
-                self.default_lanes[tool] = lane
+            if self.lanes[lane].tool == tool:
+                self.lanes.default_lanes[tool] = lane
                 return
-        self.default_lanes[tool] = None
+        self.lanes.default_lanes[tool] = None
 
     def _make_lane_default(self, lane):
-        self.default_lanes[self.tool_map[lane]] = lane
+        self.lanes.default_lanes[self.lanes[lane].tool] = lane
 
     def _assign_lane(self, lane, tool):
-        prev_tool = self.tool_map[lane]
+        prev_tool = self.lanes[lane].tool
 
         # assign lane to tool
-        self.tool_map[lane] = tool
+        self.lanes[lane].tool = tool
 
         # reassign default lane for previous tool if needed
-        if self.default_lanes[prev_tool] == lane:
+        if self.lanes.default_lanes[prev_tool] == lane:
             self._set_default_lane(prev_tool)
 
         # ensure new tool has a default lane assigned
-        if self.default_lanes[tool] is None:
-            self.default_lanes[tool] = lane
+        if self.lanes.default_lanes[tool] is None:
+            self.lanes.default_lanes[tool] = lane
+
+    def _update_consumption(self):
+        # add the filament extruded since the last update to the active lane
+        if self.toolhead is None:
+            return
+        pos = self.toolhead.get_position()[3]
+        if (
+            self.active_lane is not None
+            and self.consumption_start_pos is not None
+        ):
+            self.lanes[self.active_lane].add_consumed_length(
+                pos - self.consumption_start_pos
+            )
+        self.consumption_start_pos = pos
+
+    def _handle_consumption_timer(self, eventtime):
+        self._update_consumption()
+
+        # report if the active lane is expected to run out
+        lane = self.active_lane
+        if (
+            lane is not None
+            and lane not in self.low_lanes_reported
+            and self._is_lane_low(lane)
+        ):
+            self.low_lanes_reported.add(lane)
+            reserve_lane = self._find_reserve_lane(lane)
+            if reserve_lane is None:
+                msg = "No other lane is available for tool {}".format(
+                    self.lanes[lane].tool
+                )
+            else:
+                msg = "Lane {} will be loaded at the next toolchange".format(
+                    reserve_lane
+                )
+            self.gcode.respond_info(
+                "Lane {} is expected to run out ({:.0f}mm left). {}".format(
+                    lane, self.lanes[lane].get_remaining_length(), msg
+                )
+            )
+        return eventtime + self.CONSUMPTION_UPDATE_TIME
+
+    def _is_lane_low(self, lane):
+        remaining = self.lanes[lane].get_remaining_length()
+        return remaining is not None and remaining <= self.runout_reserve_length
+
+    def _find_reserve_lane(self, lane):
+        # find a lane to use instead of the given lane if it is expected to run
+        # out (returns None if the lane is fine or there is no other lane)
+        if not self._is_lane_low(lane):
+            return None
+        tool = self.lanes[lane].tool
+        for i in range(1, self.lane_count):
+            other_lane = (lane + i) % self.lane_count
+            if (
+                self.lanes[other_lane].tool == tool
+                and not self.lanes[other_lane].dead
+                and not self._is_lane_low(other_lane)
+            ):
+                return other_lane
+        return None
+
+    def _get_lanes_from_params(self, gcmd):
+        # get the specified lane or the lanes assigned to the specified tool
+        lane = gcmd.get_int("LANE", None)
+        tool = gcmd.get_int("TOOL", None)
+        if lane is not None:
+            self._check_lane_valid(lane)
+            return [lane]
+        if tool is not None:
+            self._check_tool_valid(tool)
+            return self._get_assigned_lanes(tool)
+        raise self.printer.command_error("LANE or TOOL must be specified")
 
     def _get_assigned_lanes(self, tool):
         lanes = []
         for lane in range(self.lane_count):
-            if self.tool_map[lane] == tool:
+            if self.lanes[lane].tool == tool:
                 lanes.append(lane)
         return lanes
 
@@ -2009,7 +3280,7 @@ class TradRack:
                 self.runout_lane, check_runout_lane=check_runout_lane
             )
             if lane is None:
-                runout_tool = self.tool_map[self.runout_lane]
+                runout_tool = self.lanes[self.runout_lane].tool
                 assigned_lanes = self._get_assigned_lanes(runout_tool)
                 self.gcode.respond_info(
                     "No replacement lane found for tool {tool}. The following"
@@ -2037,43 +3308,145 @@ class TradRack:
     def _write_bowden_length_data(
         self, filename, length, old_set_length, new_set_length, samples
     ):
-        try:
-            with open(filename, "a+") as f:
-                if os.stat(filename).st_size == 0:
-                    f.write(
-                        "time,length,diff_from_set_length,new_set_length,"
-                        "new_sample_count\n"
-                    )
-                f.write(
-                    "{},{:.3f},{:.3f},{:.3f},{}\n".format(
-                        time.strftime("%Y%m%d_%H%M%S"),
-                        length,
-                        length - old_set_length,
-                        new_set_length,
-                        samples,
-                    )
-                )
-        except IOError as e:
-            raise self.printer.command_error(
-                "Error writing to file '%s': %s", filename, str(e)
-            )
+        # queue the line to be written by the log writer thread
+        self.log_writer.write(
+            filename,
+            "time,length,diff_from_set_length,new_set_length,"
+            "new_sample_count\n",
+            "{},{:.3f},{:.3f},{:.3f},{}\n".format(
+                time.strftime("%Y%m%d_%H%M%S"),
+                length,
+                length - old_set_length,
+                new_set_length,
+                samples,
+            ),
+        )
 
-    def _save_bowden_length(self, mode, new_set_length, samples):
+    def _get_length_stats(self, new_set_length, length_filter):
         length_stats = {
             "new_set_length": new_set_length,
-            "sample_count": samples,
+            "sample_count": length_filter.get_entry_count(),
         }
+        length_stats.update(length_filter.get_saved_stats())
+        return length_stats
+
+    def _save_bowden_length(self, mode, new_set_length, length_filter):
+        length_stats = self._get_length_stats(new_set_length, length_filter)
         if mode == "load":
-            self.gcode.run_script_from_command(
-                'SAVE_VARIABLE VARIABLE=%s VALUE="%s"'
-                % (self.VARS_CALIB_BOWDEN_LOAD_LENGTH, length_stats)
+            self._save_variable(
+                self.VARS_CALIB_BOWDEN_LOAD_LENGTH, length_stats
             )
         else:
-            self.gcode.run_script_from_command(
-                'SAVE_VARIABLE VARIABLE=%s VALUE="%s"'
-                % (self.VARS_CALIB_BOWDEN_UNLOAD_LENGTH, length_stats)
+            self._save_variable(
+                self.VARS_CALIB_BOWDEN_UNLOAD_LENGTH, length_stats
             )
 
+    def _get_bowden_load_length(self, lane):
+        if self.per_lane_bowden_lengths and lane is not None:
+            length = self.lane_bowden_load_lengths[lane]
+            if length is not None:
+                return length
+        return self.bowden_load_length
+
+    def _get_bowden_unload_length(self, lane):
+        if self.per_lane_bowden_lengths and lane is not None:
+            length = self.lane_bowden_unload_lengths[lane]
+            if length is not None:
+                return length
+        return self.bowden_unload_length
+
+    def _get_bowden_homing_dist(self, mode, lane):
+        if mode == "load":
+            target = self.target_toolhead_homing_dist
+            min_dist = self.min_toolhead_homing_dist
+            length_filter = self.bowden_load_length_filter
+            lane_filters = self.lane_bowden_load_length_filters
+        else:
+            target = self.target_selector_homing_dist
+            min_dist = self.min_selector_homing_dist
+            length_filter = self.bowden_unload_length_filter
+            lane_filters = self.lane_bowden_unload_length_filters
+
+        # use the target distance unless the spread of the bowden length
+        # measurements is known
+        if not self.robust_bowden_length_filter:
+            return target
+        if (
+            self.per_lane_bowden_lengths
+            and lane is not None
+            and lane_filters[lane].has_spread()
+        ):
+            length_filter = lane_filters[lane]
+        if not length_filter.has_spread():
+            return target
+
+        # leave enough distance for the slower homing move to account for
+        # the measured variance
+        spread = length_filter.get_spread()
+        return min(
+            target, max(min_dist, self.bowden_length_outlier_sigma * spread)
+        )
+
+    def _get_bowden_speed(self, mode, lane, state):
+        if self.adaptive_bowden_speeds and lane is not None:
+            return self.bowden_speed_profiles[mode][lane].get_speed(state)
+        if state == "spool":
+            return self.spool_pull_speed
+        return self.buffer_pull_speed
+
+    def _update_bowden_speed(self, mode, lane, state, distance):
+        if not self.adaptive_bowden_speeds or lane is None:
+            return
+        profile = self.bowden_speed_profiles[mode][lane]
+        old_speed = profile.get_speed(state)
+        new_speed = profile.update(state, distance)
+        if new_speed < old_speed:
+            logging.info(
+                "trad_rack: Filament slip detected during bowden %s move of"
+                " lane %d, reducing speed from %.1f to %.1f"
+                % (mode, lane, old_speed, new_speed)
+            )
+
+    def _update_lane_bowden_length(self, mode, lane, length, mark_calibrated):
+        if mode == "load":
+            lengths = self.lane_bowden_load_lengths
+            filters = self.lane_bowden_load_length_filters
+            calibrated = self.lanes_bowden_load_calibrated
+        else:
+            lengths = self.lane_bowden_unload_lengths
+            filters = self.lane_bowden_unload_length_filters
+            calibrated = self.lanes_bowden_unload_calibrated
+
+        # update length
+        lengths[lane] = filters[lane].update(length)
+        self._save_lane_bowden_lengths(mode)
+        if mark_calibrated and not calibrated[lane]:
+            calibrated[lane] = True
+            self.gcode.respond_info(
+                "Calibrated bowden_{}_length for lane {}: {}".format(
+                    mode, lane, lengths[lane]
+                )
+            )
+
+    def _save_lane_bowden_lengths(self, mode):
+        if mode == "load":
+            lengths = self.lane_bowden_load_lengths
+            filters = self.lane_bowden_load_length_filters
+            varname = self.VARS_CALIB_LANE_BOWDEN_LOAD_LENGTHS
+        else:
+            lengths = self.lane_bowden_unload_lengths
+            filters = self.lane_bowden_unload_length_filters
+            varname = self.VARS_CALIB_LANE_BOWDEN_UNLOAD_LENGTHS
+        lane_length_stats = []
+        for length, length_filter in zip(lengths, filters):
+            if length is None:
+                lane_length_stats.append({})
+            else:
+                lane_length_stats.append(
+                    self._get_length_stats(length, length_filter)
+                )
+        self._save_variable(varname, lane_length_stats)
+
     def _calibrate_selector(self):
         extra_travel_base = 1.0
         extra_travel_per_lane = 0.3
@@ -2296,6 +3669,9 @@ class TradRack:
             (self.resume_callbacks[resume_type], resume_kwargs)
         )
 
+        # stop timing the failed toolchange
+        self.phase_timer.cancel()
+
         # pause the print
         self._send_pause()
 
@@ -2312,6 +3688,85 @@ class TradRack:
                 self.gcode.create_gcode_command("TR_RESUME", "TR_RESUME", {})
             )
 
+    def _resume_interrupted_toolchange(self, gcmd):
+        # finish the toolchange recorded in the journal from the last phase
+        # that was completed before a restart. Returns False if there is no
+        # toolchange that can be resumed.
+        entry = self.interrupted_toolchange
+        self.interrupted_toolchange = None
+        if entry is None:
+            return False
+        phase = entry["phase"]
+        unload_lane = load_lane = None
+        if phase == "loaded":
+            # the toolhead was loaded but the active lane may not have been
+            # saved
+            if not self.save_active_lane:
+                return False
+            load_lane = entry["lane"]
+        elif phase in ("start", "unload"):
+            unload_lane = entry["from_lane" if phase == "start" else "lane"]
+            if unload_lane is None:
+                return False
+            load_lane = entry["target_lane"]
+        elif phase in ("selector_loaded", "bowden_loaded"):
+            # continuing the load relies on the toolhead sensor to stop the
+            # filament wherever it is in the bowden tube
+            if not (
+                self.load_with_toolhead_sensor and self.toolhead_fil_endstops
+            ):
+                return False
+            load_lane = entry["lane"]
+        else:
+            return False
+        try:
+            for lane in (unload_lane, load_lane):
+                if lane is not None:
+                    self._check_lane_valid(lane)
+        except self.printer.command_error:
+            return False
+
+        if phase == "loaded":
+            # set the active lane
+            self.cmd_TR_SET_ACTIVE_LANE(
+                self.gcode.create_gcode_command(
+                    "TR_SET_ACTIVE_LANE",
+                    "TR_SET_ACTIVE_LANE",
+                    {"LANE": load_lane},
+                )
+            )
+            gcmd.respond_info("Set lane %d as the active lane" % load_lane)
+            return True
+
+        if unload_lane is not None:
+            # finish unloading the lane the toolchange started from
+            gcmd.respond_info(
+                "Resuming interrupted unload of lane %d" % unload_lane
+            )
+            self._set_selector_position(unload_lane)
+            self.curr_lane = unload_lane
+            self.ignore_next_unload_length = True
+            self.cmd_TR_UNLOAD_TOOLHEAD(
+                self.gcode.create_gcode_command(
+                    "TR_UNLOAD_TOOLHEAD", "TR_UNLOAD_TOOLHEAD", {}
+                )
+            )
+            if load_lane is not None:
+                self._load_toolhead(load_lane, entry["tool"])
+        else:
+            # continue loading from the filament's current position
+            gcmd.respond_info(
+                "Resuming interrupted load of lane %d after phase %s"
+                % (load_lane, phase)
+            )
+            self._set_selector_position(load_lane)
+            self.curr_lane = load_lane
+            self.ignore_next_load_length = True
+            self._load_toolhead(
+                load_lane, entry["tool"], selector_already_loaded=True
+            )
+        return True
+
     def _resume_act_locate_selector(self):
         if not self._is_selector_homed():
             self.cmd_TR_HOME(
@@ -2332,8 +3787,26 @@ class TradRack:
             "active_lane": self.active_lane,
             "next_lane": self.next_lane,
             "next_tool": self.next_tool,
-            "tool_map": self.tool_map,
+            "tool_map": self.lanes.get_tool_map(),
             "selector_homed": self._is_selector_homed(),
+            "pipeline_time_saved": self.pipeline_time_saved,
+            "prefetch_tool": self.prefetch_tool,
+            "prefetch_lane": self.prefetch_lane,
+            "toolchange_stats": self.phase_timer.get_status(),
+            "lanes": self.lanes.get_status(),
+            "bowden_load_length": self.bowden_load_length,
+            "bowden_unload_length": self.bowden_unload_length,
+            "bowden_load_length_spread": (
+                self.bowden_load_length_filter.get_spread()
+            ),
+            "bowden_unload_length_spread": (
+                self.bowden_unload_length_filter.get_spread()
+            ),
+            "runout_glitches": self.selector_sensor.glitch_count,
+            "bowden_slip": {
+                mode: [profile.get_slip() for profile in profiles]
+                for mode, profiles in self.bowden_speed_profiles.items()
+            },
         }
 
 
@@ -2414,6 +3887,9 @@ class TradRackToolHead(toolhead.ToolHead, object):
             newpos.append(0.0)
         super(TradRackToolHead, self).set_position(newpos, homing_axes)
 
+    def wait_moves(self):
+        wait_for_moves(self)
+
     def get_sel_max_velocity(self):
         return self.sel_max_velocity, self.sel_max_accel
 
@@ -2615,9 +4091,12 @@ class TradRackHoming(Homing, object):
 
 
 class TradRackServo:
-    def __init__(self, servo, toolhead):
+    def __init__(self, servo, toolhead, servo_wait):
         self.servo = servo
         self.toolhead = toolhead
+        self.servo_wait = servo_wait
+        self.last_value = None
+        self.settle_time = 0.0
 
     def set_servo(self, width=None, angle=None, print_time=None):
         if print_time is None:
@@ -2628,10 +4107,151 @@ class TradRackServo:
             value = self.servo._get_pwm_from_angle(angle)
         self.servo.gcrq.send_async_request(value, print_time=print_time)
 
+        # track when the servo will have finished moving (the servo does not
+        # move if it is already at the requested position)
+        if value != self.last_value:
+            self.settle_time = print_time + self.servo_wait
+        self.last_value = value
+
+    def wait_settled(self, toolhead):
+        # delay the next move of the given toolhead until the servo has
+        # settled
+        delay = self.settle_time - toolhead.get_last_move_time()
+        if delay > 0.0:
+            toolhead.dwell(delay)
+
     def get_max_angle(self):
         return self.servo.max_angle
 
 
+class TradRackLane:
+    # lane state saved with save_variables and the default value of each field
+    # (the tool assigned to the lane is saved separately with the tool map)
+    SAVED_FIELDS = {
+        "buffered": False,  # whether the lane's buffer is known to be full
+        "dead": False,  # whether the lane ran out or failed to load
+        "loaded": False,  # whether filament is known to be in the lane
+        "temp": 0.0,  # extruder temperature for the lane (0 if not set)
+        "material": "",
+        "load_count": 0,  # number of times the toolhead was loaded
+        "unload_count": 0,  # number of times the toolhead was unloaded
+        "last_load_length": None,  # last measured bowden load length
+        "last_unload_length": None,  # last measured bowden unload length
+        "failed_loads": 0,  # failed selector loads since the last success
+        "spool_length": None,  # length of filament on the spool (if known)
+        "consumed_length": 0.0,  # length extruded since the spool was set
+    }
+
+    def __init__(self, index):
+        self.index = index
+        self.tool = index  # tool the lane is assigned to
+        self.restore(self.SAVED_FIELDS)
+
+    def get_state(self):
+        # only include fields that differ from the defaults to keep the saved
+        # variable short
+        state = {}
+        for field, default in self.SAVED_FIELDS.items():
+            value = getattr(self, field)
+            if isinstance(value, float):
+                value = round(value, 1)
+            if value != default:
+                state[field] = value
+        return state
+
+    def get_status(self):
+        status = {"tool": self.tool}
+        for field in self.SAVED_FIELDS:
+            status[field] = getattr(self, field)
+        status["remaining_length"] = self.get_remaining_length()
+        return status
+
+    def get_health(self):
+        # estimate how likely the lane is to load (higher is better) from its
+        # recent history
+        health = 0
+        if self.buffered:
+            # filament was recently retracted from the selector into the lane
+            health += 1
+        if self.dead:
+            # lane ran out or failed to load
+            health -= 2
+        health -= min(self.failed_loads, 3)
+        return health
+
+    def set_spool_length(self, length):
+        self.spool_length = length
+        self.consumed_length = 0.0
+
+    def add_consumed_length(self, length):
+        self.consumed_length += length
+
+    def get_remaining_length(self):
+        # returns the estimated length left on the spool, or None if unknown
+        if self.spool_length is None:
+            return None
+        return self.spool_length - self.consumed_length
+
+    def restore(self, state):
+        for field in self.SAVED_FIELDS:
+            if field in state:
+                setattr(self, field, state[field])
+
+
+class TradRackLaneRegistry:
+    def __init__(self, lane_count):
+        self.lane_count = lane_count
+        self.lanes = [TradRackLane(i) for i in range(lane_count)]
+        self.default_lanes = []  # default lane for each tool
+        self.reset_tool_map()
+
+    def __getitem__(self, lane):
+        return self.lanes[lane]
+
+    def __iter__(self):
+        return iter(self.lanes)
+
+    def __len__(self):
+        return self.lane_count
+
+    def reset_tool_map(self):
+        for lane in self.lanes:
+            lane.tool = lane.index
+        self.default_lanes = list(range(self.lane_count))
+
+    def get_tool_map(self):
+        return [lane.tool for lane in self.lanes]
+
+    def get_lane_states(self):
+        return [lane.get_state() for lane in self.lanes]
+
+    def restore_lane_states(self, lane_states):
+        for lane, state in zip(self.lanes, lane_states):
+            lane.restore(state)
+
+    def get_status(self):
+        return [lane.get_status() for lane in self.lanes]
+
+    def get_tool_status(self):
+        return {
+            "tool_map": self.get_tool_map(),
+            "default_lanes": list(self.default_lanes),
+        }
+
+    def restore_tool_status(self, tool_status):
+        # ignore the saved tool map if the lane count has changed
+        tool_map = tool_status.get("tool_map", [])
+        default_lanes = tool_status.get("default_lanes", [])
+        if (
+            len(tool_map) != self.lane_count
+            or len(default_lanes) != self.lane_count
+        ):
+            return
+        for lane, tool in zip(self.lanes, tool_map):
+            lane.tool = tool
+        self.default_lanes = list(default_lanes)
+
+
 class TradRackLanePositionManager:
     def __init__(self, lane_count, config):
         self.lane_count = lane_count
@@ -2695,6 +4315,7 @@ class TradRackExtruderSyncManager:
         self._prev_sks = None
         self._prev_trapq = None
         self._prev_rotation_dists = None
+        self._stepper_kinematics = {}
 
     def handle_connect(self):
         self.toolhead = self.printer.lookup_object("toolhead")
@@ -2719,35 +4340,62 @@ class TradRackExtruderSyncManager:
             for stepper in steppers:
                 stepper.set_position((0.0, 0.0, 0.0))
 
+    def _get_stepper_kinematics(self, sync_type, stepper):
+        # reuse the stepper kinematics allocated for earlier syncs
+        key = (sync_type, stepper.get_name())
+        stepper_kinematics = self._stepper_kinematics.get(key)
+        if stepper_kinematics is None:
+            ffi_main, ffi_lib = chelper.get_ffi()
+            if sync_type == EXTRUDER_TO_FIL_DRIVER:
+                stepper_alloc = ffi_lib.cartesian_stepper_alloc(b"y")
+            else:
+                stepper_alloc = ffi_lib.extruder_stepper_alloc()
+            stepper_kinematics = ffi_main.gc(stepper_alloc, ffi_lib.free)
+            self._stepper_kinematics[key] = stepper_kinematics
+        return stepper_kinematics
+
     def _sync(self, sync_type):
-        self.unsync()
+        if sync_type not in (EXTRUDER_TO_FIL_DRIVER, FIL_DRIVER_TO_EXTRUDER):
+            raise Exception("Invalid sync_type: %d" % sync_type)
+
+        # flush both toolheads once for the whole transition
         self.toolhead.flush_step_generation()
         self.tr_toolhead.flush_step_generation()
 
-        ffi_main, ffi_lib = chelper.get_ffi()
+        # already synced the same way, only the positions need to be reset
+        if self.sync_state == sync_type:
+            if sync_type == EXTRUDER_TO_FIL_DRIVER:
+                self.reset_fil_driver()
+            else:
+                new_pos = self._get_extruder_position()
+                steppers = self.fil_driver_rail.get_steppers()
+                for i in range(len(steppers)):
+                    steppers[i].set_position(new_pos)
+                    steppers[i].set_rotation_distance(
+                        self._prev_rotation_dists[i]
+                    )
+            return
+
+        # switch directly from the previous sync (if any)
+        self._restore_steppers()
         if sync_type == EXTRUDER_TO_FIL_DRIVER:
             steppers = self._get_extruder_mcu_steppers()
             self._prev_trapq = steppers[0].get_trapq()
             external_trapq = self.tr_toolhead.get_trapq()
-            stepper_alloc = ffi_lib.cartesian_stepper_alloc(b"y")
             self.reset_fil_driver()
             new_pos = [0.0, 0.0, 0.0]
-        elif sync_type == FIL_DRIVER_TO_EXTRUDER:
+        else:
             steppers = self.fil_driver_rail.get_steppers()
             self._prev_trapq = self.tr_toolhead.get_trapq()
-            extruder = self.toolhead.get_extruder()
-            external_trapq = extruder.get_trapq()
-            stepper_alloc = ffi_lib.extruder_stepper_alloc()
-            new_pos = extruder.last_position
-            if not isinstance(new_pos, list):
-                new_pos = [new_pos, 0.0, 0.0]
-        else:
-            raise Exception("Invalid sync_type: %d" % sync_type)
+            external_trapq = self.toolhead.get_extruder().get_trapq()
+            new_pos = self._get_extruder_position()
 
         self._prev_sks = []
         self._prev_rotation_dists = []
         for stepper in steppers:
-            stepper_kinematics = ffi_main.gc(stepper_alloc, ffi_lib.free)
+            stepper_kinematics = self._get_stepper_kinematics(
+                sync_type, stepper
+            )
             self._prev_rotation_dists.append(stepper.get_rotation_distance()[0])
             self._prev_sks.append(
                 stepper.set_stepper_kinematics(stepper_kinematics)
@@ -2756,6 +4404,12 @@ class TradRackExtruderSyncManager:
             stepper.set_position(new_pos)
         self.sync_state = sync_type
 
+    def _get_extruder_position(self):
+        new_pos = self.toolhead.get_extruder().last_position
+        if not isinstance(new_pos, list):
+            new_pos = [new_pos, 0.0, 0.0]
+        return new_pos
+
     def sync_extruder_to_fil_driver(self):
         self._sync(EXTRUDER_TO_FIL_DRIVER)
 
@@ -2769,7 +4423,13 @@ class TradRackExtruderSyncManager:
 
         self.toolhead.flush_step_generation()
         self.tr_toolhead.flush_step_generation()
+        self._restore_steppers()
 
+    def _restore_steppers(self):
+        # give the synced steppers back their own kinematics, assumes step
+        # generation has already been flushed
+        if self.sync_state is None:
+            return
         if self.sync_state == EXTRUDER_TO_FIL_DRIVER:
             steppers = self._get_extruder_mcu_steppers()
         elif self.sync_state == FIL_DRIVER_TO_EXTRUDER:
@@ -2804,6 +4464,392 @@ class TradRackExtruderSyncManager:
             )
 
 
+class TradRackToolPrefetcher:
+    TOOLCHANGE_REGEX = re.compile(
+        rb"^(?:T(\d+)(?:\s.*)?|TR_LOAD_TOOLHEAD\s+(.*))$", re.IGNORECASE
+    )
+    PARAM_REGEX = re.compile(rb"\b(TOOL|LANE)=(\d+)", re.IGNORECASE)
+    # lines that might be toolchanges, used to skip all other lines without
+    # splitting the file into lines
+    CANDIDATE_REGEX = re.compile(
+        rb"^[ \t]*(?:T\d|TR_LOAD_TOOLHEAD)[^\n]*", re.IGNORECASE | re.MULTILINE
+    )
+    CHUNK_SIZE = 8192
+    # tool list added to the end of the file by gcode_post_process.py
+    TOOL_LIST_REGEX = re.compile(
+        rb"^; trad_rack_(tools|lanes) = ([\d,]*)", re.MULTILINE
+    )
+    TOOL_LIST_BYTES = 4096
+
+    def __init__(self, printer, scan_bytes):
+        self.printer = printer
+        self.scan_bytes = scan_bytes
+
+    def find_toolchanges(self, eventtime):
+        # yields (tool, lane) for each toolchange found ahead of the current
+        # position of the file being printed (tool or lane may be None)
+        sdcard = self.printer.lookup_object("virtual_sdcard", None)
+        if sdcard is None:
+            return
+        status = sdcard.get_status(eventtime)
+        file_path = status.get("file_path")
+        if not file_path:
+            return
+        try:
+            for toolchange in self.read_toolchanges(
+                file_path, status.get("file_position", 0), self.scan_bytes
+            ):
+                yield toolchange
+        except (IOError, OSError):
+            logging.warning(
+                "trad_rack: Unable to read print file for tool prefetch",
+                exc_info=True,
+            )
+
+    def read_toolchanges(
+        self, file_path, position=0, scan_bytes=None, reactor=None
+    ):
+        # yields (tool, lane) for each toolchange in the file, starting at
+        # the given position and reading at most scan_bytes (or to the end
+        # of the file if scan_bytes is None). If a reactor is given, it is
+        # allowed to run between chunks so that reading a large file does
+        # not hold up other tasks.
+        with open(file_path, "rb") as f:
+            f.seek(position)
+            partial = b""
+            bytes_left = scan_bytes
+            while bytes_left is None or bytes_left > 0:
+                if bytes_left is None:
+                    data = f.read(self.CHUNK_SIZE)
+                else:
+                    data = f.read(min(self.CHUNK_SIZE, bytes_left))
+                    bytes_left -= len(data)
+                if not data:
+                    # the last line of the file has no newline
+                    toolchange = self._parse_line(partial)
+                    if toolchange is not None:
+                        yield toolchange
+                    break
+                data = partial + data
+                end = data.rfind(b"\n") + 1
+                partial = data[end:]
+                for match in self.CANDIDATE_REGEX.finditer(data, 0, end):
+                    toolchange = self._parse_line(match.group(0))
+                    if toolchange is not None:
+                        yield toolchange
+                if reactor is not None:
+                    reactor.pause(reactor.NOW)
+
+    def read_tool_list(self, file_path):
+        # returns a (tool, lane) toolchange for each tool and lane listed at
+        # the end of the file by gcode_post_process.py, or None if there is
+        # no list
+        with open(file_path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - self.TOOL_LIST_BYTES))
+            data = f.read()
+        items = dict(self.TOOL_LIST_REGEX.findall(data))
+        if b"tools" not in items:
+            return None
+        toolchanges = [
+            (int(tool), None) for tool in items[b"tools"].split(b",") if tool
+        ]
+        toolchanges += [
+            (None, int(lane))
+            for lane in items.get(b"lanes", b"").split(b",")
+            if lane
+        ]
+        return toolchanges
+
+    def _parse_line(self, line):
+        match = self.TOOLCHANGE_REGEX.match(line.split(b";", 1)[0].strip())
+        if match is None:
+            return None
+        if match.group(1) is not None:
+            return int(match.group(1)), None
+        params = {
+            key.upper().decode(): int(value)
+            for key, value in self.PARAM_REGEX.findall(match.group(2))
+        }
+        if "LANE" in params:
+            return params.get("TOOL"), params["LANE"]
+        if "TOOL" in params:
+            return params["TOOL"], None
+        return None
+
+
+class TradRackPhaseTimer:
+    # upper bounds (in seconds) of the histogram buckets, the last bucket
+    # holds all durations above the last bound
+    BUCKET_BOUNDS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 25.0, 60.0)
+
+    def __init__(self, reactor, tr_toolhead, enabled=True):
+        self.reactor = reactor
+        self.tr_toolhead = tr_toolhead
+        self.enabled = enabled
+        self.start_time = None
+        self.last_mark_time = None
+        self.phases = {}
+        self.last_phases = {}
+        self.current_phases = {}
+
+    def _get_time(self):
+        # get the print time at which everything done so far will be finished
+        # (the later of the current time and the end of the moves flushed
+        # from the Trad Rack toolhead's lookahead queue), so that moves are
+        # counted in the phase that queued them rather than the phase that
+        # waits for them
+        print_time, est_print_time, _ = self.tr_toolhead.check_busy(
+            self.reactor.monotonic()
+        )
+        return max(est_print_time, print_time)
+
+    def start(self):
+        if not self.enabled:
+            return
+        self.start_time = self.last_mark_time = self._get_time()
+        self.current_phases = {}
+
+    def is_active(self):
+        return self.start_time is not None
+
+    def mark(self, phase):
+        # attribute the time since the last mark to the given phase
+        if self.start_time is None:
+            return
+        now = max(self._get_time(), self.last_mark_time)
+        duration = now - self.last_mark_time
+        self.last_mark_time = now
+        self.current_phases[phase] = (
+            self.current_phases.get(phase, 0.0) + duration
+        )
+
+    def finish(self, operation):
+        # skip recording if no phases were timed (nothing was done)
+        if not self.current_phases:
+            self.cancel()
+            return
+        self.current_phases[operation] = (
+            max(self._get_time(), self.last_mark_time) - self.start_time
+        )
+        for phase, duration in self.current_phases.items():
+            self._record(phase, duration)
+        self.last_phases = self.current_phases
+        self.cancel()
+
+    def cancel(self):
+        self.start_time = self.last_mark_time = None
+        self.current_phases = {}
+
+    def reset(self):
+        self.cancel()
+        self.phases = {}
+        self.last_phases = {}
+
+    def _record(self, phase, duration):
+        stats = self.phases.get(phase)
+        if stats is None:
+            stats = self.phases[phase] = {
+                "count": 0,
+                "total": 0.0,
+                "min": duration,
+                "max": duration,
+                "histogram": [0] * (len(self.BUCKET_BOUNDS) + 1),
+            }
+        stats["count"] += 1
+        stats["total"] += duration
+        stats["min"] = min(stats["min"], duration)
+        stats["max"] = max(stats["max"], duration)
+        for i, bound in enumerate(self.BUCKET_BOUNDS):
+            if duration <= bound:
+                break
+        else:
+            i = len(self.BUCKET_BOUNDS)
+        stats["histogram"][i] += 1
+
+    def get_phases(self):
+        return self.phases
+
+    def get_last_phases(self):
+        return self.last_phases
+
+    def get_status(self):
+        # return copies so that status updates are detected as changes
+        return {
+            "bucket_bounds": list(self.BUCKET_BOUNDS),
+            "phases": {
+                phase: dict(stats, histogram=list(stats["histogram"]))
+                for phase, stats in self.phases.items()
+            },
+            "last": dict(self.last_phases),
+        }
+
+
+class TradRackLogWriter:
+    MAX_PENDING_LINES = 1000  # oldest lines are dropped beyond this
+    FLUSH_INTERVAL = 5.0  # max time (in seconds) before lines are written
+
+    def __init__(self, printer, max_size):
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.io_lock = threading.Lock()
+        self.flush_event = threading.Event()
+        self.pending = deque(maxlen=self.MAX_PENDING_LINES)
+        self.dropped_lines = 0
+        self.stopping = False
+        self.thread = None
+        printer.register_event_handler("klippy:shutdown", self.flush)
+        printer.register_event_handler("klippy:disconnect", self.close)
+
+    def write(self, filename, header, line):
+        # queue a line to be appended to a file (the header is written first
+        # if the file is empty)
+        with self.lock:
+            if len(self.pending) == self.MAX_PENDING_LINES:
+                self.dropped_lines += 1
+            self.pending.append((filename, header, line))
+            if self.thread is None and not self.stopping:
+                self.thread = threading.Thread(target=self._run)
+                self.thread.daemon = True
+                self.thread.start()
+
+    def flush(self):
+        # write all queued lines from the calling thread
+        with self.lock:
+            batch = list(self.pending)
+            self.pending.clear()
+            dropped_lines, self.dropped_lines = self.dropped_lines, 0
+        if dropped_lines:
+            logging.warning(
+                "trad_rack: Log writer dropped %d lines" % dropped_lines
+            )
+        if batch:
+            with self.io_lock:
+                self._write_batch(batch)
+
+    def close(self):
+        with self.lock:
+            self.stopping = True
+            thread = self.thread
+        if thread is not None:
+            self.flush_event.set()
+            thread.join(1.0)
+        self.flush()
+
+    def _run(self):
+        while not self.stopping:
+            self.flush_event.wait(self.FLUSH_INTERVAL)
+            self.flush_event.clear()
+            self.flush()
+
+    def _write_batch(self, batch):
+        lines_by_file = {}
+        for filename, header, line in batch:
+            lines_by_file.setdefault(filename, (header, []))[1].append(line)
+        for filename, (header, lines) in lines_by_file.items():
+            try:
+                # rotate file if it is too large
+                if (
+                    self.max_size
+                    and os.path.exists(filename)
+                    and os.path.getsize(filename) >= self.max_size
+                ):
+                    os.rename(filename, filename + ".1")
+
+                with open(filename, "a") as f:
+                    if f.tell() == 0:
+                        f.write(header)
+                    f.write("".join(lines))
+            except (IOError, OSError):
+                logging.warning(
+                    "trad_rack: Error writing to file '%s'" % filename,
+                    exc_info=True,
+                )
+
+
+class TradRackToolchangeJournal:
+    # phases after which there is nothing left to resume
+    END_PHASES = ("loaded", "unloaded")
+
+    def __init__(self, filename):
+        self.filename = filename  # None if the journal is disabled
+        self.started = False
+
+    def start(self, **fields):
+        # replace the journal of the last toolchange
+        self.started = True
+        self._write("w", "start", fields)
+
+    def record(self, phase, **fields):
+        # add an entry once a phase has been completed (starting a journal
+        # with no target lane for an unload outside of a toolchange)
+        if not self.started:
+            self.start(lane=None, tool=None, from_lane=None)
+        self._write("a", phase, fields)
+
+    def finish(self, phase, **fields):
+        # add the entry of the last phase of a toolchange
+        self.record(phase, **fields)
+        self.started = False
+
+    def clear(self):
+        self.started = False
+        if self.filename is None:
+            return
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
+
+    def replay(self):
+        # returns a dict with the last completed phase and its lane, and the
+        # target lane, tool and starting lane of the toolchange, or None if
+        # there is no journal
+        if self.filename is None:
+            return None
+        try:
+            with open(self.filename, "r") as f:
+                lines = f.readlines()
+        except (IOError, OSError):
+            return None
+        start = last = None
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the last line may be incomplete if klippy stopped while it
+                # was being written
+                break
+            if entry.get("phase") == "start":
+                start = entry
+            last = entry
+        if start is None:
+            return None
+        return {
+            "phase": last["phase"],
+            "lane": last.get("lane"),
+            "target_lane": start.get("lane"),
+            "tool": start.get("tool"),
+            "from_lane": start.get("from_lane"),
+        }
+
+    def _write(self, mode, phase, fields):
+        # write an entry and wait for it to reach the disk before continuing
+        if self.filename is None:
+            return
+        entry = dict(fields, phase=phase, time=time.time())
+        try:
+            with open(self.filename, mode) as f:
+                f.write(json.dumps(entry, sort_keys=True) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+        except (IOError, OSError):
+            logging.warning(
+                "trad_rack: Error writing to file '%s'" % self.filename,
+                exc_info=True,
+            )
+
+
 class RunIfNoActivity:
     def __init__(self, toolhead, reactor, callback, delay):
         self.toolhead = toolhead
@@ -2839,6 +4885,163 @@ class MovingAverageFilter:
     def get_entry_count(self):
         return len(self.queue)
 
+    def has_spread(self):
+        return len(self.queue) >= 2
+
+    def get_spread(self):
+        # standard deviation of the values in the queue
+        if not self.queue:
+            return 0.0
+        mean = self.total / len(self.queue)
+        return math.sqrt(
+            sum((v - mean) ** 2 for v in self.queue) / len(self.queue)
+        )
+
+    def get_saved_stats(self):
+        return {"spread": self.get_spread()}
+
+    def restore(self, length_stats):
+        for _ in range(length_stats["sample_count"]):
+            self.update(length_stats["new_set_length"])
+
+
+class BowdenSpeedProfile:
+    REFERENCE_SAMPLES = 10  # number of distances used to detect slip
+    SLIP_TOLERANCE = 2.0  # extra distance (mm) that is considered slip
+    SPEED_DECREASE = 0.8  # speed multiplier after a move with slip
+    SPEED_INCREASE = 0.1  # fraction of the base speed added after a move
+    MIN_SPEED_FACTOR = 0.5  # minimum speed as a fraction of the base speed
+    SLIP_SMOOTHING = 0.2  # weight of the latest move in the slip estimate
+    # fraction of the speed range above the base speed lost per unit of
+    # estimated slip (e.g. 1% slip removes 20% of the range)
+    SLIP_SPEED_FACTOR = 20.0
+
+    def __init__(self, base_speeds, max_speed):
+        self.base_speeds = dict(base_speeds)
+        self.speeds = dict(base_speeds)
+        self.max_speed = max_speed
+        self.distances = deque(maxlen=self.REFERENCE_SAMPLES)
+        self.slip = 0.0  # estimated fraction of drive gear travel lost
+
+    def get_speed(self, state):
+        return self.speeds[state]
+
+    def get_slip(self):
+        return self.slip
+
+    def update(self, state, distance):
+        # compare the distance the drive gear moved to reach the sensor to
+        # the shortest recent distance (slip can only increase the distance)
+        if self.distances:
+            excess = max(0.0, distance - min(self.distances))
+        else:
+            excess = 0.0
+        self.distances.append(distance)
+        self.slip += self.SLIP_SMOOTHING * (excess / distance - self.slip)
+
+        # slow down after slip, otherwise speed up until the max speed
+        # (reduced by the estimated slip, so lanes with more friction are
+        # kept closer to the base speed)
+        base_speed = self.base_speeds[state]
+        speed = self.speeds[state]
+        if excess > self.SLIP_TOLERANCE:
+            speed = max(
+                base_speed * self.MIN_SPEED_FACTOR, speed * self.SPEED_DECREASE
+            )
+        else:
+            headroom = max(0.0, self.max_speed - base_speed) * max(
+                0.0, 1.0 - self.SLIP_SPEED_FACTOR * self.slip
+            )
+            speed = min(
+                base_speed + headroom,
+                speed + base_speed * self.SPEED_INCREASE,
+            )
+        self.speeds[state] = speed
+        return speed
+
+
+class RobustLengthFilter:
+    MIN_SAMPLES = 3  # samples required before outliers are rejected
+    MIN_SPREAD = 1.0  # lower limit of the spread used to reject outliers (mm)
+    MAX_REJECTIONS = 3  # consecutive rejections before starting over
+    TRIM_FRACTION = 0.2  # fraction of samples trimmed from each end
+
+    def __init__(self, max_entries, outlier_sigma):
+        self.max_entries = max_entries
+        self.outlier_sigma = outlier_sigma
+        self.queue = deque()
+        self.rejected = []
+
+    def update(self, value):
+        # reject value if it is too far from the current estimate
+        if len(self.queue) >= self.MIN_SAMPLES:
+            estimate = self.get_estimate()
+            limit = self.outlier_sigma * max(self.get_spread(), self.MIN_SPREAD)
+            if abs(value - estimate) > limit:
+                self.rejected.append(value)
+                if len(self.rejected) < self.MAX_REJECTIONS:
+                    logging.info(
+                        "trad_rack: Rejected bowden length sample %.3f"
+                        " (estimate: %.3f, limit: %.3f)"
+                        % (value, estimate, limit)
+                    )
+                    return estimate
+
+                # the length has consistently changed, so start over with
+                # the rejected values
+                logging.info(
+                    "trad_rack: Resetting bowden length estimate after %d"
+                    " consecutive outliers" % len(self.rejected)
+                )
+                self.queue = deque(self.rejected[-self.max_entries :])
+                self.rejected = []
+                return self.get_estimate()
+        self.rejected = []
+
+        # add value
+        if len(self.queue) >= self.max_entries:
+            self.queue.popleft()
+        self.queue.append(value)
+        return self.get_estimate()
+
+    def reset(self):
+        self.queue.clear()
+        self.rejected = []
+
+    def get_entry_count(self):
+        return len(self.queue)
+
+    def get_estimate(self):
+        # trimmed mean of the values in the queue
+        values = sorted(self.queue)
+        trim = int(len(values) * self.TRIM_FRACTION)
+        if trim:
+            values = values[trim:-trim]
+        return sum(values) / len(values)
+
+    def has_spread(self):
+        return len(self.queue) >= self.MIN_SAMPLES
+
+    def get_spread(self):
+        # standard deviation of the values in the queue
+        if not self.queue:
+            return 0.0
+        mean = sum(self.queue) / len(self.queue)
+        return math.sqrt(
+            sum((v - mean) ** 2 for v in self.queue) / len(self.queue)
+        )
+
+    def get_saved_stats(self):
+        return {"spread": self.get_spread(), "samples": list(self.queue)}
+
+    def restore(self, length_stats):
+        self.reset()
+        # (start with only the set length if the samples were not saved,
+        # since the spread of the samples is unknown)
+        samples = length_stats.get("samples", [length_stats["new_set_length"]])
+        for value in samples[-self.max_entries :]:
+            self.queue.append(value)
+
 
 class TradRackLoadError(CommandError):
     pass
@@ -2848,11 +5051,10 @@ class SelectorNotHomedError(CommandError):
     pass
 
 
-class TradRackRunoutSensor:
-    def __init__(self, config, runout_callback, pin):
+class TradRackFilamentSensor:
+    def __init__(self, config, pin):
         self.printer = config.get_printer()
         self.reactor = self.printer.get_reactor()
-        self.runout_callback = runout_callback
 
         # disable config checks for duplicate pins
         pin_desc = pin
@@ -2867,17 +5069,119 @@ class TradRackRunoutSensor:
         buttons = config.get_printer().load_object(config, "buttons")
         buttons.register_buttons([pin], self.sensor_callback)
 
+        self.state = None
+
+    def sensor_callback(self, eventtime, state):
+        self.set_state(state)
+
+    def set_state(self, state):
+        self.state = not not state
+
+    def get_state(self):
+        # returns the last known state (None if it is not known yet)
+        return self.state
+
+
+class TradRackRunoutSensor(TradRackFilamentSensor):
+    CHECK_INTERVAL = 0.1  # time between checks of a possible runout
+
+    def __init__(
+        self,
+        config,
+        runout_callback,
+        pin,
+        glitch_callback=None,
+        toolhead_sensor=None,
+    ):
+        super(TradRackRunoutSensor, self).__init__(config, pin)
+        self.runout_callback = runout_callback
+        self.glitch_callback = glitch_callback
+        self.toolhead_sensor = toolhead_sensor
         self.active = False
+        self.debounce_length = 0.0
+        self.debounce_time = 0.0
+        # (eventtime, extruder position) when the filament went missing, if
+        # the runout has not been confirmed yet
+        self.pending = None
+        self.glitch_count = 0
+        self.check_timer = self.reactor.register_timer(self._check_pending)
+
+    def set_debounce(self, debounce_length, debounce_time):
+        # set how much filament must be extruded and how much time must pass
+        # with no filament detected before a runout is handled
+        self.debounce_length = debounce_length
+        self.debounce_time = debounce_time
 
     def sensor_callback(self, eventtime, state):
-        if self.active and not state:
-            idle_timeout = self.printer.lookup_object("idle_timeout")
-            if idle_timeout.get_status(eventtime)["state"] == "Printing":
-                self.active = False
-                self.reactor.register_callback(self.runout_callback)
+        super(TradRackRunoutSensor, self).sensor_callback(eventtime, state)
+        if not self.active:
+            return
+        if state:
+            # filament came back before the runout was confirmed
+            if self.pending is not None:
+                self._note_glitch(eventtime)
+        elif self.pending is None and self._is_printing(eventtime):
+            if self.debounce_length or self.debounce_time:
+                self.pending = (eventtime, self._get_extruder_position())
+                self.reactor.update_timer(self.check_timer, self.reactor.NOW)
+            else:
+                self._trigger_runout()
 
     def set_active(self, active):
         self.active = active
+        if not active:
+            self._cancel_pending()
+
+    def _check_pending(self, eventtime):
+        if self.pending is None:
+            return self.reactor.NEVER
+        start_time, start_pos = self.pending
+
+        # confirm the runout once the filament has been missing for long
+        # enough, or right away if the toolhead sensor has no filament either
+        if self._is_printing(eventtime) and (
+            self._is_toolhead_sensor_empty()
+            or (
+                eventtime - start_time >= self.debounce_time
+                and self._get_extruder_position() - start_pos
+                >= self.debounce_length
+            )
+        ):
+            self._trigger_runout()
+            return self.reactor.NEVER
+        return eventtime + self.CHECK_INTERVAL
+
+    def _note_glitch(self, eventtime):
+        start_time, start_pos = self.pending
+        self._cancel_pending()
+        self.glitch_count += 1
+        if self.glitch_callback is not None:
+            self.glitch_callback(
+                eventtime,
+                eventtime - start_time,
+                self._get_extruder_position() - start_pos,
+            )
+
+    def _trigger_runout(self):
+        self.active = False
+        self._cancel_pending()
+        self.reactor.register_callback(self.runout_callback)
+
+    def _cancel_pending(self):
+        self.pending = None
+        self.reactor.update_timer(self.check_timer, self.reactor.NEVER)
+
+    def _is_printing(self, eventtime):
+        idle_timeout = self.printer.lookup_object("idle_timeout")
+        return idle_timeout.get_status(eventtime)["state"] == "Printing"
+
+    def _is_toolhead_sensor_empty(self):
+        if self.toolhead_sensor is None:
+            return False
+        return self.toolhead_sensor.get_state() is False
+
+    def _get_extruder_position(self):
+        return self.printer.lookup_object("toolhead").get_position()[3]
 
 
 def load_config(config):
@@ -0,0 +1,230 @@
+import argparse, os, re, shutil, sys, tempfile
+
+# first character of lines that might be toolchanges
+TOOLCHANGE_PREFIXES = (b"T", b"t")
+# toolchange line, split into the command, the tool number and the rest of
+# the line (including any comment and the line ending)
+TOOLCHANGE_REGEX = re.compile(
+    rb"^(T)(\d+)(\s*(?:;.*)?\s*)$", re.DOTALL | re.IGNORECASE
+)
+LOAD_TOOLHEAD_REGEX = re.compile(
+    rb"^(TR_LOAD_TOOLHEAD\b.*\bTOOL=)(\d+)(.*)$", re.DOTALL | re.IGNORECASE
+)
+TOOL_LIST_PREFIX = b"; trad_rack_"
+LOAD_LANE_REGEX = re.compile(
+    rb"^TR_LOAD_TOOLHEAD\b.*\bLANE=(\d+)", re.DOTALL | re.IGNORECASE
+)
+
+
+def parse_toolchange(line):
+    # returns the (tool, lane) loaded by a toolchange line, where the lane is
+    # None unless it is given with TR_LOAD_TOOLHEAD LANE=<lane> (in which
+    # case the tool is None), or None if the line is not a toolchange
+    if line[:1] not in TOOLCHANGE_PREFIXES:
+        return None
+    match = LOAD_LANE_REGEX.match(line)
+    if match is not None:
+        return None, int(match.group(1))
+    match = TOOLCHANGE_REGEX.match(line) or LOAD_TOOLHEAD_REGEX.match(line)
+    if match is not None:
+        return int(match.group(2)), None
+    return None
+
+
+class RemoveUnloadRule:
+    # removes the unload gcode that the slicer adds before each toolchange,
+    # from the unload retraction up to the start of the filament end gcode
+    START_PREFIX = b"G1 E-15"
+    START_REGEX = re.compile(rb"G1 E-15[.0]* F6000")
+    END_MARKER = b"; Filament-specific end gcode"
+
+    def apply(self, lines):
+        # lines of an unload block are held until the end of the block is
+        # found, since they are kept if it is never found
+        held_lines = None
+        for line in lines:
+            if line.startswith(self.START_PREFIX) and self.START_REGEX.match(
+                line
+            ):
+                if held_lines:
+                    yield from held_lines
+                held_lines = [line]
+            elif held_lines is None:
+                yield line
+            elif self.END_MARKER in line:
+                held_lines = None
+                yield line
+            else:
+                held_lines.append(line)
+        if held_lines:
+            yield from held_lines
+
+
+class RemoveRedundantToolchangesRule:
+    # removes toolchanges to the tool that is already loaded
+    def apply(self, lines):
+        tool = None
+        for line in lines:
+            if line[:3].upper() == b"TR_":
+                # after any other toolhead load or unload command, the loaded
+                # tool is only known if the command loaded a tool
+                toolchange = parse_toolchange(line)
+                if toolchange is not None and toolchange[1] is None:
+                    tool = toolchange[0]
+                else:
+                    tool = None
+            elif line[:1] in TOOLCHANGE_PREFIXES:
+                match = TOOLCHANGE_REGEX.match(line)
+                if match is not None:
+                    if int(match.group(2)) == tool:
+                        continue
+                    tool = int(match.group(2))
+            yield line
+
+
+class ToolMapRule:
+    # changes the tool number of each toolchange according to a map of old
+    # tool numbers to new ones
+    def __init__(self, tool_map):
+        self.tool_map = {
+            str(old).encode(): str(new).encode()
+            for old, new in tool_map.items()
+        }
+
+    def apply(self, lines):
+        for line in lines:
+            if line[:1] in TOOLCHANGE_PREFIXES:
+                match = TOOLCHANGE_REGEX.match(line) or (
+                    LOAD_TOOLHEAD_REGEX.match(line)
+                )
+                if match is not None and match.group(2) in self.tool_map:
+                    line = b"".join(
+                        (
+                            match.group(1),
+                            self.tool_map[match.group(2)],
+                            match.group(3),
+                        )
+                    )
+            yield line
+
+
+class ToolListRule:
+    # adds comments to the end of the file listing the tools (and lanes given
+    # directly with TR_LOAD_TOOLHEAD LANE=<lane>) in the order they are
+    # first loaded, read by the TR_PREFLIGHT gcode command
+    def apply(self, lines):
+        tools = []
+        lanes = []
+        line = b"\n"
+        for line in lines:
+            if line.startswith(TOOL_LIST_PREFIX):
+                # replace the list from an earlier run
+                continue
+            toolchange = parse_toolchange(line)
+            if toolchange is not None:
+                tool, lane = toolchange
+                if lane is not None:
+                    if lane not in lanes:
+                        lanes.append(lane)
+                elif tool not in tools:
+                    tools.append(tool)
+            yield line
+        if not line.endswith(b"\n"):
+            yield b"\n"
+        yield b"; trad_rack_tools = %s\n" % b",".join(
+            b"%d" % tool for tool in tools
+        )
+        yield b"; trad_rack_lanes = %s\n" % b",".join(
+            b"%d" % lane for lane in lanes
+        )
+
+
+def process_lines(lines, rules):
+    # chain the rules so that each line is passed through all of them before
+    # the next line is read
+    for rule in rules:
+        lines = rule.apply(lines)
+    return lines
+
+
+def process_file(source_file, rules, dest_file=None):
+    # read the source file one line at a time and write the result to a
+    # temporary file in the destination directory, then move it into place
+    # so that the destination is never left partially written
+    if dest_file is None:
+        dest_file = source_file
+    dest_dir = os.path.dirname(os.path.abspath(dest_file))
+    fd, temp_file = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=dest_dir)
+    try:
+        with open(source_file, "rb") as src, os.fdopen(fd, "wb") as dest:
+            dest.writelines(process_lines(src, rules))
+        shutil.copymode(source_file, temp_file)
+        os.replace(temp_file, dest_file)
+    except:
+        os.remove(temp_file)
+        raise
+
+
+def parse_tool_map(tool_map_str):
+    tool_map = {}
+    for item in tool_map_str.split(","):
+        old, sep, new = item.partition("=")
+        if not sep or not old.strip().isdigit() or not new.strip().isdigit():
+            raise ValueError("Expected OLD=NEW, got '%s'" % item)
+        tool_map[int(old)] = int(new)
+    return tool_map
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Post-process a sliced gcode file for Trad Rack in a single pass"
+        )
+    )
+    parser.add_argument("source_file", help="sliced gcode file")
+    parser.add_argument(
+        "-o",
+        "--output",
+        help="file to write the result to (the default is the source file)",
+    )
+    parser.add_argument(
+        "--remove-unload",
+        action="store_true",
+        help="remove the slicer's unload gcode (see remove_unload.py)",
+    )
+    parser.add_argument(
+        "--remove-redundant-toolchanges",
+        action="store_true",
+        help="remove toolchanges to the tool that is already loaded",
+    )
+    parser.add_argument(
+        "--tool-list",
+        action="store_true",
+        help="list the tools used at the end of the file for TR_PREFLIGHT",
+    )
+    parser.add_argument(
+        "--tool-map",
+        metavar="OLD=NEW[,OLD=NEW...]",
+        help="change the tool number of toolchanges",
+    )
+    args = parser.parse_args()
+
+    rules = []
+    if args.remove_unload:
+        rules.append(RemoveUnloadRule())
+    if args.tool_map:
+        try:
+            rules.append(ToolMapRule(parse_tool_map(args.tool_map)))
+        except ValueError as e:
+            sys.exit("Invalid --tool-map: %s" % e)
+    if args.remove_redundant_toolchanges:
+        rules.append(RemoveRedundantToolchangesRule())
+    if args.tool_list:
+        rules.append(ToolListRule())
+    if not rules:
+        sys.exit("No rules selected")
+    process_file(args.source_file, rules, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+import argparse, math, random, sys
+from gcode_post_process import parse_toolchange, process_file
+
+HEADER = b"; Lane mapping generated by optimize_lane_map.py\n"
+
+
+def read_toolchanges(source_file):
+    # get the (tool, lane) of each toolchange in the order they are loaded
+    # (lane is only set for toolchanges that load a lane directly)
+    toolchanges = []
+    with open(source_file, "rb") as f:
+        for line in f:
+            toolchange = parse_toolchange(line.lstrip())
+            if toolchange is None:
+                continue
+            if not toolchanges or toolchanges[-1] != toolchange:
+                toolchanges.append(toolchange)
+    return toolchanges
+
+
+def count_transitions(toolchanges):
+    transitions = {}
+    for key in zip(toolchanges, toolchanges[1:]):
+        transitions[key] = transitions.get(key, 0) + 1
+    return transitions
+
+
+def move_time(distance, velocity, accel):
+    # time for a trapezoidal move that starts and ends at rest
+    if distance <= 0.0:
+        return 0.0
+    accel_dist = velocity * velocity / accel
+    if distance < accel_dist:
+        return 2.0 * math.sqrt(distance / accel)
+    return 2.0 * velocity / accel + (distance - accel_dist) / velocity
+
+
+class LaneMapOptimizer:
+    def __init__(self, transitions, lane_count, lane_spacing, velocity, accel):
+        self.transitions = transitions
+        self.lane_count = lane_count
+        self.lane_times = [
+            [
+                move_time(abs(a - b) * lane_spacing, velocity, accel)
+                for b in range(lane_count)
+            ]
+            for a in range(lane_count)
+        ]
+
+        # lanes loaded directly by the print cannot be used for a tool
+        self.fixed_lanes = set()
+        for toolchanges in transitions:
+            for tool, lane in toolchanges:
+                if lane is not None:
+                    self.fixed_lanes.add(lane)
+
+    def get_cost(self, lane_map):
+        # total selector travel time for all toolchanges
+        return sum(
+            count
+            * self.lane_times[self._get_lane(lane_map, a)][
+                self._get_lane(lane_map, b)
+            ]
+            for (a, b), count in self.transitions.items()
+        )
+
+    def _get_lane(self, lane_map, toolchange):
+        tool, lane = toolchange
+        if lane is None:
+            return lane_map[tool]
+        return lane
+
+    def optimize(self, tools, restarts=20, seed=0):
+        # local search over tool swaps and moves to unused lanes, restarted
+        # from the default mapping and from random mappings
+        rand = random.Random(seed)
+        free_lanes = [
+            lane
+            for lane in range(self.lane_count)
+            if lane not in self.fixed_lanes
+        ]
+        best_map, best_cost = None, float("inf")
+        for i in range(restarts + 1):
+            if i == 0:
+                # skip the default mapping if it uses a lane that the print
+                # loads directly
+                if self.fixed_lanes.intersection(tools):
+                    continue
+                lane_map = {tool: tool for tool in tools}
+            else:
+                lanes = rand.sample(free_lanes, len(tools))
+                lane_map = dict(zip(tools, lanes))
+            lane_map, cost = self._improve(tools, lane_map)
+            if cost < best_cost - 1e-9:
+                best_map, best_cost = lane_map, cost
+        return best_map, best_cost
+
+    def _improve(self, tools, lane_map):
+        cost = self.get_cost(lane_map)
+        improved = True
+        while improved:
+            improved = False
+            for new_map in self._neighbors(tools, lane_map):
+                new_cost = self.get_cost(new_map)
+                if new_cost < cost - 1e-9:
+                    lane_map, cost = new_map, new_cost
+                    improved = True
+                    break
+        return lane_map, cost
+
+    def _neighbors(self, tools, lane_map):
+        for i, tool in enumerate(tools):
+            # swap lanes with another tool
+            for other_tool in tools[i + 1 :]:
+                new_map = dict(lane_map)
+                new_map[tool] = lane_map[other_tool]
+                new_map[other_tool] = lane_map[tool]
+                yield new_map
+
+            # move to an unused lane
+            used_lanes = self.fixed_lanes.union(lane_map.values())
+            for lane in range(self.lane_count):
+                if lane not in used_lanes:
+                    new_map = dict(lane_map)
+                    new_map[tool] = lane
+                    yield new_map
+
+
+def get_assign_commands(lane_map, lane_count):
+    # assign every lane so that lanes that are not used in the print are not
+    # left in the lane group of a tool that is used
+    commands = []
+    used_lanes = {lane: tool for tool, lane in lane_map.items()}
+    spare_tools = [t for t in range(lane_count) if t not in lane_map]
+    for lane in range(lane_count):
+        if lane in used_lanes:
+            commands.append(
+                "TR_ASSIGN_LANE LANE={} TOOL={} SET_DEFAULT=1".format(
+                    lane, used_lanes[lane]
+                )
+            )
+        else:
+            commands.append(
+                "TR_ASSIGN_LANE LANE={} TOOL={}".format(lane, spare_tools[0])
+            )
+    return commands
+
+
+class LaneMapRule:
+    # adds TR_ASSIGN_LANE commands to the start of the file, replacing the
+    # ones added by an earlier run
+    def __init__(self, commands):
+        self.commands = commands
+
+    def apply(self, lines):
+        yield HEADER
+        for command in self.commands:
+            yield command.encode() + b"\n"
+        lines = iter(lines)
+        line = next(lines, None)
+        if line == HEADER:
+            line = next(lines, None)
+            while line is not None and line.startswith(b"TR_ASSIGN_LANE "):
+                line = next(lines, None)
+        if line is not None:
+            yield line
+        yield from lines
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Find a lane for each tool in a sliced gcode file that minimizes"
+            " the time the Trad Rack selector spends moving between lanes"
+        )
+    )
+    parser.add_argument("source_file", help="sliced gcode file")
+    parser.add_argument("--lane-count", type=int, default=16)
+    parser.add_argument("--lane-spacing", type=float, default=17.0)
+    parser.add_argument(
+        "--selector-max-velocity",
+        type=float,
+        default=400.0,
+        help="selector_max_velocity from the [trad_rack] config section",
+    )
+    parser.add_argument(
+        "--selector-max-accel",
+        type=float,
+        default=10000.0,
+        help="selector_max_accel from the [trad_rack] config section",
+    )
+    parser.add_argument(
+        "--write",
+        action="store_true",
+        help="add the TR_ASSIGN_LANE commands to the start of the file",
+    )
+    args = parser.parse_args()
+
+    toolchanges = read_toolchanges(args.source_file)
+    used_tools = sorted({tool for tool, lane in toolchanges if lane is None})
+    fixed_lanes = sorted(
+        {lane for tool, lane in toolchanges if lane is not None}
+    )
+    if len(toolchanges) < 2 or not used_tools:
+        print("No toolchanges found")
+        return
+    if max(used_tools) >= args.lane_count:
+        sys.exit(
+            "Tool {} does not exist with {} lanes".format(
+                max(used_tools), args.lane_count
+            )
+        )
+    if fixed_lanes and max(fixed_lanes) >= args.lane_count:
+        sys.exit(
+            "Lane {} does not exist with {} lanes".format(
+                max(fixed_lanes), args.lane_count
+            )
+        )
+    if len(used_tools) + len(fixed_lanes) > args.lane_count:
+        sys.exit(
+            "{} tools and {} directly loaded lanes do not fit in {}"
+            " lanes".format(len(used_tools), len(fixed_lanes), args.lane_count)
+        )
+
+    # find best lane for each tool
+    optimizer = LaneMapOptimizer(
+        count_transitions(toolchanges),
+        args.lane_count,
+        args.lane_spacing,
+        args.selector_max_velocity,
+        args.selector_max_accel,
+    )
+    default_cost = optimizer.get_cost({tool: tool for tool in used_tools})
+    lane_map, cost = optimizer.optimize(used_tools)
+    commands = get_assign_commands(lane_map, args.lane_count)
+
+    # print results
+    print(
+        "{} toolchanges between {} tools".format(
+            len(toolchanges) - 1, len(used_tools)
+        )
+    )
+    if fixed_lanes:
+        print(
+            "Lanes loaded directly (not remapped): {}".format(
+                ", ".join(str(lane) for lane in fixed_lanes)
+            )
+        )
+    print(
+        "Selector travel time with default lanes: {:.1f}s".format(default_cost)
+    )
+    print("Selector travel time with optimized lanes: {:.1f}s".format(cost))
+    print("Load the filament for each tool into the following lanes:")
+    for tool in used_tools:
+        print("  Tool {}: lane {}".format(tool, lane_map[tool]))
+    print("Then run the following commands:")
+    for command in commands:
+        print("  " + command)
+
+    # add commands to the start of the file
+    if args.write:
+        process_file(args.source_file, [LaneMapRule(commands)])
+
+
+if __name__ == "__main__":
+    main()
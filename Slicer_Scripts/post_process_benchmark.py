@@ -0,0 +1,177 @@
+import argparse, os, random, re, sys, tempfile, time, tracemalloc
+from gcode_post_process import (
+    RemoveRedundantToolchangesRule,
+    RemoveUnloadRule,
+    process_file,
+)
+
+# gcode added by the slicer for each toolchange, including the unload block
+# removed by RemoveUnloadRule
+TOOLCHANGE_GCODE = """; CP TOOLCHANGE START
+M220 B
+M220 S100
+G1 X180.000 Y10.000 F7200
+G1 E-15.0000 F6000
+G1 E-24.5000 F5400
+G1 E-7.0000 F2700
+G1 E-3.5000 F1620
+G1 E14.5000 F600
+G1 E-14.5000 F600
+G1 E-49.0000 F1800
+; Filament-specific end gcode
+T{tool}
+G1 E50.0000 F1800
+; CP TOOLCHANGE END
+"""
+
+
+def legacy_remove_unload(source_file):
+    # the original remove_unload.py, which reads the whole file into memory
+    # and rewrites it in place
+    with open(source_file, "r") as f:
+        lines = f.readlines()
+        to_skip = []
+        start = None
+        for i in range(len(lines)):
+            if re.match("G1 E-15[.0]* F6000", lines[i]):
+                start = i
+            elif start is not None and (
+                "; Filament-specific end gcode" in lines[i]
+            ):
+                to_skip.append((start, i))
+                start = None
+
+    with open(source_file, "w") as f:
+        start = 0
+        for s in to_skip:
+            for i in range(start, s[0]):
+                f.write(lines[i])
+            start = s[1]
+        for i in range(start, len(lines)):
+            f.write(lines[i])
+
+
+def write_synthetic_file(filename, size_mb, toolchanges, tools, seed):
+    # write a file with print moves between evenly spaced toolchanges
+    rand = random.Random(seed)
+    layer_bytes = size_mb * 1024 * 1024 // (toolchanges + 1)
+    tool = 0
+    with open(filename, "w", newline="\n") as f:
+        f.write("; generated by post_process_benchmark.py\nT0\n")
+        for i in range(toolchanges + 1):
+            written = 0
+            while written < layer_bytes:
+                line = "G1 X%.3f Y%.3f E%.5f\n" % (
+                    rand.uniform(0.0, 300.0),
+                    rand.uniform(0.0, 300.0),
+                    rand.uniform(0.01, 0.5),
+                )
+                f.write(line)
+                written += len(line)
+            if i < toolchanges:
+                if rand.random() < 0.05:
+                    # toolchange to the tool that is already loaded
+                    f.write("T%d\n" % tool)
+                tool = (tool + rand.randrange(1, tools)) % tools
+                f.write(TOOLCHANGE_GCODE.format(tool=tool))
+
+
+def run(name, func, source_file, work_file, measure_memory):
+    with open(source_file, "rb") as src, open(work_file, "wb") as dest:
+        dest.write(src.read())
+    if measure_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    func(work_file)
+    elapsed = time.perf_counter() - start
+    peak = None
+    if measure_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    line = "%-28s %8.3f s" % (name, elapsed)
+    if peak is not None:
+        line += "  peak memory %8.1f MB" % (peak / (1024.0 * 1024.0))
+    print(line)
+
+
+def files_match(file_a, file_b):
+    with open(file_a, "rb") as a, open(file_b, "rb") as b:
+        while True:
+            chunk_a = a.read(1 << 20)
+            if chunk_a != b.read(1 << 20):
+                return False
+            if not chunk_a:
+                return True
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Time remove_unload.py and gcode_post_process.py on a large"
+            " synthetic gcode file"
+        )
+    )
+    parser.add_argument("--size-mb", type=int, default=200)
+    parser.add_argument("--toolchanges", type=int, default=2000)
+    parser.add_argument("--tools", type=int, default=16)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="also measure peak memory (makes each run slower)",
+    )
+    args = parser.parse_args()
+    if args.tools < 2:
+        sys.exit("At least 2 tools are needed")
+
+    temp_dir = tempfile.mkdtemp()
+    source_file = os.path.join(temp_dir, "source.gcode")
+    legacy_file = os.path.join(temp_dir, "legacy.gcode")
+    streaming_file = os.path.join(temp_dir, "streaming.gcode")
+    try:
+        write_synthetic_file(
+            source_file, args.size_mb, args.toolchanges, args.tools, args.seed
+        )
+        print(
+            "%.1f MB synthetic file with %d toolchanges"
+            % (
+                os.path.getsize(source_file) / (1024.0 * 1024.0),
+                args.toolchanges,
+            )
+        )
+        run(
+            "remove_unload (legacy)",
+            legacy_remove_unload,
+            source_file,
+            legacy_file,
+            args.memory,
+        )
+        run(
+            "remove unload (streaming)",
+            lambda f: process_file(f, [RemoveUnloadRule()]),
+            source_file,
+            streaming_file,
+            args.memory,
+        )
+        if not files_match(legacy_file, streaming_file):
+            print("ERROR: outputs differ")
+            return 1
+        print("outputs match")
+        run(
+            "remove unload + redundant",
+            lambda f: process_file(
+                f, [RemoveUnloadRule(), RemoveRedundantToolchangesRule()]
+            ),
+            source_file,
+            streaming_file,
+            args.memory,
+        )
+    finally:
+        for filename in os.listdir(temp_dir):
+            os.remove(os.path.join(temp_dir, filename))
+        os.rmdir(temp_dir)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
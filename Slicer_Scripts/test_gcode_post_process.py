@@ -0,0 +1,40 @@
+import unittest
+from gcode_post_process import RemoveRedundantToolchangesRule, process_lines
+
+
+def remove_redundant(lines):
+    return [
+        line.decode()
+        for line in process_lines(
+            (line.encode() for line in lines),
+            [RemoveRedundantToolchangesRule()],
+        )
+    ]
+
+
+class RemoveRedundantToolchangesTest(unittest.TestCase):
+    def test_removes_repeated_toolchange(self):
+        lines = ["T1\n", "G1 X1\n", "T1\n", "T2\n"]
+        self.assertEqual(remove_redundant(lines), ["T1\n", "G1 X1\n", "T2\n"])
+
+    def test_keeps_toolchange_after_unload(self):
+        lines = ["T1\n", "TR_UNLOAD_TOOLHEAD\n", "T1\n"]
+        self.assertEqual(remove_redundant(lines), lines)
+
+    def test_keeps_toolchange_after_load_of_other_tool(self):
+        lines = ["T1\n", "TR_LOAD_TOOLHEAD TOOL=2\n", "T1\n"]
+        self.assertEqual(remove_redundant(lines), lines)
+
+    def test_tracks_tool_loaded_with_load_toolhead(self):
+        lines = ["TR_LOAD_TOOLHEAD TOOL=2\n", "T2\n", "T1\n"]
+        self.assertEqual(
+            remove_redundant(lines), ["TR_LOAD_TOOLHEAD TOOL=2\n", "T1\n"]
+        )
+
+    def test_keeps_toolchange_after_lane_load(self):
+        lines = ["T1\n", "TR_LOAD_TOOLHEAD LANE=1\n", "T1\n"]
+        self.assertEqual(remove_redundant(lines), lines)
+
+
+if __name__ == "__main__":
+    unittest.main()